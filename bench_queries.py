@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the db_helper hot lookups.
+Compares the old ORM Query + instance hydration path against the
+precompiled Core fast path, per call, on a throwaway SQLite database.
+
+Usage: python bench_queries.py [users] [calls]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# Point db_helper at a scratch database BEFORE importing it
+_tmpdir = tempfile.mkdtemp(prefix="rxzbot-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+
+import db_helper
+from init_database import Base, User, UserCredential
+
+
+def seed(count):
+    """Create the schema and insert `count` users with credentials."""
+    Base.metadata.create_all(db_helper.engine)
+    with db_helper.get_db() as db:
+        for i in range(count):
+            db.add(User(
+                username=f"player{i}",
+                player_id=f"pid-{i}",
+                expires="2099-12-31",
+                paused=False,
+                last_nickname=None,
+                first_connection_date="2024-01-01 00:00:00"
+            ))
+            db.add(UserCredential(email=f"user{i}@example.com", password="x", accounts=[f"player{i}"]))
+
+
+def orm_license(db, username):
+    """Previous implementation: ORM query, full instance, copied to a dict."""
+    u = db.query(User).filter(User.username == username).first()
+    if not u:
+        return None
+    return {
+        "username": u.username,
+        "player_id": getattr(u, 'player_id', None),
+        "expires": u.expires,
+        "paused": u.paused,
+        "paused_at": u.paused_at,
+        "remaining_days": u.remaining_days,
+        "last_nickname": getattr(u, 'last_nickname', None),
+        "first_connection_date": getattr(u, 'first_connection_date', None)
+    }
+
+
+def fast_license(db, username):
+    """Current implementation: precompiled Core select returning a row tuple."""
+    row = db.execute(db_helper._SELECT_LICENSE_BY_USERNAME, {"username": username}).first()
+    return db_helper._license_from_row(row) if row else None
+
+
+def orm_accounts(db, email):
+    row = db.query(UserCredential).filter(UserCredential.email == email).first()
+    return (row.accounts or []) if row else []
+
+
+def fast_accounts(db, email):
+    return db.execute(db_helper._SELECT_ACCOUNTS_BY_EMAIL, {"email": email}).scalar() or []
+
+
+def measure(label, func, keys):
+    """Run func(db, key) for every key and print CPU microseconds per call."""
+    with db_helper.get_db() as db:
+        for key in keys[:50]:  # warm the compiled cache
+            func(db, key)
+        db.expunge_all()
+        start = time.process_time()
+        for key in keys:
+            func(db, key)
+            db.expunge_all()  # don't let the identity map hide hydration cost
+        elapsed = time.process_time() - start
+    per_call = elapsed / len(keys) * 1_000_000
+    print(f"   {label:<28} {per_call:8.1f} µs/call")
+    return per_call
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    print("=" * 60)
+    print(f"⏱️  DB HELPER MICROBENCHMARK ({users} users, {calls} calls)")
+    print("=" * 60)
+    seed(users)
+
+    names = [f"player{i % users}" for i in range(calls)]
+    emails = [f"user{i % users}@example.com" for i in range(calls)]
+
+    print("\nget_license:")
+    before = measure("ORM query (before)", orm_license, names)
+    after = measure("Core fast path (after)", fast_license, names)
+    print(f"   speedup: {before / after:.2f}x")
+
+    print("\nget_user_accounts:")
+    before = measure("ORM query (before)", orm_accounts, emails)
+    after = measure("Core fast path (after)", fast_accounts, emails)
+    print(f"   speedup: {before / after:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
 import os
-from sqlalchemy import create_engine
+import json
+import base64
+import hashlib
+import gzip
+import threading
+from collections import defaultdict, namedtuple
+from time import monotonic
+from sqlalchemy import (
+    create_engine, select, bindparam, func, exists, and_, or_, tuple_,
+    table, column, literal_column, case, Date, Integer
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
-from datetime import datetime
-from init_database import User, Key, Testimonial, UserCredential, UserXP, Stats, LastConnected, Log, RecentConnection, PasswordReset
+from datetime import datetime, date, time, timedelta
+from flask import g, has_request_context
+from init_database import (
+    User, Key, Testimonial, UserCredential, UserXP, Stats, LastConnected, Log, RecentConnection, PasswordReset,
+    PurchaseStatus, PurchasePlatform
+)
 from sqlalchemy.exc import OperationalError
+from records import LicenseRecord, KeyRecord, TestimonialRecord, PurchaseRecord
 
 # Database connection with PROPER pool configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -21,18 +37,251 @@ engine = create_engine(
 # ✅ Use plain sessionmaker (NOT scoped_session)
 SessionLocal = sessionmaker(bind=engine)
 
-# Ensure unique index on user_credentials.email exists (idempotent)
+# Idempotent schema additions applied on startup (indexes, additive columns),
+# after ensure_schema() has created any missing table. Each statement runs in
+# its own transaction so one failure doesn't block the rest.
 from sqlalchemy import text
-try:
+_SCHEMA_STATEMENTS = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_user_credentials_email ON user_credentials (email);",
+    # Native date columns for licenses (backfilled by migrate_native_dates.py)
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS expires_on DATE;",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS paused_on DATE;",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS first_connected_at TIMESTAMP;",
+    "CREATE INDEX IF NOT EXISTS ix_users_expires_on ON users (expires_on);",
+    # Case-insensitive username lookups (WHERE lower(username) = lower(:name))
+    "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username));",
+    "CREATE INDEX IF NOT EXISTS idx_stats_username_lower ON stats (lower(username));",
+    "CREATE INDEX IF NOT EXISTS idx_last_connected_username_lower ON last_connected (lower(username));",
+    "CREATE INDEX IF NOT EXISTS idx_user_xp_username_lower ON user_xp (lower(username));",
+    "CREATE INDEX IF NOT EXISTS idx_testimonials_username_lower ON testimonials (lower(username));",
+    # Case-insensitive activation key lookups for redemption; unique, so codes
+    # differing only by case can't be minted (replaces the plain index)
+    """DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = 'idx_keys_code_lower_unique') THEN
+            CREATE UNIQUE INDEX idx_keys_code_lower_unique ON keys (lower(code));
+            DROP INDEX IF EXISTS idx_keys_code_lower;
+        END IF;
+    END $$;""",
+    # Legacy keys differing only by case make the unique build fail (logged
+    # on every boot until they are cleaned up); keep redemption indexed
+    """DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = 'idx_keys_code_lower_unique') THEN
+            CREATE INDEX IF NOT EXISTS idx_keys_code_lower ON keys (lower(code));
+        END IF;
+    END $$;""",
+    # Housekeeping of unused keys by creation time
+    "CREATE INDEX IF NOT EXISTS idx_keys_unused_created ON keys (created) WHERE used = false;",
+    # Keyset pagination: prefix search and (sort, tiebreak) orderings
+    "CREATE INDEX IF NOT EXISTS idx_users_username_pattern ON users (lower(username) text_pattern_ops);",
+    "CREATE INDEX IF NOT EXISTS idx_users_expires_on_username ON users (expires_on, username);",
+    "CREATE INDEX IF NOT EXISTS idx_keys_code_pattern ON keys (code text_pattern_ops);",
+    "CREATE INDEX IF NOT EXISTS idx_keys_created_code ON keys (created, code);",
+    "CREATE INDEX IF NOT EXISTS idx_testimonials_date_id ON testimonials (date, id);",
+    "CREATE INDEX IF NOT EXISTS idx_purchases_created_id ON purchases (created_at, id);",
+    # Denormalized admin user list (see load_admin_users); the unique index
+    # is what allows REFRESH ... CONCURRENTLY
+    """CREATE MATERIALIZED VIEW IF NOT EXISTS admin_user_summary AS
+        SELECT u.username, u.player_id, u.expires_on, u.expires, u.paused, u.paused_at,
+               u.remaining_days, u.last_nickname, u.first_connection_date,
+               lc.last_connected, COALESCE(s.connection_count, 0) AS connection_count
+        FROM users u
+        LEFT JOIN last_connected lc ON lc.username = u.username
+        LEFT JOIN stats s ON s.username = u.username;""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_admin_user_summary_username ON admin_user_summary (username);",
+    # Native log timestamps for retention (old rows are backfilled by migrate_log_partitions.py)
+    "ALTER TABLE logs ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;",
+    "ALTER TABLE logs ALTER COLUMN created_at SET DEFAULT (now() AT TIME ZONE 'utc');",
+    "CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs (created_at);",
+    # Keyset pages of /api/logs/query
+    "CREATE INDEX IF NOT EXISTS idx_logs_created_id ON logs (created_at, id);",
+    "ALTER TABLE recent_connections ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;",
+    "ALTER TABLE recent_connections ALTER COLUMN created_at SET DEFAULT (now() AT TIME ZONE 'utc');",
+    "CREATE INDEX IF NOT EXISTS idx_recent_connections_created_at ON recent_connections (created_at);",
+    # Structured log fields, each indexed together with time for filtered range scans
+    "ALTER TABLE logs ADD COLUMN IF NOT EXISTS event VARCHAR(50);",
+    "ALTER TABLE logs ADD COLUMN IF NOT EXISTS username VARCHAR(255);",
+    "ALTER TABLE logs ADD COLUMN IF NOT EXISTS ip VARCHAR(50);",
+    "CREATE INDEX IF NOT EXISTS idx_logs_level_created_at ON logs (level, created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_logs_event_created_at ON logs (event, created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_logs_username_created_at ON logs (lower(username), created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_logs_ip_created_at ON logs (ip, created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_logs_message_fts ON logs USING GIN (to_tsvector('simple', message));",
+    # Per-item hashes for the differential shop sync
+    "ALTER TABLE shop_bundles ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);",
+    "ALTER TABLE shop_skin_sets ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);",
+    "ALTER TABLE shop_daily_skins ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);",
+    "ALTER TABLE shop_calendars ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);",
+    # Pre-serialized shop catalog snapshot
+    "ALTER TABLE shop_metadata ADD COLUMN IF NOT EXISTS snapshot_json BYTEA;",
+    "ALTER TABLE shop_metadata ADD COLUMN IF NOT EXISTS snapshot_gzip BYTEA;",
+    "ALTER TABLE shop_metadata ADD COLUMN IF NOT EXISTS snapshot_etag VARCHAR(64);",
+    # Scheduler run history and expired password reset cleanup
+    "CREATE INDEX IF NOT EXISTS idx_job_runs_job_started ON job_runs (job, started_at DESC);",
+    "CREATE INDEX IF NOT EXISTS idx_password_resets_expires_at ON password_resets (expires_at);",
+    # Best-fit gem account selection
+    "CREATE INDEX IF NOT EXISTS idx_gem_accounts_active_gems ON gem_accounts (gems_remaining, last_used) WHERE is_active = true;",
+    # Gift code lookup, listing and ledger
+    # (initial_amount of older codes is backfilled by migrate_gift_codes.py)
+    "ALTER TABLE gift_codes ADD COLUMN IF NOT EXISTS initial_amount NUMERIC(10, 2);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_gift_codes_code ON gift_codes (code);",
+    "CREATE INDEX IF NOT EXISTS idx_gift_codes_created_id ON gift_codes (created_at, id);",
+    "CREATE INDEX IF NOT EXISTS idx_gift_code_transactions_code ON gift_code_transactions (code, created_at);",
+    """CREATE OR REPLACE FUNCTION gift_code_transactions_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'gift_code_transactions is append-only';
+    END;
+    $$ LANGUAGE plpgsql;""",
+    "CREATE OR REPLACE TRIGGER gift_code_transactions_append_only BEFORE UPDATE OR DELETE ON gift_code_transactions "
+    "FOR EACH ROW EXECUTE FUNCTION gift_code_transactions_append_only();",
+    # Purchase work queue: claims, status/platform lists, allowed values
+    "ALTER TABLE purchases ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(255);",
+    "ALTER TABLE purchases ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;",
+    "CREATE INDEX IF NOT EXISTS idx_purchases_status_created ON purchases (status, created_at, id);",
+    "CREATE INDEX IF NOT EXISTS idx_purchases_platform_created ON purchases (platform, created_at, id);",
+    """DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'purchases_status_check') THEN
+            ALTER TABLE purchases ADD CONSTRAINT purchases_status_check
+                CHECK (status IN ('Awaiting user contact', 'Awaiting transaction', 'Completed')) NOT VALID;
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'purchases_platform_check') THEN
+            ALTER TABLE purchases ADD CONSTRAINT purchases_platform_check
+                CHECK (platform IN ('Instagram', 'Discord', 'PayPal')) NOT VALID;
+        END IF;
+    END $$;""",
+    # Outbound email queue
+    "CREATE INDEX IF NOT EXISTS idx_outbound_emails_due ON outbound_emails (next_attempt_at, id) WHERE status = 'pending';",
+    "CREATE INDEX IF NOT EXISTS idx_outbound_emails_sending ON outbound_emails (claimed_at) WHERE status = 'sending';",
+    "CREATE INDEX IF NOT EXISTS idx_outbound_emails_created ON outbound_emails (created_at);",
+]
+
+SCHEMA_LOCK_KEY = int(os.getenv("SCHEMA_LOCK_KEY", "7235675"))
+
+def ensure_schema():
+    """
+    Create missing tables, then apply the idempotent schema statements
+    (safe to run on every boot). Workers booting together serialize on an
+    advisory lock. Failing to create a table raises, since the statements
+    and the app depend on it; a failing statement is logged and the rest
+    still run. Other dialects (the SQLite benchmark database) only get the
+    tables: the statements and the advisory lock are Postgres-only.
+    Returns the number of failed statements.
+    """
+    from init_database import Base
+    if engine.dialect.name != "postgresql":
+        Base.metadata.create_all(engine, checkfirst=True)
+        return 0
+    failed = 0
     with engine.connect() as conn:
-        conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_credentials_email ON user_credentials (email);"))
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
         conn.commit()
-except Exception:
-    pass
+        try:
+            Base.metadata.create_all(conn, checkfirst=True)
+            conn.commit()
+            for statement in _SCHEMA_STATEMENTS:
+                try:
+                    with conn.begin():
+                        conn.execute(text(statement))
+                except Exception as e:
+                    failed += 1
+                    summary = " ".join(statement.split())[:80]
+                    print(f"⚠️ Schema statement failed: {summary}... ({e})")
+        finally:
+            conn.rollback()
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            conn.commit()
+    if failed:
+        print(f"⚠️ {failed} schema statement(s) failed, see above")
+    return failed
+
+ensure_schema()
+
+# ==================== REQUEST-SCOPED SESSION ====================
+
+def _request_session():
+    """Return the session bound to the current Flask request, or None.
+
+    The session is created lazily on first use so requests that never touch
+    the database never check out a connection.
+    """
+    if not has_request_context() or not g.get('_db_unit_of_work'):
+        return None
+    db = g.get('_db_session')
+    if db is None:
+        db = SessionLocal()
+        g._db_session = db
+    return db
+
+def init_request_session(app):
+    """Bind one database session (unit of work) to each Flask request.
+
+    Every `get_db()` block inside the request joins that session under a
+    SAVEPOINT, and the request does a single commit once the view returns.
+    """
+    @app.before_request
+    def _begin_unit_of_work():
+        g._db_unit_of_work = True
+
+    @app.after_request
+    def _commit_unit_of_work(response):
+        # Anything running after this point (streamed bodies, teardown logging)
+        # falls back to standalone sessions that commit on their own.
+        g._db_unit_of_work = False
+        db = g.pop('_db_session', None)
+        callbacks = g.pop('_db_after_commit', [])
+        if db is not None:
+            try:
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"⚠️ Error committing request session: {e}")
+                raise
+            finally:
+                db.close()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Error in after-commit callback: {e}")
+        return response
+
+    @app.teardown_request
+    def _close_unit_of_work(exc):
+        g._db_unit_of_work = False
+        g.pop('_db_after_commit', None)
+        db = g.pop('_db_session', None)
+        if db is not None:
+            # Only reached when the view raised before after_request ran
+            db.rollback()
+            db.close()
+
+def call_after_commit(callback):
+    """
+    Run `callback` once the current request's unit of work has committed
+    (dropped if it, or the get_db() block it was registered in, rolls back);
+    outside a request it runs right away.
+    """
+    if has_request_context() and g.get('_db_unit_of_work'):
+        g.setdefault('_db_after_commit', []).append(callback)
+    else:
+        callback()
 
 @contextmanager
 def get_db():
     """Context manager for database sessions - PROPERLY releases connections"""
+    shared = _request_session()
+    if shared is not None:
+        # Join the request unit of work; a failing block only rolls back its
+        # own SAVEPOINT, the commit happens once at the end of the request.
+        callbacks = g.setdefault('_db_after_commit', [])
+        mark = len(callbacks)
+        try:
+            with shared.begin_nested():
+                yield shared
+        except BaseException:
+            del callbacks[mark:]  # registered for changes that were just rolled back
+            raise
+        return
+
     db = SessionLocal()
     try:
         yield db
@@ -43,26 +292,79 @@ def get_db():
     finally:
         db.close()  # ✅ Now this actually returns connection to pool
 
+# ==================== FAST-PATH QUERIES ====================
+# Hot lookups are built once at import as Core statements with bound
+# parameters: SQLAlchemy's compiled cache reuses the SQL for every call and
+# rows come back as plain tuples instead of hydrated ORM instances.
+
+_users = User.__table__
+_keys = Key.__table__
+_testimonials = Testimonial.__table__
+_credentials = UserCredential.__table__
+
+# The legacy `expires` string trails the record columns as a fallback for
+# rows that haven't been backfilled yet (see _license_from_row)
+_LICENSE_COLUMNS = [_users.c[name] for name in LicenseRecord.__slots__] + [_users.c.expires]
+_KEY_COLUMNS = [_keys.c[name] for name in KeyRecord.__slots__]
+_TESTIMONIAL_COLUMNS = [_testimonials.c[name] for name in TestimonialRecord.__slots__]
+
+_SELECT_ALL_LICENSES = select(*_LICENSE_COLUMNS)
+_SELECT_ALL_KEYS = select(*_KEY_COLUMNS)
+_SELECT_ALL_TESTIMONIALS = select(*_TESTIMONIAL_COLUMNS)
+
+_SELECT_LICENSE_BY_USERNAME = (
+    select(*_LICENSE_COLUMNS).where(_users.c.username == bindparam('username')).limit(1)
+)
+_SELECT_LICENSE_BY_USERNAME_CI = (
+    select(*_LICENSE_COLUMNS)
+    .where(func.lower(_users.c.username) == func.lower(bindparam('username')))
+    .order_by(_users.c.username).limit(1)
+)
+_SELECT_LICENSE_BY_PLAYER_ID = (
+    select(*_LICENSE_COLUMNS).where(_users.c.player_id == bindparam('player_id')).limit(1)
+)
+_SELECT_CREDENTIAL_BY_EMAIL = (
+    select(_credentials.c.email, _credentials.c.password, _credentials.c.accounts)
+    .where(_credentials.c.email == bindparam('email')).limit(1)
+)
+_SELECT_ACCOUNTS_BY_EMAIL = (
+    select(_credentials.c.accounts).where(_credentials.c.email == bindparam('email')).limit(1)
+)
+
+def to_date(value):
+    """Coerce a date, datetime or 'YYYY-MM-DD' string to a date (None if invalid)"""
+    if value is None or isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    try:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def to_datetime(value):
+    """Coerce a datetime or 'YYYY-MM-DD HH:MM:SS' string to a datetime (None if invalid)"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(str(value)[:19], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+def _license_from_row(row):
+    """Build a LicenseRecord from a fast-path row tuple."""
+    if row[2] is None:
+        # Not backfilled yet: parse the legacy string once
+        return LicenseRecord(row[0], row[1], to_date(row[8]), *row[3:8])
+    return LicenseRecord(*row[:8])
+
 # ==================== USER FUNCTIONS ====================
 
 def load_users():
     """Load all users from database"""
     try:
         with get_db() as db:
-            users = db.query(User).all()
-            return [
-                {
-                    "username": u.username,
-                    "player_id": getattr(u, 'player_id', None),
-                    "expires": u.expires,
-                    "paused": u.paused,
-                    "paused_at": u.paused_at,
-                    "remaining_days": u.remaining_days,
-                    "last_nickname": getattr(u, 'last_nickname', None),
-                    "first_connection_date": getattr(u, 'first_connection_date', None)
-                } 
-                for u in users
-            ]
+            return [_license_from_row(row) for row in db.execute(_SELECT_ALL_LICENSES)]
     except Exception as e:
         print(f"⚠️ Error loading users: {e}")
         return []
@@ -75,8 +377,10 @@ def save_users(users_list):
                 user = db.query(User).filter_by(username=user_data['username']).first()
                 if user:
                     user.expires = user_data['expires']
+                    user.expires_on = to_date(user_data['expires'])
                     user.paused = user_data.get('paused', False)
                     user.paused_at = user_data.get('paused_at')
+                    user.paused_on = to_date(user.paused_at)
                     user.remaining_days = user_data.get('remaining_days')
                     if 'player_id' in user_data:
                         user.player_id = user_data['player_id']
@@ -84,16 +388,20 @@ def save_users(users_list):
                         user.last_nickname = user_data['last_nickname']
                     if 'first_connection_date' in user_data:
                         user.first_connection_date = user_data['first_connection_date']
+                        user.first_connected_at = to_datetime(user.first_connection_date)
                 else:
                     new_user = User(
                         username=user_data['username'],
                         player_id=user_data.get('player_id'),
                         expires=user_data['expires'],
+                        expires_on=to_date(user_data['expires']),
                         paused=user_data.get('paused', False),
                         paused_at=user_data.get('paused_at'),
+                        paused_on=to_date(user_data.get('paused_at')),
                         remaining_days=user_data.get('remaining_days'),
                         last_nickname=user_data.get('last_nickname'),
-                        first_connection_date=user_data.get('first_connection_date')
+                        first_connection_date=user_data.get('first_connection_date'),
+                        first_connected_at=to_datetime(user_data.get('first_connection_date'))
                     )
                     db.add(new_user)
             return {"saved_local": True, "storage": {"ok": True, "detail": "saved to database"}}
@@ -108,24 +416,42 @@ def find_user(users, username):
             return u
     return None
 
+def find_license(username: str):
+    """Case-insensitive single-user lookup via the lower(username) index"""
+    try:
+        with get_db() as db:
+            row = db.execute(_SELECT_LICENSE_BY_USERNAME_CI, {"username": username}).first()
+            if not row:
+                return None
+            return _license_from_row(row)
+    except OperationalError as e:
+        print(f"⚠️ DB connection error in find_license: {e}")
+        return None
+    except Exception as e:
+        print(f"⚠️ Unexpected error in find_license: {e}")
+        return None
+
+def delete_license(username: str):
+    """Delete a user (case-insensitive). Returns the deleted usernames, [] if none, None on error"""
+    try:
+        with get_db() as db:
+            rows = db.execute(
+                _users.delete()
+                .where(func.lower(_users.c.username) == func.lower(username))
+                .returning(_users.c.username)
+            ).all()
+            return [r[0] for r in rows]
+    except Exception as e:
+        print(f"⚠️ Error deleting user {username}: {e}")
+        return None
+
 # ==================== KEY FUNCTIONS ====================
 
 def load_keys():
     """Load all activation keys"""
     try:
         with get_db() as db:
-            keys = db.query(Key).all()
-            return [
-                {
-                    "code": k.code,
-                    "duration": k.duration,
-                    "created": k.created,
-                    "used": k.used,
-                    "used_by": k.used_by,
-                    "used_at": k.used_at
-                }
-                for k in keys
-            ]
+            return [KeyRecord(*row) for row in db.execute(_SELECT_ALL_KEYS)]
     except Exception as e:
         print(f"⚠️ Error loading keys: {e}")
         return []
@@ -177,16 +503,202 @@ def create_key(code, duration, created):
             )
             db.add(new_key)
             db.flush()  # ✅ FLUSH before returning to ensure DB visibility
+            return KeyRecord(
+                new_key.code, new_key.duration, new_key.created,
+                new_key.used, new_key.used_by, new_key.used_at
+            )
+    except Exception as e:
+        print(f"⚠️ Error creating key: {e}")
+        return None
+
+# Rows per multi-row INSERT statement (keeps bind parameters well under the
+# Postgres limit of 65535)
+_INSERT_CHUNK_SIZE = 1000
+
+def _insert_unique_codes(db, table, generate, count, values, max_rounds=10):
+    """
+    Insert `count` rows keyed by freshly generated codes.
+
+    Codes come from `generate()` and are deduplicated in memory
+    (case-insensitively); each round inserts the pending codes with multi-row
+    INSERT ... ON CONFLICT DO NOTHING RETURNING, and only the codes that
+    collided with existing rows are regenerated for the next round. The
+    conflict has no target so it covers every unique index on the table,
+    including keys' unique lower(code). `values` holds the remaining column
+    values shared by every row. Returns the inserted rows.
+    """
+    inserted = []
+    taken = set()
+    missing = count
+    for _ in range(max_rounds):
+        if missing <= 0:
+            break
+        pending = []
+        while len(pending) < missing:
+            code = generate()
+            if code.lower() not in taken:
+                taken.add(code.lower())
+                pending.append(code)
+
+        for i in range(0, len(pending), _INSERT_CHUNK_SIZE):
+            chunk = pending[i:i + _INSERT_CHUNK_SIZE]
+            stmt = (
+                pg_insert(table)
+                .values([dict(values, code=code) for code in chunk])
+                .on_conflict_do_nothing()
+                .returning(*table.c)
+            )
+            inserted.extend(db.execute(stmt).all())
+        missing = count - len(inserted)
+
+    if missing > 0:
+        raise RuntimeError(f"could not allocate {missing} unique codes after {max_rounds} rounds")
+    return inserted
+
+def create_keys(generate, count, duration, created):
+    """
+    Mint `count` activation keys in bulk with collision-free codes.
+    `generate` returns a new random code. Returns a list of KeyRecords, or None on error.
+    """
+    try:
+        with get_db() as db:
+            rows = _insert_unique_codes(db, _keys, generate, count, {
+                "duration": duration,
+                "created": created,
+                "used": False,
+                "used_by": None,
+                "used_at": None
+            })
+            return [KeyRecord(*(row._mapping[c] for c in KeyRecord.__slots__)) for row in rows]
+    except Exception as e:
+        print(f"⚠️ Error creating {count} keys: {e}")
+        return None
+
+def redeem_key(key_code: str, username: str, used_at: str):
+    """
+    Atomically redeem an activation key and extend the user's license in the
+    same transaction.
+
+    The key is claimed with a single conditional UPDATE ... RETURNING on the
+    lower(code) index, so two concurrent submissions of the same key can't
+    both succeed. Returns a dict with "status": "ok", "invalid", "used" or
+    "error"; on "ok" it also carries the duration and the old/new expiry.
+    """
+    try:
+        with get_db() as db:
+            target = (
+                select(_keys.c.code)
+                .where(func.lower(_keys.c.code) == func.lower(key_code), _keys.c.used == False)
+                .order_by(_keys.c.code)
+                .limit(1)
+                .with_for_update()
+                .scalar_subquery()
+            )
+            claimed = db.execute(
+                _keys.update()
+                .where(_keys.c.code == target, _keys.c.used == False)
+                .values(used=True, used_by=username, used_at=used_at)
+                .returning(_keys.c.code, _keys.c.duration)
+            ).first()
+
+            if not claimed:
+                found = db.execute(
+                    select(exists().where(func.lower(_keys.c.code) == func.lower(key_code)))
+                ).scalar()
+                return {"status": "used" if found else "invalid"}
+
+            code, days = claimed
+            today = datetime.now().date()
+
+            user = (
+                db.query(User)
+                .filter(func.lower(User.username) == func.lower(username))
+                .order_by(User.username)
+                .with_for_update()
+                .first()
+            )
+            if user:
+                previous = user.expires_on or to_date(user.expires)
+                # Still valid: extend from the expiry date, otherwise start from today
+                extended = previous is not None and previous > today
+                new_expires = (previous if extended else today) + timedelta(days=days)
+                user.expires = new_expires.isoformat()
+                user.expires_on = new_expires
+            else:
+                previous = None
+                extended = False
+                new_expires = today + timedelta(days=days)
+                db.add(User(
+                    username=username,
+                    expires=new_expires.isoformat(),
+                    expires_on=new_expires,
+                    paused=False
+                ))
+
             return {
-                "code": new_key.code,
-                "duration": new_key.duration,
-                "created": new_key.created,
-                "used": new_key.used,
-                "used_by": new_key.used_by,
-                "used_at": new_key.used_at
+                "status": "ok",
+                "code": code,
+                "duration": days,
+                "new_user": user is None,
+                "extended": extended,
+                "previous_expires": previous.isoformat() if previous else None,
+                "expires": new_expires.isoformat()
             }
     except Exception as e:
-        print(f"⚠️ Error creating key: {e}")
+        print(f"⚠️ Error redeeming key {key_code}: {e}")
+        return {"status": "error", "error": str(e)}
+
+# used_by markers for keys taken out of circulation without being redeemed
+KEY_REVOKED = "(revoked)"
+KEY_EXPIRED = "(expired)"
+
+def delete_keys(codes):
+    """Delete the given keys in one statement; returns the number deleted, or None on error"""
+    if not codes:
+        return 0
+    try:
+        with get_db() as db:
+            result = db.execute(_keys.delete().where(_keys.c.code.in_(list(codes))))
+            return result.rowcount
+    except Exception as e:
+        print(f"⚠️ Error deleting keys: {e}")
+        return None
+
+def revoke_keys(codes, revoked_at: str):
+    """
+    Make unused keys unredeemable while keeping them for audit.
+    Returns the number revoked (already used keys are left alone), or None on error.
+    """
+    if not codes:
+        return 0
+    try:
+        with get_db() as db:
+            result = db.execute(
+                _keys.update()
+                .where(_keys.c.code.in_(list(codes)), _keys.c.used == False)
+                .values(used=True, used_by=KEY_REVOKED, used_at=revoked_at)
+            )
+            return result.rowcount
+    except Exception as e:
+        print(f"⚠️ Error revoking keys: {e}")
+        return None
+
+def expire_unused_keys(created_before: str, expired_at: str):
+    """
+    Expire every unused key created before `created_before` (same
+    "YYYY-MM-DD HH:MM:SSZ" format as keys.created, which sorts lexically).
+    Returns the number expired, or None on error.
+    """
+    try:
+        with get_db() as db:
+            result = db.execute(
+                _keys.update()
+                .where(_keys.c.used == False, _keys.c.created < created_before)
+                .values(used=True, used_by=KEY_EXPIRED, used_at=expired_at)
+            )
+            return result.rowcount
+    except Exception as e:
+        print(f"⚠️ Error expiring keys: {e}")
         return None
 
 # ==================== TESTIMONIAL FUNCTIONS ====================
@@ -195,19 +707,7 @@ def load_testimonials():
     """Load all testimonials"""
     try:
         with get_db() as db:
-            testimonials = db.query(Testimonial).all()
-            return [
-                {
-                    "id": t.id,
-                    "username": t.username,
-                    "rating": t.rating,
-                    "comment": t.comment,
-                    "anonymous": t.anonymous,
-                    "date": t.date,
-                    "approved": t.approved
-                }
-                for t in testimonials
-            ]
+            return [TestimonialRecord(*row) for row in db.execute(_SELECT_ALL_TESTIMONIALS)]
     except Exception as e:
         print(f"⚠️ Error loading testimonials: {e}")
         return []
@@ -241,6 +741,17 @@ def save_testimonials(testimonials_list):
         print(f"⚠️ Error saving testimonials: {e}")
         return {"saved_local": False, "storage": {"ok": False, "detail": str(e)}}
 
+def has_testimonial_from(username: str):
+    """True if this username (case-insensitive) already submitted a testimonial"""
+    try:
+        with get_db() as db:
+            return bool(db.execute(
+                select(exists().where(func.lower(_testimonials.c.username) == func.lower(username)))
+            ).scalar())
+    except Exception as e:
+        print(f"⚠️ Error checking testimonials for {username}: {e}")
+        return False
+
 # ==================== STORAGE FUNCTIONS ====================
 
 def read_storage_impl(filename):
@@ -337,10 +848,10 @@ def get_user_by_email(email: str):
     """Return user credential row for given email or None."""
     try:
         with get_db() as db:
-            user = db.query(UserCredential).filter(UserCredential.email == email).first()
-            if not user:
+            row = db.execute(_SELECT_CREDENTIAL_BY_EMAIL, {"email": email}).first()
+            if not row:
                 return None
-            return {"email": user.email, "password": user.password, "accounts": user.accounts or []}
+            return {"email": row[0], "password": row[1], "accounts": row[2] or []}
     except OperationalError as e:
         print(f"⚠️ DB connection error in get_user_by_email: {e}")
         return None
@@ -390,10 +901,8 @@ def get_user_accounts(user_identifier):
     """Return list of accounts for the given user identifier (email)."""
     try:
         with get_db() as db:
-            row = db.query(UserCredential).filter(UserCredential.email == user_identifier).first()
-            if not row:
-                return []
-            return row.accounts or []
+            accounts = db.execute(_SELECT_ACCOUNTS_BY_EMAIL, {"email": user_identifier}).scalar()
+            return accounts or []
     except OperationalError as e:
         print(f"⚠️ DB connection error in get_user_accounts: {e}")
         return []
@@ -485,19 +994,10 @@ def get_license(username: str):
     """Return license row for username from users table or None"""
     try:
         with get_db() as db:
-            u = db.query(User).filter(User.username == username).first()
-            if not u:
+            row = db.execute(_SELECT_LICENSE_BY_USERNAME, {"username": username}).first()
+            if not row:
                 return None
-            return {
-                "username": u.username,
-                "player_id": getattr(u, 'player_id', None),
-                "expires": u.expires,
-                "paused": u.paused,
-                "paused_at": u.paused_at,
-                "remaining_days": u.remaining_days,
-                "last_nickname": getattr(u, 'last_nickname', None),
-                "first_connection_date": getattr(u, 'first_connection_date', None)
-            }
+            return _license_from_row(row)
     except OperationalError as e:
         print(f"⚠️ DB connection error in get_license: {e}")
         return None
@@ -513,15 +1013,16 @@ def pause_license(username: str):
                 return False
             if getattr(u, 'paused', False):
                 return False
-            # compute remaining days safely
-            try:
-                from datetime import datetime
-                expires_dt = datetime.strptime(u.expires, '%Y-%m-%d')
-                remaining = (expires_dt - datetime.now()).days
-            except Exception:
+            # compute remaining days from the native expiry (legacy string as fallback)
+            expires_on = u.expires_on or to_date(u.expires)
+            if expires_on is not None:
+                remaining = (datetime.combine(expires_on, time.min) - datetime.now()).days
+            else:
                 remaining = None
+            today = datetime.now().date()
             u.paused = True
-            u.paused_at = datetime.now().strftime('%Y-%m-%d') if hasattr(__import__('datetime'), 'datetime') else None
+            u.paused_at = today.isoformat()
+            u.paused_on = today
             u.remaining_days = remaining
             return True
     except OperationalError as e:
@@ -540,14 +1041,13 @@ def resume_license(username: str):
             if not getattr(u, 'paused', False):
                 return False
             remaining = u.remaining_days or 0
-            try:
-                from datetime import datetime, timedelta
-                new_expiry = (datetime.now() + timedelta(days=remaining)).strftime('%Y-%m-%d')
-            except Exception:
-                new_expiry = u.expires
-            u.expires = new_expiry
+            from datetime import timedelta
+            new_expiry = (datetime.now() + timedelta(days=remaining)).date()
+            u.expires = new_expiry.isoformat()
+            u.expires_on = new_expiry
             u.paused = False
             u.paused_at = None
+            u.paused_on = None
             u.remaining_days = None
             return True
     except OperationalError as e:
@@ -557,10 +1057,27 @@ def resume_license(username: str):
         print(f"⚠️ Unexpected error in resume_license: {e}")
         return False
 
+def get_expiring_licenses(start, end):
+    """Return LicenseRecords expiring in [start, end) - an index range scan on expires_on"""
+    try:
+        with get_db() as db:
+            rows = db.execute(
+                _SELECT_ALL_LICENSES
+                .where(_users.c.expires_on >= to_date(start), _users.c.expires_on < to_date(end))
+                .order_by(_users.c.expires_on)
+            )
+            return [_license_from_row(row) for row in rows]
+    except OperationalError as e:
+        print(f"⚠️ DB connection error in get_expiring_licenses: {e}")
+        return []
+    except Exception as e:
+        print(f"⚠️ Unexpected error in get_expiring_licenses: {e}")
+        return []
+
 def get_user_xp(username: str):
     try:
         with get_db() as db:
-            xp = db.query(UserXP).filter(UserXP.username == username).first()
+            xp = db.query(UserXP).filter(func.lower(UserXP.username) == func.lower(username)).first()
             if not xp:
                 return {"daily": {}, "weekly": {}, "monthly": {}}
             return {"daily": xp.daily or {}, "weekly": xp.weekly or {}, "monthly": xp.monthly or {}}
@@ -571,6 +1088,33 @@ def get_user_xp(username: str):
         print(f"⚠️ Unexpected error in get_user_xp: {e}")
         return {"daily": {}, "weekly": {}, "monthly": {}}
 
+def add_user_xp(username: str, xp_amount, day_key: str, week_key: str, month_key: str):
+    """Add XP to one user's daily/weekly/monthly buckets (row-locked, no full-table load)"""
+    try:
+        with get_db() as db:
+            xp = (
+                db.query(UserXP)
+                .filter(func.lower(UserXP.username) == func.lower(username))
+                .with_for_update()
+                .first()
+            )
+            if not xp:
+                xp = UserXP(username=username, daily={}, weekly={}, monthly={})
+                db.add(xp)
+
+            # Assign fresh dicts so SQLAlchemy sees the JSON columns as changed
+            daily = dict(xp.daily or {})
+            weekly = dict(xp.weekly or {})
+            monthly = dict(xp.monthly or {})
+            daily[day_key] = daily.get(day_key, 0) + xp_amount
+            weekly[week_key] = weekly.get(week_key, 0) + xp_amount
+            monthly[month_key] = monthly.get(month_key, 0) + xp_amount
+            xp.daily, xp.weekly, xp.monthly = daily, weekly, monthly
+            return True
+    except Exception as e:
+        print(f"⚠️ Error adding XP for {username}: {e}")
+        return False
+
 # ==================== STATS FUNCTIONS ====================
 
 def load_stats():
@@ -621,14 +1165,51 @@ def save_last_connected(last_conn_dict):
     except Exception as e:
         print(f"⚠️ Error saving last_connected: {e}")
 
+def record_authorized_connection(username: str, timestamp: str):
+    """Bump one user's connection count and last-connected time (two upserts)"""
+    stats = Stats.__table__
+    last_connected = LastConnected.__table__
+    try:
+        with get_db() as db:
+            db.execute(
+                pg_insert(stats)
+                .values(username=username, connection_count=1)
+                .on_conflict_do_update(
+                    index_elements=[stats.c.username],
+                    set_={"connection_count": func.coalesce(stats.c.connection_count, 0) + 1}
+                )
+            )
+            db.execute(
+                pg_insert(last_connected)
+                .values(username=username, last_connected=timestamp)
+                .on_conflict_do_update(
+                    index_elements=[last_connected.c.username],
+                    set_={"last_connected": timestamp}
+                )
+            )
+            return True
+    except Exception as e:
+        print(f"⚠️ Error recording connection for {username}: {e}")
+        return False
+
 # ==================== LOGGING FUNCTIONS ====================
 
-def save_log(timestamp, message, level='info'):
-    """Save a log entry to database"""
+def save_log(timestamp, message, level='info', event=None, username=None, ip=None):
+    """Save a log entry to database.
+
+    Written on its own connection rather than the request's unit of work, so
+    the logs of a request that rolls back (or fails to commit) are kept.
+    """
     try:
-        with get_db() as db:
-            log = Log(timestamp=timestamp, message=message, level=level)
-            db.add(log)
+        with engine.begin() as conn:
+            conn.execute(Log.__table__.insert().values(
+                timestamp=timestamp,
+                message=message,
+                level=level,
+                event=event,
+                username=username,
+                ip=ip
+            ))
     except Exception as e:
         print(f"⚠️ Error saving log: {e}")
 
@@ -645,17 +1226,72 @@ def get_recent_logs(limit=500):
         print(f"⚠️ Error fetching logs: {e}")
         return []
 
-def save_recent_connection(timestamp, username, ip, status):
-    """Save a recent connection to database"""
+def query_logs(cursor=None, limit=100, levels=None, event=None, username=None, ip=None,
+               search=None, since=None, until=None):
+    """
+    Filtered log search, newest first, in keyset pages (see page_licenses).
+    levels: list of levels; username: case-insensitive exact match;
+    search: full-text query on the message (websearch syntax, e.g.
+    `"bot version" -error`); since/until: UTC datetimes on created_at.
+    Raises ValueError for a bad cursor, returns None on database errors.
+    """
+    logs = Log.__table__
+    stmt = select(
+        logs.c.id, logs.c.timestamp, logs.c.created_at, logs.c.level,
+        logs.c.event, logs.c.username, logs.c.ip, logs.c.message
+    )
+    if levels:
+        stmt = stmt.where(logs.c.level.in_(list(levels)))
+    if event:
+        stmt = stmt.where(logs.c.event == event)
+    if username:
+        stmt = stmt.where(func.lower(logs.c.username) == username.lower())
+    if ip:
+        stmt = stmt.where(logs.c.ip == ip)
+    if since:
+        stmt = stmt.where(logs.c.created_at >= since)
+    if until:
+        stmt = stmt.where(logs.c.created_at < until)
+    if search:
+        # Same expression as idx_logs_message_fts so the GIN index is used
+        config = literal_column("'simple'")
+        stmt = stmt.where(
+            func.to_tsvector(config, logs.c.message).bool_op("@@")(func.websearch_to_tsquery(config, search))
+        )
+
+    def build(row):
+        return {
+            "id": row.id,
+            "ts": row.timestamp,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+            "level": row.level,
+            "event": row.event,
+            "username": row.username,
+            "ip": row.ip,
+            "msg": row.message
+        }
+
     try:
         with get_db() as db:
-            conn = RecentConnection(
+            return _keyset_page(
+                db, stmt, "created_at", logs.c.created_at, logs.c.id, True, cursor, limit, build
+            )
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Error querying logs: {e}")
+        return None
+
+def save_recent_connection(timestamp, username, ip, status):
+    """Save a recent connection to database (own connection, like save_log)"""
+    try:
+        with engine.begin() as conn:
+            conn.execute(RecentConnection.__table__.insert().values(
                 timestamp=timestamp,
                 username=username,
                 ip=ip,
                 status=status
-            )
-            db.add(conn)
+            ))
     except Exception as e:
         print(f"⚠️ Error saving recent connection: {e}")
 
@@ -677,25 +1313,392 @@ def get_recent_connections(limit=300):
         print(f"⚠️ Error fetching recent connections: {e}")
         return []
 
+# ==================== LOG RETENTION ====================
+# logs and recent_connections are range-partitioned on created_at once
+# migrate_log_partitions.py has run. Expired data is then removed by
+# dropping whole partitions; until then (or for rows in the default
+# partition) the pruner falls back to small batched DELETEs on the
+# created_at index.
+
+LOG_RETENTION = {
+    # table: (partition interval "day" | "month", retention in days)
+    "logs": (
+        os.getenv("LOG_PARTITION_INTERVAL", "day"),
+        int(os.getenv("LOG_RETENTION_DAYS", "30"))
+    ),
+    "recent_connections": (
+        os.getenv("CONNECTION_PARTITION_INTERVAL", "month"),
+        int(os.getenv("CONNECTION_RETENTION_DAYS", "90"))
+    ),
+}
+LOG_PARTITIONS_AHEAD = 3
+_PRUNE_BATCH_SIZE = 5000
+
+def period_start(day, interval):
+    """First day of the partition period containing `day`"""
+    return day.replace(day=1) if interval == "month" else day
+
+def next_period(start, interval):
+    if interval == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+def partition_name(table, start, interval):
+    return f"{table}_p{start.strftime('%Y%m' if interval == 'month' else '%Y%m%d')}"
+
+def _partition_start(table, name, interval):
+    """Inverse of partition_name; None for partitions not created by us (e.g. the default one)"""
+    suffix = name[len(table) + 2:] if name.startswith(f"{table}_p") else ""
+    try:
+        if interval == "month":
+            return datetime.strptime(suffix, "%Y%m").date()
+        return datetime.strptime(suffix, "%Y%m%d").date()
+    except ValueError:
+        return None
+
+def is_partitioned(conn, table):
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt "
+        "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = :table)"
+    ), {"table": table}).scalar()
+
+def list_partitions(conn, table):
+    return [row[0] for row in conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :table"
+    ), {"table": table})]
+
+def default_partition(conn, table):
+    """Name of the table's DEFAULT partition, or None"""
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT'"
+    ), {"table": table}).scalar()
+
+def create_partition(conn, table, start, interval):
+    """
+    Create the partition for the period starting at `start` (no-op if it exists).
+
+    Postgres refuses to create a partition while the default partition holds
+    rows of its range (left there after a gap in maintenance), so those rows
+    are moved: the default partition is detached, the rows move into the new
+    partition, and it is attached again, all in the caller's transaction.
+    """
+    name = partition_name(table, start, interval)
+    end = next_period(start, interval)
+    if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+        return
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    default = default_partition(conn, table)
+    in_range = {"start": start, "end": end}
+    stranded = default and conn.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {default} WHERE created_at >= :start AND created_at < :end)"
+    ), in_range).scalar()
+    if not stranded:
+        conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+        return
+
+    conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+    conn.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+    moved = conn.execute(text(
+        f"WITH moved AS (DELETE FROM {default} WHERE created_at >= :start AND created_at < :end RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), in_range).rowcount
+    conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+    print(f"🧱 {name}: moved {moved} rows out of {default}")
+
+def ensure_log_partitions(today=None):
+    """Pre-create partitions for the current and next LOG_PARTITIONS_AHEAD periods"""
+    today = today or datetime.utcnow().date()
+    created = {}
+    for table, (interval, _) in LOG_RETENTION.items():
+        try:
+            with engine.begin() as conn:
+                if not is_partitioned(conn, table):
+                    continue
+                existing = set(list_partitions(conn, table))
+                start = period_start(today, interval)
+                created[table] = []
+                for _ in range(LOG_PARTITIONS_AHEAD + 1):
+                    name = partition_name(table, start, interval)
+                    if name not in existing:
+                        create_partition(conn, table, start, interval)
+                        created[table].append(name)
+                    start = next_period(start, interval)
+        except Exception as e:
+            print(f"⚠️ Error creating partitions for {table}: {e}")
+    return created
+
+def prune_logs(now=None):
+    """
+    Remove log rows older than each table's retention.
+    Returns {table: {"dropped": [partition names], "deleted": row count}}.
+    """
+    now = now or datetime.utcnow()
+    report = {}
+    for table, (interval, days) in LOG_RETENTION.items():
+        cutoff = now - timedelta(days=days)
+        dropped, deleted = [], 0
+        try:
+            with engine.begin() as conn:
+                if is_partitioned(conn, table):
+                    for name in list_partitions(conn, table):
+                        start = _partition_start(table, name, interval)
+                        # Only drop partitions whose whole range is past the cutoff
+                        if start and next_period(start, interval) <= cutoff.date():
+                            conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                            dropped.append(name)
+
+            # Unpartitioned table, or stragglers in the default partition
+            while True:
+                with engine.begin() as conn:
+                    # ids come from one sequence, so they are unique across partitions
+                    count = conn.execute(text(
+                        f"DELETE FROM {table} WHERE created_at < :cutoff AND id IN ("
+                        f"SELECT id FROM {table} WHERE created_at < :cutoff LIMIT {_PRUNE_BATCH_SIZE})"
+                    ), {"cutoff": cutoff}).rowcount
+                deleted += count
+                if count < _PRUNE_BATCH_SIZE:
+                    break
+        except Exception as e:
+            print(f"⚠️ Error pruning {table}: {e}")
+        report[table] = {"dropped": dropped, "deleted": deleted}
+    return report
+
+def run_log_maintenance():
+    """Create upcoming partitions, then apply retention"""
+    created = ensure_log_partitions()
+    pruned = prune_logs()
+    for table, result in pruned.items():
+        if created.get(table) or result["dropped"] or result["deleted"]:
+            print(
+                f"🧹 {table}: created {len(created.get(table, []))} partitions, "
+                f"dropped {len(result['dropped'])}, deleted {result['deleted']} rows"
+            )
+    return {"created": created, "pruned": pruned}
+
+# ==================== SCHEDULED JOBS ====================
+
+JOB_RUN_RETENTION_DAYS = int(os.getenv("JOB_RUN_RETENTION_DAYS", "14"))
+
+def record_job_run(job, started_at, duration_ms, status, error=None):
+    """Persist one scheduler run (see scheduler.py)"""
+    from init_database import JobRun
+    try:
+        with engine.begin() as conn:
+            conn.execute(JobRun.__table__.insert().values(
+                job=job, started_at=started_at, duration_ms=duration_ms,
+                status=status, error=(error or None) and error[:2000], worker=str(os.getpid())
+            ))
+        return True
+    except Exception as e:
+        print(f"⚠️ Error recording job run: {e}")
+        return False
+
+def get_job_runs(job=None, limit=50):
+    """Most recent persisted job runs, newest first"""
+    from init_database import JobRun
+    try:
+        with get_db() as db:
+            stmt = select(JobRun).order_by(JobRun.started_at.desc()).limit(min(limit, MAX_PAGE_SIZE))
+            if job:
+                stmt = stmt.where(JobRun.job == job)
+            return [
+                {
+                    "job": run.job,
+                    "started_at": run.started_at.isoformat() + "Z",
+                    "duration_ms": run.duration_ms,
+                    "status": run.status,
+                    "error": run.error,
+                    "worker": run.worker
+                }
+                for run in db.execute(stmt).scalars()
+            ]
+    except Exception as e:
+        print(f"⚠️ Error loading job runs: {e}")
+        return []
+
+def prune_job_runs(days=None):
+    """Delete job runs older than JOB_RUN_RETENTION_DAYS; returns the row count"""
+    from init_database import JobRun
+    cutoff = datetime.utcnow() - timedelta(days=days or JOB_RUN_RETENTION_DAYS)
+    try:
+        with engine.begin() as conn:
+            return conn.execute(JobRun.__table__.delete().where(JobRun.started_at < cutoff)).rowcount
+    except Exception as e:
+        print(f"⚠️ Error pruning job runs: {e}")
+        return 0
+
+def delete_expired_password_resets(grace_hours=24):
+    """Delete reset codes that expired (or were used) more than `grace_hours` ago"""
+    cutoff = datetime.utcnow() - timedelta(hours=grace_hours)
+    resets = PasswordReset.__table__
+    try:
+        with engine.begin() as conn:
+            return conn.execute(resets.delete().where(or_(
+                resets.c.expires_at < cutoff,
+                and_(resets.c.used == True, resets.c.used_at < cutoff)
+            ))).rowcount
+    except Exception as e:
+        print(f"⚠️ Error deleting expired password resets: {e}")
+        return 0
+
+# ==================== OUTBOUND EMAIL QUEUE ====================
+# Emails are written to outbound_emails and sent by email_queue.EmailSender.
+# Senders claim batches with FOR UPDATE SKIP LOCKED, so every worker can run
+# one; a batch left in "sending" by a dead process is picked up again after
+# EMAIL_CLAIM_TIMEOUT seconds.
+
+EMAIL_CLAIM_TIMEOUT = int(os.getenv("EMAIL_CLAIM_TIMEOUT", "300"))
+EMAIL_RETENTION_DAYS = int(os.getenv("EMAIL_RETENTION_DAYS", "30"))
+
+def _outbound_emails():
+    from init_database import OutboundEmail
+    return OutboundEmail.__table__
+
+def enqueue_email(to_email, subject, html_content, dedup_key=None, to_name=None, params=None):
+    """
+    Queue an email. Inside a request the row is written through the request
+    session (transactional outbox): it commits together with the rest of the
+    request, and disappears if the request's changes are rolled back.
+    An email whose dedup_key is already queued or sent is not queued again.
+    Returns {"id": ..., "duplicate": bool}, or None on error.
+    """
+    emails = _outbound_emails()
+    now = datetime.utcnow()
+    try:
+        with get_db() as db:
+            stmt = pg_insert(emails).values(
+                dedup_key=dedup_key, to_email=to_email, to_name=to_name, subject=subject,
+                html_content=html_content, params=params, status="pending", attempts=0,
+                next_attempt_at=now, created_at=now
+            )
+            if dedup_key:
+                stmt = stmt.on_conflict_do_nothing(index_elements=[emails.c.dedup_key])
+            email_id = db.execute(stmt.returning(emails.c.id)).scalar()
+            if email_id is not None:
+                return {"id": email_id, "duplicate": False}
+            existing = db.execute(select(emails.c.id).where(emails.c.dedup_key == dedup_key)).scalar()
+            return {"id": existing, "duplicate": True}
+    except Exception as e:
+        print(f"⚠️ Error queueing email to {to_email}: {e}")
+        return None
+
+def claim_outbound_emails(limit=100):
+    """Claim up to `limit` due emails for sending (marks them "sending", counts the attempt)"""
+    emails = _outbound_emails()
+    now = datetime.utcnow()
+    due = (
+        select(emails.c.id)
+        .where(or_(
+            and_(emails.c.status == "pending", emails.c.next_attempt_at <= now),
+            and_(emails.c.status == "sending", emails.c.claimed_at < now - timedelta(seconds=EMAIL_CLAIM_TIMEOUT))
+        ))
+        .order_by(emails.c.next_attempt_at, emails.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    try:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                emails.update()
+                .where(emails.c.id.in_(due.scalar_subquery()))
+                .values(status="sending", claimed_at=now, attempts=emails.c.attempts + 1)
+                .returning(*emails.c)
+            ).all()
+            return [dict(row._mapping) for row in sorted(rows, key=lambda r: r.id)]
+    except Exception as e:
+        print(f"⚠️ Error claiming outbound emails: {e}")
+        return []
+
+def mark_emails_sent(message_ids):
+    """Record successful sends: {email_id: brevo message id}"""
+    if not message_ids:
+        return True
+    emails = _outbound_emails()
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                emails.update()
+                .where(emails.c.id == bindparam("b_id"))
+                .values(status="sent", sent_at=datetime.utcnow(), message_id=bindparam("b_message_id"), last_error=None),
+                [{"b_id": email_id, "b_message_id": message_id} for email_id, message_id in message_ids.items()]
+            )
+        return True
+    except Exception as e:
+        print(f"⚠️ Error marking emails sent: {e}")
+        return False
+
+def mark_emails_failed(failures):
+    """
+    Record failed sends: (email_id, error, retry_at) tuples. retry_at=None
+    marks the email as permanently failed.
+    """
+    if not failures:
+        return True
+    emails = _outbound_emails()
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                emails.update()
+                .where(emails.c.id == bindparam("b_id"))
+                .values(status=bindparam("b_status"), last_error=bindparam("b_error"), next_attempt_at=bindparam("b_retry_at")),
+                [
+                    {
+                        "b_id": email_id,
+                        "b_status": "pending" if retry_at else "failed",
+                        "b_error": (error or "")[:2000],
+                        "b_retry_at": retry_at
+                    }
+                    for email_id, error, retry_at in failures
+                ]
+            )
+        return True
+    except Exception as e:
+        print(f"⚠️ Error marking emails failed: {e}")
+        return False
+
+def get_email_queue_stats():
+    """Email counts by status and the age of the oldest pending one"""
+    emails = _outbound_emails()
+    try:
+        with get_db() as db:
+            counts = dict(db.execute(select(emails.c.status, func.count()).group_by(emails.c.status)).all())
+            oldest = db.execute(select(func.min(emails.c.created_at)).where(emails.c.status == "pending")).scalar()
+            return {
+                "counts": counts,
+                "oldest_pending": oldest.isoformat() + "Z" if oldest else None
+            }
+    except Exception as e:
+        print(f"⚠️ Error getting email queue stats: {e}")
+        return None
+
+def prune_outbound_emails(days=None):
+    """Delete sent and failed emails older than EMAIL_RETENTION_DAYS; returns the row count"""
+    emails = _outbound_emails()
+    cutoff = datetime.utcnow() - timedelta(days=days or EMAIL_RETENTION_DAYS)
+    try:
+        with engine.begin() as conn:
+            return conn.execute(
+                emails.delete().where(emails.c.status.in_(["sent", "failed"]), emails.c.created_at < cutoff)
+            ).rowcount
+    except Exception as e:
+        print(f"⚠️ Error pruning outbound emails: {e}")
+        return 0
+
 # ==================== PLAYER ID & NICKNAME TRACKING ====================
 
 def get_user_by_player_id(player_id: str):
     """Get user by player_id"""
     try:
         with get_db() as db:
-            user = db.query(User).filter(User.player_id == player_id).first()
-            if not user:
+            row = db.execute(_SELECT_LICENSE_BY_PLAYER_ID, {"player_id": player_id}).first()
+            if not row:
                 return None
-            return {
-                "username": user.username,
-                "player_id": user.player_id,
-                "expires": user.expires,
-                "paused": user.paused,
-                "paused_at": user.paused_at,
-                "remaining_days": user.remaining_days,
-                "last_nickname": user.last_nickname,
-                "first_connection_date": user.first_connection_date
-            }
+            return _license_from_row(row)
     except OperationalError as e:
         print(f"⚠️ DB connection error in get_user_by_player_id: {e}")
         return None
@@ -707,13 +1710,14 @@ def update_user_player_id(username: str, player_id: str):
     """Update user's player_id on first connection"""
     try:
         with get_db() as db:
-            from datetime import datetime
             user = db.query(User).filter(User.username == username).first()
             if not user:
                 return False
             user.player_id = player_id
             if not user.first_connection_date:
-                user.first_connection_date = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                now = datetime.utcnow().replace(microsecond=0)
+                user.first_connection_date = now.strftime("%Y-%m-%d %H:%M:%S")
+                user.first_connected_at = now
             return True
     except OperationalError as e:
         print(f"⚠️ DB connection error in update_user_player_id: {e}")
@@ -772,53 +1776,187 @@ def set_custom_message(message: str):
 
 # ==================== GEM ACCOUNT FUNCTIONS ====================
 
-def get_all_gem_accounts():
-    """Get all gem accounts"""
+_GEM_ACCOUNT_COLUMNS = (
+    "id", "account_number", "email", "current_nickname", "gems_remaining", "is_active", "last_used"
+)
+
+def _gem_accounts():
+    from init_database import GemAccount
+    return GemAccount.__table__
+
+def get_all_gem_accounts(include_passwords=False):
+    """
+    Get all gem accounts. Passwords are left out unless `include_passwords`
+    (only the code that logs into an account needs one).
+    """
     try:
         with get_db() as db:
-            from init_database import GemAccount
-            accounts = db.query(GemAccount).order_by(GemAccount.account_number).all()
-            return [
-                {
-                    'id': acc.id,
-                    'account_number': acc.account_number,
-                    'email': acc.email,
-                    'password': acc.password,
-                    'current_nickname': acc.current_nickname,
-                    'gems_remaining': acc.gems_remaining,
-                    'is_active': acc.is_active,
-                    'last_used': acc.last_used
-                }
-                for acc in accounts
-            ]
+            accounts = _gem_accounts()
+            columns = list(_GEM_ACCOUNT_COLUMNS) + (["password"] if include_passwords else [])
+            stmt = select(*(accounts.c[name] for name in columns)).order_by(accounts.c.account_number)
+            return [dict(row._mapping) for row in db.execute(stmt)]
     except Exception as e:
         print(f"⚠️ Error getting gem accounts: {e}")
         return []
 
-def add_gem_account(account_number, email, password):
-    """Add a new gem account"""
-    try:
-        with get_db() as db:
-            from init_database import GemAccount
-            
-            existing = db.query(GemAccount).filter_by(email=email).first()
-            if existing:
-                return False
-            
-            new_account = GemAccount(
-                account_number=account_number,
-                email=email,
-                password=password,
-                current_nickname=f"bugsbot{account_number}",
-                gems_remaining=5000,
-                is_active=True
-            )
-            
-            db.add(new_account)
-            return True
+DEFAULT_ACCOUNT_GEMS = 5000
+
+def import_gem_accounts(rows, update_existing=False):
+    """
+    Insert gem accounts in one INSERT ... ON CONFLICT (email) statement.
+
+    `rows` are dicts with account_number, email, password and optionally
+    current_nickname and gems_remaining (as read from a CSV; a missing or
+    empty gems_remaining gets DEFAULT_ACCOUNT_GEMS). Emails match
+    case-insensitively: new ones are stored lowercased, existing ones keep
+    their spelling. Existing emails are left alone, or get their
+    number/password/nickname overwritten with `update_existing`. Returns one report entry per input row:
+        {"row": 1, "email": "...", "status": "created" | "updated" | "exists" | "invalid",
+         "id": 12, "error": "..."}
+    or None on a database error.
+    """
+    report = []
+    values = {}  # lower(email) -> row to write (first occurrence wins)
+    for number, raw in enumerate(rows, start=1):
+        entry = {"row": number, "email": str(raw.get("email") or "").strip()}
+        report.append(entry)
+        try:
+            account_number = int(raw.get("account_number"))
+            gems = raw.get("gems_remaining")
+            gems = DEFAULT_ACCOUNT_GEMS if gems is None or gems == "" else int(gems)
+        except (TypeError, ValueError):
+            entry.update(status="invalid", error="account_number and gems_remaining must be integers")
+            continue
+        password = str(raw.get("password") or "").strip()
+        if "@" not in entry["email"] or not password:
+            entry.update(status="invalid", error="email and password are required")
+            continue
+        if gems < 0:
+            entry.update(status="invalid", error="gems_remaining must be >= 0")
+            continue
+        key = entry["email"].lower()
+        if key in values:
+            entry.update(status="invalid", error="duplicate email in this import")
+            continue
+        values[key] = {
+            "account_number": account_number,
+            "email": key,
+            "password": password,
+            "current_nickname": str(raw.get("current_nickname") or "").strip() or f"bugsbot{account_number}",
+            "gems_remaining": gems,
+            "is_active": True
+        }
+
+    written = {}
+    if values:
+        try:
+            with get_db() as db:
+                accounts = _gem_accounts()
+                # ON CONFLICT (email) is case-sensitive: write rows whose
+                # email already exists under the stored spelling
+                stored = dict(db.execute(
+                    select(func.lower(accounts.c.email), accounts.c.email)
+                    .where(func.lower(accounts.c.email).in_(list(values)))
+                ).all())
+                for key, value in values.items():
+                    value["email"] = stored.get(key, key)
+                stmt = pg_insert(accounts).values(list(values.values()))
+                if update_existing:
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[accounts.c.email],
+                        set_={
+                            "account_number": stmt.excluded.account_number,
+                            "password": stmt.excluded.password,
+                            "current_nickname": stmt.excluded.current_nickname
+                        }
+                    )
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=[accounts.c.email])
+                # xmax is 0 for a freshly inserted row version, non-zero for an updated one
+                stmt = stmt.returning(accounts.c.id, accounts.c.email, literal_column("xmax = 0").label("inserted"))
+                for row in db.execute(stmt):
+                    written[row.email.lower()] = (row.id, "created" if row.inserted else "updated")
+        except Exception as e:
+            print(f"⚠️ Error importing gem accounts: {e}")
+            return None
+
+    for entry in report:
+        if "status" not in entry:
+            account_id, status = written.get(entry["email"].lower(), (None, "exists"))
+            entry.update(status=status, id=account_id)
+    return report
+
+def add_gem_account(account_number, email, password):
+    """Add a new gem account (False if the email is already registered)"""
+    report = import_gem_accounts([{"account_number": account_number, "email": email, "password": password}])
+    return bool(report) and report[0]["status"] == "created"
+
+def _gem_account_selection(ids=None, active=None, below=None):
+    """
+    WHERE clauses selecting accounts by id list and/or filter
+    (is_active == active, gems_remaining < below). Raises ValueError when
+    nothing is given, so a bulk call never touches every account by accident.
+    """
+    accounts = _gem_accounts()
+    clauses = []
+    if ids is not None:
+        clauses.append(accounts.c.id.in_(list(ids)))
+    if active is not None:
+        clauses.append(accounts.c.is_active == bool(active))
+    if below is not None:
+        clauses.append(accounts.c.gems_remaining < int(below))
+    if not clauses:
+        raise ValueError("account ids or a filter are required")
+    return clauses
+
+def _bulk_update_gem_accounts(values, field, ids=None, active=None, below=None):
+    """
+    Apply `values` to the selected accounts in one UPDATE ... FROM that
+    returns each row's previous and new `field`. Returns
+        {"updated": n, "results": [{"id", "status": "updated", "previous", field}, ...]}
+    plus a "not_found" entry per requested id that matched nothing, or None
+    on a database error.
+    """
+    clauses = _gem_account_selection(ids, active, below)
+    accounts = _gem_accounts()
+    old = accounts.alias("old")  # the pre-update row version
+    try:
+        with get_db() as db:
+            rows = db.execute(
+                accounts.update()
+                .where(accounts.c.id == old.c.id, *clauses)
+                .values(**values)
+                .returning(accounts.c.id, old.c[field].label("previous"), accounts.c[field].label("current"))
+            ).all()
     except Exception as e:
-        print(f"⚠️ Error adding gem account: {e}")
-        return False
+        print(f"⚠️ Error updating gem accounts ({field}): {e}")
+        return None
+
+    results = [
+        {"id": row.id, "status": "updated", "previous": row.previous, field: row.current}
+        for row in sorted(rows, key=lambda r: r.id)
+    ]
+    found = {row.id for row in rows}
+    results.extend({"id": i, "status": "not_found"} for i in (ids or []) if i not in found)
+    return {"updated": len(rows), "results": results}
+
+def recharge_gem_accounts(gems_amount=DEFAULT_ACCOUNT_GEMS, ids=None, active=None, below=None):
+    """Set gems_remaining on the accounts selected by id and/or filter"""
+    return _bulk_update_gem_accounts({"gems_remaining": gems_amount}, "gems_remaining", ids, active, below)
+
+def set_gem_accounts_active(is_active, ids=None, active=None, below=None):
+    """Enable or disable the accounts selected by id and/or filter"""
+    return _bulk_update_gem_accounts({"is_active": bool(is_active)}, "is_active", ids, active, below)
+
+def delete_gem_accounts(ids):
+    """Delete accounts by id; returns the number deleted, or None on error"""
+    try:
+        with get_db() as db:
+            accounts = _gem_accounts()
+            return db.execute(accounts.delete().where(accounts.c.id.in_(list(ids)))).rowcount
+    except Exception as e:
+        print(f"⚠️ Error deleting gem accounts: {e}")
+        return None
 
 def update_gem_account_nickname(account_id, new_nickname):
     """Update account's current nickname"""
@@ -837,43 +1975,94 @@ def update_gem_account_nickname(account_id, new_nickname):
         return False
 
 def deduct_account_gems(account_id, gems_spent):
-    """Deduct gems from account"""
+    """Deduct gems from account; False if it doesn't have enough (checked atomically)"""
     try:
         with get_db() as db:
-            from init_database import GemAccount
-            from datetime import datetime
-
-            account = db.query(GemAccount).filter_by(id=account_id).first()
-            if not account:
-                return False
-
-            if account.gems_remaining < gems_spent:
-                return False
-
-            account.gems_remaining -= gems_spent
-            account.last_used = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-
-            return True
+            accounts = _gem_accounts()
+            deducted = db.execute(
+                accounts.update()
+                .where(accounts.c.id == account_id, accounts.c.gems_remaining >= gems_spent)
+                .values(
+                    gems_remaining=accounts.c.gems_remaining - gems_spent,
+                    last_used=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                )
+            ).rowcount
+            return deducted == 1
     except Exception as e:
         print(f"⚠️ Error deducting gems: {e}")
         return False
 
+@contextmanager
+def reserve_gems(gems, include_password=False):
+    """
+    Reserve `gems` on the best-fit active account for the duration of the block.
+
+    The account with the fewest remaining gems that still covers the amount
+    (least recently used first) is picked with FOR UPDATE SKIP LOCKED and
+    debited by a single conditional UPDATE ... RETURNING, in a transaction of
+    its own. The transaction stays open while the block runs: if the block
+    returns, the debit is committed; if it raises (the upstream gift failed),
+    it is rolled back and the exception propagates. Concurrent reservations
+    skip the locked account and get another one.
+
+    Yields the reserved account as a dict (without the password unless
+    `include_password`), or None when no active account has enough gems.
+    Database errors propagate.
+
+        with db_helper.reserve_gems(450, include_password=True) as account:
+            if account is None:
+                ...  # out of gems
+            send_gift(account, ...)  # raise on failure to release the gems
+    """
+    accounts = _gem_accounts()
+    columns = list(_GEM_ACCOUNT_COLUMNS) + (["password"] if include_password else [])
+    target = (
+        select(accounts.c.id)
+        .where(accounts.c.is_active == True, accounts.c.gems_remaining >= gems)
+        .order_by(accounts.c.gems_remaining, accounts.c.last_used.asc().nulls_first(), accounts.c.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    with engine.begin() as conn:
+        row = conn.execute(
+            accounts.update()
+            .where(accounts.c.id == target, accounts.c.gems_remaining >= gems)
+            .values(
+                gems_remaining=accounts.c.gems_remaining - gems,
+                last_used=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            )
+            .returning(*(accounts.c[name] for name in columns))
+        ).first()
+        yield dict(row._mapping) if row else None
+
+def get_gem_accounts_stats():
+    """Account counts and gem totals for the dashboard"""
+    try:
+        with get_db() as db:
+            accounts = _gem_accounts()
+            active = accounts.c.is_active == True
+            row = db.execute(select(
+                func.count(),
+                func.count().filter(active),
+                func.coalesce(func.sum(accounts.c.gems_remaining).filter(active), 0),
+                func.coalesce(func.max(accounts.c.gems_remaining).filter(active), 0)
+            )).first()
+            return {
+                "total_accounts": row[0],
+                "active_accounts": row[1],
+                "total_gems": int(row[2]),
+                "max_reservable": int(row[3])
+            }
+    except Exception as e:
+        print(f"⚠️ Error getting gem account stats: {e}")
+        return {"total_accounts": 0, "active_accounts": 0, "total_gems": 0, "max_reservable": 0}
+
 
-def recharge_account_gems(account_id, gems_amount=5000):
+def recharge_account_gems(account_id, gems_amount=DEFAULT_ACCOUNT_GEMS):
     """Recharge account gems"""
-    try:
-        with get_db() as db:
-            from init_database import GemAccount
-            
-            account = db.query(GemAccount).filter_by(id=account_id).first()
-            if not account:
-                return False
-            
-            account.gems_remaining = gems_amount
-            return True
-    except Exception as e:
-        print(f"⚠️ Error recharging gems: {e}")
-        return False
+    result = recharge_gem_accounts(gems_amount, ids=[account_id])
+    return bool(result and result["updated"])
 
 # ==================== STATS SUMMARY ====================
 
@@ -976,148 +2165,157 @@ def update_user_bot_version(username: str, bot_version: str):
         print(f"⚠️ Error updating user bot version: {e}")
         return False
 
-def save_shop_bundles(bundles_list):
-    """Save/update shop bundles"""
-    try:
-        with get_db() as db:
-            from init_database import ShopBundle
-            from datetime import datetime
-            
-            # Clear existing bundles
-            db.query(ShopBundle).delete()
-            
-            # Add new bundles
-            for bundle in bundles_list:
-                new_bundle = ShopBundle(
-                    type=bundle['type'],
-                    cost=bundle['cost'],
-                    price=str(bundle['price']),
-                    name=bundle['name'],
-                    image=bundle.get('image'),
-                    is_new=bundle.get('isNew', False),
-                    new_since=bundle.get('newSince'),
-                    updated_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                )
-                db.add(new_bundle)
-            
-            return True
+# ==================== SHOP SYNC ====================
+# Shop syncs are diffed against the stored catalog: every item is matched by
+# its natural key, compared through a hash of its synced fields, and only
+# the inserts/updates/deletes are written (one bulk statement each).
+
+def _shop_bundle_row(bundle):
+    return {
+        "type": bundle['type'],
+        "cost": bundle['cost'],
+        "price": float(bundle['price']),
+        "name": bundle['name'],
+        "image": bundle.get('image'),
+        "is_new": bundle.get('isNew', False),
+        "new_since": bundle.get('newSince')
+    }
+
+def _shop_skin_set_row(skin_set):
+    return {
+        "type": skin_set['type'],
+        "cost": skin_set['cost'],
+        "price": float(skin_set['price']),
+        "name": skin_set['name'],
+        "expire_date": skin_set.get('expireDate'),
+        "item_sets": skin_set.get('itemSets', [])
+    }
+
+def _shop_daily_skin_row(skin):
+    return {
+        "type": skin['type'],
+        "cost": skin['cost'],
+        "price": float(skin['price']),
+        "name": skin['name'],
+        "image_name": skin.get('imageName'),
+        "image_color": skin.get('imageColor'),
+        "expire_date": skin.get('expireDate'),
+        "avatar_item_ids": skin.get('avatarItemIds', [])
+    }
+
+def _shop_calendar_row(calendar):
+    return {
+        "calendar_id": calendar['id'],
+        "title": calendar['title'],
+        "cost": calendar['cost'],
+        "price": float(calendar['price']),
+        "description": calendar.get('description'),
+        "image_name": calendar.get('imageName'),
+        "icon_name": calendar.get('iconName'),
+        "duration_in_days": calendar.get('durationInDays'),
+        "owned": calendar.get('owned', False)
+    }
+
+def _shop_specs():
+    """section -> (table, natural key columns, row builder)"""
+    from init_database import ShopBundle, ShopSkinSet, ShopDailySkin, ShopCalendar
+    return {
+        "bundles": (ShopBundle.__table__, ("type", "name"), _shop_bundle_row),
+        "skin_sets": (ShopSkinSet.__table__, ("type", "name"), _shop_skin_set_row),
+        "daily_skins": (ShopDailySkin.__table__, ("type", "name"), _shop_daily_skin_row),
+        "calendars": (ShopCalendar.__table__, ("calendar_id",), _shop_calendar_row),
+    }
+
+def _content_hash(row):
+    return hashlib.sha256(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
+
+def _sync_shop_section(db, table, key_columns, build_row, items, timestamp):
+    """
+    Diff `items` against `table` and apply the changes.
+    Items sharing a natural key are matched in order (n-th incoming to n-th stored).
+    Returns {"inserted": [...], "updated": [...], "deleted": [...], "unchanged": n}
+    with the natural keys of the affected items.
+    """
+    current = defaultdict(list)  # natural key -> [(id, content_hash)] in id order
+    stmt = select(table.c.id, table.c.content_hash, *(table.c[k] for k in key_columns)).order_by(table.c.id)
+    for row in db.execute(stmt):
+        current[tuple(row[2:])].append((row[0], row[1]))
+
+    inserts, updates = [], []
+    changes = {"inserted": [], "updated": [], "deleted": [], "unchanged": 0}
+    for item in items:
+        row = build_row(item)
+        key = tuple(row[k] for k in key_columns)
+        digest = _content_hash(row)
+        label = " / ".join(str(part) for part in key)
+        if current[key]:
+            row_id, stored_hash = current[key].pop(0)
+            if stored_hash == digest:
+                changes["unchanged"] += 1
+                continue
+            updates.append(dict({f"b_{k}": v for k, v in row.items()}, b_id=row_id, b_content_hash=digest))
+            changes["updated"].append(label)
+        else:
+            inserts.append(dict(row, content_hash=digest, updated_at=timestamp))
+            changes["inserted"].append(label)
+
+    stale = []
+    for key, leftovers in current.items():
+        for row_id, _ in leftovers:
+            stale.append(row_id)
+            changes["deleted"].append(" / ".join(str(part) for part in key))
+
+    if inserts:
+        db.execute(table.insert(), inserts)
+    if updates:
+        values = {c[2:]: bindparam(c) for c in updates[0] if c != "b_id"}
+        values["updated_at"] = timestamp
+        db.execute(table.update().where(table.c.id == bindparam("b_id")).values(values), updates)
+    if stale:
+        db.execute(table.delete().where(table.c.id.in_(stale)))
+    return changes
+
+def _touch_shop_metadata(db, timestamp):
+    from init_database import ShopMetadata
+    metadata = db.query(ShopMetadata).filter_by(id=1).first()
+    if metadata:
+        metadata.last_updated = timestamp
+    else:
+        db.add(ShopMetadata(id=1, last_updated=timestamp))
+
+def _save_shop_section(section, items):
+    try:
+        with get_db() as db:
+            table, key_columns, build_row = _shop_specs()[section]
+            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            return _sync_shop_section(db, table, key_columns, build_row, items, timestamp)
     except Exception as e:
-        print(f"⚠️ Error saving shop bundles: {e}")
+        print(f"⚠️ Error saving shop {section}: {e}")
         import traceback
         traceback.print_exc()
-        return False
+        return None
+
+def save_shop_bundles(bundles_list):
+    """Sync shop bundles; returns the change set or None"""
+    return _save_shop_section("bundles", bundles_list)
 
 def save_shop_skin_sets(skin_sets_list):
-    """Save/update shop skin sets"""
-    try:
-        with get_db() as db:
-            from init_database import ShopSkinSet
-            from datetime import datetime
-            
-            # Clear existing skin sets
-            db.query(ShopSkinSet).delete()
-            
-            # Add new skin sets
-            for skin_set in skin_sets_list:
-                new_skin_set = ShopSkinSet(
-                    type=skin_set['type'],
-                    cost=skin_set['cost'],
-                    price=str(skin_set['price']),
-                    name=skin_set['name'],
-                    expire_date=skin_set.get('expireDate'),
-                    item_sets=skin_set.get('itemSets', []),
-                    updated_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                )
-                db.add(new_skin_set)
-            
-            return True
-    except Exception as e:
-        print(f"⚠️ Error saving shop skin sets: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+    """Sync shop skin sets; returns the change set or None"""
+    return _save_shop_section("skin_sets", skin_sets_list)
 
 def save_shop_daily_skins(daily_skins_list):
-    """Save/update shop daily skins"""
-    try:
-        with get_db() as db:
-            from init_database import ShopDailySkin
-            from datetime import datetime
-            
-            # Clear existing daily skins
-            db.query(ShopDailySkin).delete()
-            
-            # Add new daily skins
-            for skin in daily_skins_list:
-                new_skin = ShopDailySkin(
-                    type=skin['type'],
-                    cost=skin['cost'],
-                    price=str(skin['price']),
-                    name=skin['name'],
-                    image_name=skin.get('imageName'),
-                    image_color=skin.get('imageColor'),
-                    expire_date=skin.get('expireDate'),
-                    avatar_item_ids=skin.get('avatarItemIds', []),
-                    updated_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                )
-                db.add(new_skin)
-            
-            return True
-    except Exception as e:
-        print(f"⚠️ Error saving shop daily skins: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+    """Sync shop daily skins; returns the change set or None"""
+    return _save_shop_section("daily_skins", daily_skins_list)
 
 def save_shop_calendars(calendars_list):
-    """Save/update shop calendars"""
-    try:
-        with get_db() as db:
-            from init_database import ShopCalendar
-            from datetime import datetime
-            
-            # Clear existing calendars
-            db.query(ShopCalendar).delete()
-            
-            # Add new calendars
-            for calendar in calendars_list:
-                new_calendar = ShopCalendar(
-                    calendar_id=calendar['id'],
-                    title=calendar['title'],
-                    cost=calendar['cost'],
-                    price=str(calendar['price']),
-                    description=calendar.get('description'),
-                    image_name=calendar.get('imageName'),
-                    icon_name=calendar.get('iconName'),
-                    duration_in_days=calendar.get('durationInDays'),
-                    owned=calendar.get('owned', False),
-                    updated_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                )
-                db.add(new_calendar)
-            
-            return True
-    except Exception as e:
-        print(f"⚠️ Error saving shop calendars: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+    """Sync shop calendars; returns the change set or None"""
+    return _save_shop_section("calendars", calendars_list)
 
 def update_shop_metadata():
     """Update last shop sync timestamp"""
     try:
         with get_db() as db:
-            from init_database import ShopMetadata
-            from datetime import datetime
-            
-            metadata = db.query(ShopMetadata).filter_by(id=1).first()
-            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            
-            if metadata:
-                metadata.last_updated = timestamp
-            else:
-                new_metadata = ShopMetadata(id=1, last_updated=timestamp)
-                db.add(new_metadata)
-            
+            _touch_shop_metadata(db, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
             return True
     except Exception as e:
         print(f"⚠️ Error updating shop metadata: {e}")
@@ -1126,174 +2324,186 @@ def update_shop_metadata():
 
 def save_all_shop_data(bundles, skin_sets, daily_skins, calendars):
     """
-    Save ALL shop data in a SINGLE transaction to avoid connection pool issues.
-    This is much more efficient and reliable than separate saves.
+    Sync ALL shop data in a SINGLE transaction, writing only what changed.
+
+    Returns the change set, e.g.
+        {"bundles": {"inserted": ["event / Halloween"], "updated": [], "deleted": [], "unchanged": 11},
+         ..., "changed": True}
+    ("inserted" bundles are the new items to announce), or None on error.
     """
     try:
         with get_db() as db:
-            from init_database import ShopBundle, ShopSkinSet, ShopDailySkin, ShopCalendar, ShopMetadata
-            from datetime import datetime
-            
             timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            
-            print("🗑️  Clearing old shop data...")
-            # Clear all existing data first
-            db.query(ShopBundle).delete()
-            db.query(ShopSkinSet).delete()
-            db.query(ShopDailySkin).delete()
-            db.query(ShopCalendar).delete()
-            
-            print(f"💾 Saving {len(bundles)} bundles...")
-            # Batch insert bundles
-            for bundle in bundles:
-                db.add(ShopBundle(
-                    type=bundle['type'],
-                    cost=bundle['cost'],
-                    price=float(bundle['price']),  # ← CHANGED to float
-                    name=bundle['name'],
-                    image=bundle.get('image'),
-                    is_new=bundle.get('isNew', False),
-                    new_since=bundle.get('newSince'),
-                    updated_at=timestamp
-                ))
-            
-            print(f"💾 Saving {len(skin_sets)} skin sets...")
-            # Batch insert skin sets
-            for skin_set in skin_sets:
-                db.add(ShopSkinSet(
-                    type=skin_set['type'],
-                    cost=skin_set['cost'],
-                    price=float(skin_set['price']),  # ← CHANGED to float
-                    name=skin_set['name'],
-                    expire_date=skin_set.get('expireDate'),
-                    item_sets=skin_set.get('itemSets', []),
-                    updated_at=timestamp
-                ))
-            
-            print(f"💾 Saving {len(daily_skins)} daily skins...")
-            # Batch insert daily skins
-            for skin in daily_skins:
-                db.add(ShopDailySkin(
-                    type=skin['type'],
-                    cost=skin['cost'],
-                    price=float(skin['price']),  # ← CHANGED to float
-                    name=skin['name'],
-                    image_name=skin.get('imageName'),
-                    image_color=skin.get('imageColor'),
-                    expire_date=skin.get('expireDate'),
-                    avatar_item_ids=skin.get('avatarItemIds', []),
-                    updated_at=timestamp
-                ))
-            
-            print(f"💾 Saving {len(calendars)} calendars...")
-            # Batch insert calendars
-            for calendar in calendars:
-                db.add(ShopCalendar(
-                    calendar_id=calendar['id'],
-                    title=calendar['title'],
-                    cost=calendar['cost'],
-                    price=float(calendar['price']),  # ← CHANGED to float
-                    description=calendar.get('description'),
-                    image_name=calendar.get('imageName'),
-                    icon_name=calendar.get('iconName'),
-                    duration_in_days=calendar.get('durationInDays'),
-                    owned=calendar.get('owned', False),
-                    updated_at=timestamp
-                ))
-            
-            # Update metadata
-            print("📝 Updating metadata...")
-            metadata = db.query(ShopMetadata).filter_by(id=1).first()
-            if metadata:
-                metadata.last_updated = timestamp
-            else:
-                db.add(ShopMetadata(id=1, last_updated=timestamp))
-            
-            # Flush and commit happens automatically when exiting context
-            print("✅ All shop data saved successfully in single transaction!")
-            return True
+            incoming = {
+                "bundles": bundles,
+                "skin_sets": skin_sets,
+                "daily_skins": daily_skins,
+                "calendars": calendars
+            }
+
+            result = {}
+            for section, (table, key_columns, build_row) in _shop_specs().items():
+                changes = _sync_shop_section(db, table, key_columns, build_row, incoming[section], timestamp)
+                result[section] = changes
+                print(
+                    f"💾 {section}: +{len(changes['inserted'])} ~{len(changes['updated'])} "
+                    f"-{len(changes['deleted'])} ={changes['unchanged']}"
+                )
+            result["changed"] = any(
+                result[section][kind]
+                for section in incoming
+                for kind in ("inserted", "updated", "deleted")
+            )
+
+            _touch_shop_metadata(db, timestamp)
+            if result["changed"] or not db.execute(_select_shop_etag()).scalar():
+                result["etag"] = _store_shop_snapshot(db)
+                print(f"📦 Shop snapshot rebuilt (etag {result['etag']})")
+            print("✅ Shop sync applied in a single transaction")
+            return result
             
     except Exception as e:
         print(f"❌ Error saving shop data: {e}")
         import traceback
         traceback.print_exc()
-        return False
+        return None
 
 
-def get_shop_data():
+def _build_shop_catalog(db):
+    """The full catalog as served to clients"""
+    from init_database import ShopBundle, ShopSkinSet, ShopDailySkin, ShopCalendar, ShopMetadata
+    
+    bundles = db.query(ShopBundle).order_by(ShopBundle.id).all()
+    skin_sets = db.query(ShopSkinSet).order_by(ShopSkinSet.id).all()
+    daily_skins = db.query(ShopDailySkin).order_by(ShopDailySkin.id).all()
+    calendars = db.query(ShopCalendar).order_by(ShopCalendar.id).all()
+    metadata = db.query(ShopMetadata).filter_by(id=1).first()
+    
+    return {
+        'bundles': [
+            {
+                'type': b.type,
+                'cost': b.cost,
+                'price': float(b.price),
+                'name': b.name,
+                'image': b.image,
+                'isNew': b.is_new,
+                'newSince': b.new_since
+            }
+            for b in bundles
+        ],
+        'skin_sets': [
+            {
+                'type': s.type,
+                'cost': s.cost,
+                'price': float(s.price),
+                'name': s.name,
+                'expireDate': s.expire_date,
+                'itemSets': s.item_sets or []
+            }
+            for s in skin_sets
+        ],
+        'daily_skins': [
+            {
+                'type': d.type,
+                'cost': d.cost,
+                'price': float(d.price),
+                'name': d.name,
+                'imageName': d.image_name,
+                'imageColor': d.image_color,
+                'expireDate': d.expire_date,
+                'avatarItemIds': d.avatar_item_ids or []
+            }
+            for d in daily_skins
+        ],
+        'calendars': [
+            {
+                'id': c.calendar_id,
+                'title': c.title,
+                'cost': c.cost,
+                'price': float(c.price),
+                'description': c.description,
+                'imageName': c.image_name,
+                'iconName': c.icon_name,
+                'durationInDays': c.duration_in_days,
+                'owned': c.owned
+            }
+            for c in calendars
+        ],
+        'last_updated': metadata.last_updated if metadata else None
+    }
+
+# ==================== SHOP SNAPSHOT ====================
+# The catalog only changes on sync, so it is serialized (and gzipped) once
+# per change and stored on shop_metadata with a content hash used as ETag.
+# Workers keep the bytes in memory and only re-check the ETag column every
+# SHOP_SNAPSHOT_RECHECK seconds.
+
+SHOP_SNAPSHOT_RECHECK = int(os.getenv("SHOP_SNAPSHOT_RECHECK", "10"))
+
+# Published as a whole: a reader holding one snapshot always sees an ETag
+# and bodies that belong together, even while another thread refreshes it
+ShopSnapshot = namedtuple("ShopSnapshot", "etag json gzip checked")
+_shop_snapshot = None
+_shop_snapshot_lock = threading.Lock()
+
+def _select_shop_etag():
+    from init_database import ShopMetadata
+    return select(ShopMetadata.snapshot_etag).where(ShopMetadata.id == 1)
+
+def _store_shop_snapshot(db):
+    """Serialize the current catalog onto shop_metadata; returns the new ETag"""
+    from init_database import ShopMetadata
+    body = json.dumps(_build_shop_catalog(db), separators=(",", ":"), sort_keys=True).encode()
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    metadata = db.query(ShopMetadata).filter_by(id=1).first()
+    if not metadata:
+        metadata = ShopMetadata(id=1)
+        db.add(metadata)
+    metadata.snapshot_json = body
+    metadata.snapshot_gzip = gzip.compress(body, compresslevel=9, mtime=0)
+    metadata.snapshot_etag = etag
+    return etag
+
+def get_shop_snapshot():
     """
-    Get all shop data from database in a SINGLE query session.
-    More efficient than multiple separate queries.
+    The serialized catalog as a ShopSnapshot (etag, json bytes, gzip bytes),
+    or None on error. Built on first use if no sync has stored one yet.
     """
-    try:
-        with get_db() as db:
-            from init_database import ShopBundle, ShopSkinSet, ShopDailySkin, ShopCalendar, ShopMetadata
-            
-            # Single session for all queries
-            bundles = db.query(ShopBundle).all()
-            skin_sets = db.query(ShopSkinSet).all()
-            daily_skins = db.query(ShopDailySkin).all()
-            calendars = db.query(ShopCalendar).all()
-            metadata = db.query(ShopMetadata).filter_by(id=1).first()
-            
-            return {
-                'bundles': [
-                    {
-                        'type': b.type,
-                        'cost': b.cost,
-                        'price': float(b.price),
-                        'name': b.name,
-                        'image': b.image,
-                        'isNew': b.is_new,
-                        'newSince': b.new_since
-                    }
-                    for b in bundles
-                ],
-                'skin_sets': [
-                    {
-                        'type': s.type,
-                        'cost': s.cost,
-                        'price': float(s.price),
-                        'name': s.name,
-                        'expireDate': s.expire_date,
-                        'itemSets': s.item_sets or []
-                    }
-                    for s in skin_sets
-                ],
-                'daily_skins': [
-                    {
-                        'type': d.type,
-                        'cost': d.cost,
-                        'price': float(d.price),
-                        'name': d.name,
-                        'imageName': d.image_name,
-                        'imageColor': d.image_color,
-                        'expireDate': d.expire_date,
-                        'avatarItemIds': d.avatar_item_ids or []
-                    }
-                    for d in daily_skins
-                ],
-                'calendars': [
-                    {
-                        'id': c.calendar_id,
-                        'title': c.title,
-                        'cost': c.cost,
-                        'price': float(c.price),
-                        'description': c.description,
-                        'imageName': c.image_name,
-                        'iconName': c.icon_name,
-                        'durationInDays': c.duration_in_days,
-                        'owned': c.owned
-                    }
-                    for c in calendars
-                ],
-                'last_updated': metadata.last_updated if metadata else None
-            }
+    global _shop_snapshot
+    from init_database import ShopMetadata
+    now = monotonic()
+    snapshot = _shop_snapshot
+    if snapshot and now - snapshot.checked < SHOP_SNAPSHOT_RECHECK:
+        return snapshot
+    try:
+        with _shop_snapshot_lock:
+            snapshot = _shop_snapshot
+            with get_db() as db:
+                etag = db.execute(_select_shop_etag()).scalar()
+                if not etag:
+                    etag = _store_shop_snapshot(db)
+                    db.flush()
+                if snapshot and etag == snapshot.etag:
+                    snapshot = snapshot._replace(checked=now)
+                else:
+                    body, compressed = db.execute(
+                        select(ShopMetadata.snapshot_json, ShopMetadata.snapshot_gzip)
+                        .where(ShopMetadata.id == 1)
+                    ).one()
+                    snapshot = ShopSnapshot(etag, bytes(body), bytes(compressed), now)
+            _shop_snapshot = snapshot
+            return snapshot
     except Exception as e:
-        print(f"⚠️ Error getting shop data: {e}")
-        import traceback
-        traceback.print_exc()
+        print(f"⚠️ Error getting shop snapshot: {e}")
+        return _shop_snapshot
+
+def get_shop_data():
+    """All shop data as a dict (decoded from the snapshot)"""
+    snapshot = get_shop_snapshot()
+    if not snapshot:
         return None
+    return json.loads(snapshot.json)
 
 
 def get_shop_bundles_only():
@@ -1323,101 +2533,289 @@ def get_shop_bundles_only():
         return []
 
 # ==================== GIFT CODE FUNCTIONS ====================
-
-def create_gift_code(amount, expires_at=None):
-    """Create a new gift code"""
+# A gift code is a stored-value balance (`amount`). Every balance change is a
+# single conditional UPDATE ... RETURNING (so concurrent redemptions and
+# top-ups can't double-spend) followed, in the same transaction, by a row in
+# the append-only gift_code_transactions ledger.
+
+GIFT_CODE_STATUSES = ("available", "redeemed", "expired")
+
+def _gift_codes():
+    from init_database import GiftCode
+    return GiftCode.__table__
+
+def _gift_code_transactions():
+    from init_database import GiftCodeTransaction
+    return GiftCodeTransaction.__table__
+
+def _normalize_gift_code(code):
+    return (code or "").strip().upper()
+
+def _gift_code_usable(codes):
+    """Not redeemed and not past its expiry date"""
+    return and_(
+        codes.c.is_redeemed == False,
+        or_(codes.c.expires_at.is_(None), codes.c.expires_at >= func.current_date())
+    )
+
+def _gift_code_dict(row):
+    m = row._mapping
+    return {
+        'code': m['code'],
+        'amount': float(m['amount']),
+        'initial_amount': float(m['initial_amount']) if m['initial_amount'] is not None else None,
+        'is_redeemed': m['is_redeemed'],
+        'redeemed_by': m['redeemed_by'],
+        'redeemed_at': m['redeemed_at'].isoformat() if m['redeemed_at'] else None,
+        'created_at': m['created_at'].isoformat() if m['created_at'] else None,
+        'expires_at': m['expires_at'].isoformat() if m['expires_at'] else None
+    }
+
+def _record_gift_transactions(db, entries):
+    """Append ledger rows: dicts with code, kind, delta, balance_after[, username, note]"""
+    if entries:
+        db.execute(_gift_code_transactions().insert(), [
+            {"username": None, "note": None, **entry} for entry in entries
+        ])
+
+def _gift_code_failure(db, code):
+    """Why a conditional gift code update matched nothing"""
+    codes = _gift_codes()
+    row = db.execute(
+        select(codes.c.is_redeemed, codes.c.expires_at, codes.c.amount).where(codes.c.code == code)
+    ).first()
+    if not row:
+        return "Code not found"
+    if row.is_redeemed:
+        return "Code already redeemed"
+    if row.expires_at and row.expires_at < date.today():
+        return "Code expired"
+    return "Insufficient balance"
+
+def _gift_code_generator():
+    import secrets
+    return lambda: secrets.token_hex(8).upper()
+
+def create_gift_codes(count, amount, expires_at=None, note=None):
+    """
+    Mint `count` gift codes of `amount` in one transaction: codes are
+    generated in memory and inserted with chunked multi-row INSERTs (only
+    collisions are regenerated), then their "mint" ledger rows are written
+    in one batch. Returns a list of {code, amount, created_at, expires_at}
+    dicts, or None on error.
+    """
     try:
-        import secrets
-        code = secrets.token_hex(8).upper()
-        
         with get_db() as db:
-            from init_database import GiftCode
-            new_code = GiftCode(
-                code=code,
-                amount=amount,
-                expires_at=expires_at
-            )
-            db.add(new_code)
-            return code
-    except Exception as e:
-        print(f"⚠️ Error creating gift code: {e}")
+            created_at = datetime.utcnow()
+            rows = _insert_unique_codes(db, _gift_codes(), _gift_code_generator(), count, {
+                "amount": amount,
+                "initial_amount": amount,
+                "is_redeemed": False,
+                "created_at": created_at,
+                "expires_at": to_date(expires_at) if expires_at else None
+            })
+            minted = [_gift_code_dict(row) for row in rows]
+            _record_gift_transactions(db, [
+                {"code": gc["code"], "kind": "mint", "delta": amount, "balance_after": amount,
+                 "note": note, "created_at": created_at}
+                for gc in minted
+            ])
+            return minted
+    except Exception as e:
+        print(f"⚠️ Error creating {count} gift codes: {e}")
         return None
 
+def create_gift_code(amount, expires_at=None):
+    """Create a new gift code"""
+    minted = create_gift_codes(1, amount, expires_at)
+    return minted[0]["code"] if minted else None
+
 def get_gift_code(code):
     """Get a gift code by code"""
     try:
         with get_db() as db:
-            from init_database import GiftCode
-            gc = db.query(GiftCode).filter_by(code=code).first()
-            if gc:
-                return {
-                    'code': gc.code,
-                    'amount': float(gc.amount),
-                    'is_redeemed': gc.is_redeemed,
-                    'redeemed_by': gc.redeemed_by,
-                    'expires_at': gc.expires_at
-                }
-            return None
+            codes = _gift_codes()
+            row = db.execute(select(codes).where(codes.c.code == _normalize_gift_code(code))).first()
+            return _gift_code_dict(row) if row else None
     except Exception as e:
         print(f"⚠️ Error getting gift code: {e}")
         return None
 
 def redeem_gift_code(code, username):
-    """Redeem a gift code"""
+    """
+    Redeem a gift code for its whole balance.
+    Returns (True, amount) or (False, reason).
+    """
+    code = _normalize_gift_code(code)
+    codes = _gift_codes()
     try:
         with get_db() as db:
-            from init_database import GiftCode
-            gc = db.query(GiftCode).filter_by(code=code).first()
-            if not gc:
-                return False, "Code not found"
-            if gc.is_redeemed:
-                return False, "Code already redeemed"
-            
-            gc.is_redeemed = True
-            gc.redeemed_by = username
-            gc.redeemed_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            return True, float(gc.amount)
+            # Lock first: a waiting FOR UPDATE re-reads the latest committed
+            # row, so the amount paid out is the balance actually zeroed
+            row = db.execute(
+                select(codes.c.id, codes.c.amount)
+                .where(codes.c.code == code, _gift_code_usable(codes))
+                .with_for_update()
+            ).first()
+            if not row:
+                return False, _gift_code_failure(db, code)
+
+            db.execute(
+                codes.update()
+                .where(codes.c.id == row.id)
+                .values(amount=0, is_redeemed=True, redeemed_by=username, redeemed_at=datetime.utcnow())
+            )
+            amount = row.amount
+            _record_gift_transactions(db, [{
+                "code": code, "kind": "redeem", "delta": -amount, "balance_after": 0, "username": username
+            }])
+            return True, float(amount)
     except Exception as e:
         print(f"⚠️ Error redeeming gift code: {e}")
         return False, str(e)
 
-def update_gift_code_balance(code, new_balance):
-    """Update gift code balance (for top-ups)"""
+def spend_gift_code(code, amount, username=None, note=None):
+    """
+    Debit `amount` from a gift code's balance; the code is marked redeemed
+    when it reaches zero. Returns (True, new_balance) or (False, reason).
+    """
+    code = _normalize_gift_code(code)
+    codes = _gift_codes()
+    remaining = codes.c.amount - amount
+    try:
+        with get_db() as db:
+            row = db.execute(
+                codes.update()
+                .where(codes.c.code == code, _gift_code_usable(codes), codes.c.amount >= amount)
+                .values(
+                    amount=remaining,
+                    is_redeemed=(remaining == 0),
+                    redeemed_by=case((remaining == 0, username), else_=codes.c.redeemed_by),
+                    redeemed_at=case((remaining == 0, datetime.utcnow()), else_=codes.c.redeemed_at)
+                )
+                .returning(codes.c.amount)
+            ).first()
+            if not row:
+                return False, _gift_code_failure(db, code)
+
+            _record_gift_transactions(db, [{
+                "code": code, "kind": "spend", "delta": -amount, "balance_after": row.amount,
+                "username": username, "note": note
+            }])
+            return True, float(row.amount)
+    except Exception as e:
+        print(f"⚠️ Error spending gift code: {e}")
+        return False, str(e)
+
+def top_up_gift_code(code, amount, username=None, note=None):
+    """Add `amount` to an unredeemed code's balance. Returns (True, new_balance) or (False, reason)."""
+    code = _normalize_gift_code(code)
+    codes = _gift_codes()
+    try:
+        with get_db() as db:
+            row = db.execute(
+                codes.update()
+                .where(codes.c.code == code, _gift_code_usable(codes))
+                .values(amount=codes.c.amount + amount)
+                .returning(codes.c.amount)
+            ).first()
+            if not row:
+                return False, _gift_code_failure(db, code)
+
+            _record_gift_transactions(db, [{
+                "code": code, "kind": "topup", "delta": amount, "balance_after": row.amount,
+                "username": username, "note": note
+            }])
+            return True, float(row.amount)
+    except Exception as e:
+        print(f"⚠️ Error topping up gift code: {e}")
+        return False, str(e)
+
+def update_gift_code_balance(code, new_balance, username=None, note=None):
+    """Set a gift code's balance (admin correction), recorded as an adjustment"""
+    code = _normalize_gift_code(code)
+    codes = _gift_codes()
     try:
         with get_db() as db:
-            from init_database import GiftCode
-            gc = db.query(GiftCode).filter_by(code=code).first()
-            if not gc:
+            previous = db.execute(
+                select(codes.c.id, codes.c.amount).where(codes.c.code == code).with_for_update()
+            ).first()
+            if not previous:
                 return False, "Code not found"
-            
-            gc.amount = float(new_balance)
+
+            row = db.execute(
+                codes.update()
+                .where(codes.c.id == previous.id)
+                .values(amount=new_balance)
+                .returning(codes.c.amount)
+            ).first()
+            _record_gift_transactions(db, [{
+                "code": code, "kind": "adjust", "delta": row.amount - previous.amount,
+                "balance_after": row.amount, "username": username, "note": note
+            }])
             return True, "Balance updated"
     except Exception as e:
         print(f"⚠️ Error updating gift code balance: {e}")
         return False, str(e)
 
-def get_all_gift_codes():
-    """Get all gift codes for admin"""
+def get_gift_code_transactions(code, limit=100):
+    """Ledger rows of one code, newest first"""
     try:
         with get_db() as db:
-            from init_database import GiftCode
-            codes = db.query(GiftCode).all()
+            ledger = _gift_code_transactions()
+            rows = db.execute(
+                select(ledger)
+                .where(ledger.c.code == _normalize_gift_code(code))
+                .order_by(ledger.c.created_at.desc(), ledger.c.id.desc())
+                .limit(min(limit, MAX_PAGE_SIZE))
+            ).all()
             return [
                 {
-                    'code': c.code,
-                    'amount': float(c.amount),
-                    'is_redeemed': c.is_redeemed,
-                    'redeemed_by': c.redeemed_by,
-                    'redeemed_at': c.redeemed_at,
-                    'created_at': c.created_at,
-                    'expires_at': c.expires_at
+                    "id": row.id,
+                    "kind": row.kind,
+                    "delta": float(row.delta),
+                    "balance_after": float(row.balance_after),
+                    "username": row.username,
+                    "note": row.note,
+                    "created_at": row.created_at.isoformat() if row.created_at else None
                 }
-                for c in codes
+                for row in rows
             ]
     except Exception as e:
-        print(f"⚠️ Error getting all gift codes: {e}")
+        print(f"⚠️ Error getting gift code transactions: {e}")
         return []
 
+def page_gift_codes(cursor=None, limit=50, descending=True, status=None, search=None):
+    """
+    One page of gift codes, newest first by default.
+    status: "available", "redeemed" or "expired"; search: code prefix.
+    Raises ValueError for bad arguments, returns None on database errors.
+    """
+    codes = _gift_codes()
+    stmt = select(codes)
+    if status == "available":
+        stmt = stmt.where(_gift_code_usable(codes))
+    elif status == "redeemed":
+        stmt = stmt.where(codes.c.is_redeemed == True)
+    elif status == "expired":
+        stmt = stmt.where(codes.c.is_redeemed == False, codes.c.expires_at < func.current_date())
+    elif status:
+        raise ValueError(f"invalid status: {status}")
+    if search:
+        stmt = stmt.where(codes.c.code.like(_like_prefix(_normalize_gift_code(search)), escape="\\"))
+
+    try:
+        with get_db() as db:
+            return _keyset_page(
+                db, stmt, "created", codes.c.created_at, codes.c.id, descending, cursor, limit,
+                _gift_code_dict
+            )
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Error paging gift codes: {e}")
+        return None
+
 # ==================== PURCHASE HISTORY FUNCTIONS ====================
 
 def create_paypal_purchase(username, email, item, amount, currency="USD"):
@@ -1438,7 +2836,7 @@ def create_paypal_purchase(username, email, item, amount, currency="USD"):
                 updated_at=datetime.utcnow()
             )
             db.add(purchase)
-            db.commit()
+            db.flush()
             return {"success": True, "purchase_id": purchase.id}
     except Exception as e:
         print(f"⚠️ Error creating PayPal purchase: {e}")
@@ -1539,6 +2937,40 @@ def update_shop_settings(global_promo_enabled, global_promo_percent, global_prom
 
 # ==================== ROSES/GEMS PURCHASE FUNCTIONS ====================
 
+# Statuses of the admin work queue (everything not yet completed)
+PENDING_PURCHASE_STATUSES = (PurchaseStatus.AWAITING_CONTACT, PurchaseStatus.AWAITING_TRANSACTION)
+
+# A claim on a purchase expires after this many seconds without completion
+PURCHASE_CLAIM_TTL = int(os.getenv("PURCHASE_CLAIM_TTL", "900"))
+
+def _enum_value(value):
+    return value.value if isinstance(value, (PurchaseStatus, PurchasePlatform)) else value
+
+def _purchase_record(p):
+    """Build a PurchaseRecord with pre-formatted timestamps"""
+    return PurchaseRecord(
+        p.id, p.username, p.email, _enum_value(p.platform), p.item, p.currency, p.price,
+        p.duration, _enum_value(p.status), p.access_key,
+        p.created_at.strftime("%Y-%m-%d %H:%M:%S") if p.created_at else None,
+        p.updated_at.strftime("%Y-%m-%d %H:%M:%S") if p.updated_at else None,
+        p.claimed_by,
+        p.claimed_at.strftime("%Y-%m-%d %H:%M:%S") if p.claimed_at else None
+    )
+
+def _purchases():
+    from init_database import Purchase
+    return Purchase.__table__
+
+def _purchase_claimable(purchases, claimant):
+    """Unclaimed, claimed by `claimant`, or claimed longer than PURCHASE_CLAIM_TTL ago"""
+    clauses = [
+        purchases.c.claimed_by.is_(None),
+        purchases.c.claimed_at < datetime.utcnow() - timedelta(seconds=PURCHASE_CLAIM_TTL)
+    ]
+    if claimant:
+        clauses.append(purchases.c.claimed_by == claimant)
+    return or_(*clauses)
+
 def create_purchase(username, email, platform, item, currency, price, duration=None):
     """Create a new Roses/Gems purchase entry"""
     try:
@@ -1571,20 +3003,7 @@ def get_purchase(purchase_id):
             from init_database import Purchase
             purchase = db.query(Purchase).filter_by(id=purchase_id).first()
             if purchase:
-                return {
-                    'id': purchase.id,
-                    'username': purchase.username,
-                    'email': purchase.email,
-                    'platform': purchase.platform,
-                    'item': purchase.item,
-                    'currency': purchase.currency,
-                    'price': purchase.price,
-                    'duration': purchase.duration,
-                    'status': purchase.status,
-                    'access_key': purchase.access_key,
-                    'created_at': purchase.created_at.strftime("%Y-%m-%d %H:%M:%S") if purchase.created_at else None,
-                    'updated_at': purchase.updated_at.strftime("%Y-%m-%d %H:%M:%S") if purchase.updated_at else None
-                }
+                return _purchase_record(purchase)
             return None
     except Exception as e:
         print(f"⚠️ Error getting purchase: {e}")
@@ -1596,23 +3015,7 @@ def get_all_purchases_for_admin():
         with get_db() as db:
             from init_database import Purchase
             purchases = db.query(Purchase).order_by(Purchase.created_at.desc()).all()
-            return [
-                {
-                    'id': p.id,
-                    'username': p.username,
-                    'email': p.email,
-                    'platform': p.platform,
-                    'item': p.item,
-                    'currency': p.currency,
-                    'price': p.price,
-                    'duration': p.duration,
-                    'status': p.status,
-                    'access_key': p.access_key,
-                    'created_at': p.created_at.strftime("%Y-%m-%d %H:%M:%S") if p.created_at else None,
-                    'updated_at': p.updated_at.strftime("%Y-%m-%d %H:%M:%S") if p.updated_at else None
-                }
-                for p in purchases
-            ]
+            return [_purchase_record(p) for p in purchases]
     except Exception as e:
         print(f"⚠️ Error getting purchases: {e}")
         return []
@@ -1622,91 +3025,595 @@ def get_all_paypal_purchases():
     try:
         with get_db() as db:
             from init_database import Purchase
-            purchases = db.query(Purchase).filter_by(platform="PayPal").order_by(Purchase.created_at.desc()).all()
-            return [
-                {
-                    'id': p.id,
-                    'username': p.username,
-                    'email': p.email,
-                    'item': p.item,
-                    'price': p.price,
-                    'currency': p.currency,
-                    'status': p.status,
-                    'created_at': p.created_at.strftime("%Y-%m-%d %H:%M:%S") if p.created_at else None,
-                    'updated_at': p.updated_at.strftime("%Y-%m-%d %H:%M:%S") if p.updated_at else None
-                }
-                for p in purchases
-            ]
+            purchases = (
+                db.query(Purchase)
+                .filter(Purchase.platform == PurchasePlatform.PAYPAL)
+                .order_by(Purchase.created_at.desc(), Purchase.id.desc())
+                .all()
+            )
+            return [_purchase_record(p) for p in purchases]
     except Exception as e:
         print(f"⚠️ Error getting PayPal purchases: {e}")
         return []
 
-def update_purchase_status(purchase_id, new_status):
+def _set_purchase(purchase_id, values, claimant=None, open_only=False):
+    """
+    Apply `values` to one purchase in a single UPDATE ... RETURNING.
+    With a `claimant`, the update only goes through if nobody else holds a
+    live claim on it; with `open_only`, only if it isn't completed yet, so of
+    two concurrent approvals exactly one matches. Completing a purchase
+    releases its claim. A refused update returns "conflict": True.
+    """
+    purchases = _purchases()
+    values = dict(values, updated_at=datetime.utcnow())
+    if values.get("status") == PurchaseStatus.COMPLETED:
+        values.update(claimed_by=None, claimed_at=None)
+    stmt = purchases.update().where(purchases.c.id == purchase_id)
+    if claimant:
+        stmt = stmt.where(_purchase_claimable(purchases, claimant))
+    if open_only:
+        stmt = stmt.where(purchases.c.status != PurchaseStatus.COMPLETED)
+    try:
+        with get_db() as db:
+            row = db.execute(stmt.values(**values).returning(*purchases.c)).first()
+            if row:
+                return {"success": True, "purchase": _purchase_record(row)}
+            current = db.execute(
+                select(purchases.c.status, purchases.c.claimed_by).where(purchases.c.id == purchase_id)
+            ).first()
+            if not current:
+                return {"success": False, "error": "Purchase not found"}
+            if open_only and current.status == PurchaseStatus.COMPLETED:
+                return {"success": False, "error": "Purchase already completed", "conflict": True}
+            return {"success": False, "error": f"Purchase is claimed by {current.claimed_by}", "conflict": True}
+    except Exception as e:
+        print(f"⚠️ Error updating purchase {purchase_id}: {e}")
+        return {"success": False, "error": str(e)}
+
+def update_purchase_status(purchase_id, new_status, claimant=None):
     """Update purchase status"""
+    try:
+        status = PurchaseStatus(new_status)
+    except ValueError:
+        return {"success": False, "error": "Invalid status"}
+    return _set_purchase(purchase_id, {"status": status}, claimant)
+
+def update_purchase_with_key(purchase_id, access_key, claimant=None):
+    """Attach the access key and mark the purchase completed (refused if it already is)"""
+    return _set_purchase(
+        purchase_id, {"access_key": access_key, "status": PurchaseStatus.COMPLETED}, claimant, open_only=True
+    )
+
+def get_pending_purchases():
+    """Get all pending purchases (not Completed), newest first (the work queue is oldest first)"""
     try:
         with get_db() as db:
             from init_database import Purchase
-            purchase = db.query(Purchase).filter_by(id=purchase_id).first()
-            if purchase:
-                purchase.status = new_status
-                purchase.updated_at = datetime.utcnow()
-                return {"success": True, "purchase": get_purchase(purchase_id)}
-            return {"success": False, "error": "Purchase not found"}
+            purchases = (
+                db.query(Purchase)
+                .filter(Purchase.status.in_(PENDING_PURCHASE_STATUSES))
+                .order_by(Purchase.created_at.desc(), Purchase.id.desc())
+                .all()
+            )
+            return [_purchase_record(p) for p in purchases]
     except Exception as e:
-        print(f"⚠️ Error updating purchase status: {e}")
-        return {"success": False, "error": str(e)}
+        print(f"⚠️ Error getting pending purchases: {e}")
+        return []
+
+def claim_purchases(claimant, limit=1, status=None, platform=None):
+    """
+    Claim up to `limit` of the oldest pending purchases for `claimant`.
+
+    Candidates are picked with FOR UPDATE SKIP LOCKED, so admins claiming
+    concurrently never get the same purchase; purchases claimed by someone
+    else are skipped until their claim expires (PURCHASE_CLAIM_TTL).
+    Returns the claimed PurchaseRecords (possibly empty), or None on error.
+    """
+    purchases = _purchases()
+    statuses = [PurchaseStatus(status)] if status else list(PENDING_PURCHASE_STATUSES)
+    candidates = (
+        select(purchases.c.id)
+        .where(purchases.c.status.in_(statuses), _purchase_claimable(purchases, claimant))
+        .order_by(purchases.c.created_at, purchases.c.id)
+        .limit(max(1, min(int(limit), MAX_PAGE_SIZE)))
+        .with_for_update(skip_locked=True)
+    )
+    if platform:
+        candidates = candidates.where(purchases.c.platform == PurchasePlatform(platform))
+    try:
+        with get_db() as db:
+            rows = db.execute(
+                purchases.update()
+                .where(purchases.c.id.in_(candidates.scalar_subquery()))
+                .values(claimed_by=claimant, claimed_at=datetime.utcnow())
+                .returning(*purchases.c)
+            ).all()
+            rows.sort(key=lambda r: (r.created_at or datetime.min, r.id))
+            return [_purchase_record(row) for row in rows]
+    except Exception as e:
+        print(f"⚠️ Error claiming purchases: {e}")
+        return None
+
+def claim_purchase(purchase_id, claimant):
+    """
+    Claim one open purchase unless another admin holds a live claim
+    (same result shape as update_purchase_status)
+    """
+    return _set_purchase(
+        purchase_id, {"claimed_by": claimant, "claimed_at": datetime.utcnow()}, claimant, open_only=True
+    )
 
-def update_purchase_with_key(purchase_id, access_key):
-    """Update purchase with access key and mark as completed"""
+def release_purchase_claim(purchase_id, claimant):
+    """Give up `claimant`'s claim on a purchase; True if it held one"""
+    purchases = _purchases()
     try:
         with get_db() as db:
-            from init_database import Purchase
-            purchase = db.query(Purchase).filter_by(id=purchase_id).first()
-            if purchase:
-                purchase.access_key = access_key
-                purchase.status = "Completed"
-                purchase.updated_at = datetime.utcnow()
-                return {"success": True, "purchase": get_purchase(purchase_id)}
-            return {"success": False, "error": "Purchase not found"}
+            return db.execute(
+                purchases.update()
+                .where(purchases.c.id == purchase_id, purchases.c.claimed_by == claimant)
+                .values(claimed_by=None, claimed_at=None)
+            ).rowcount == 1
     except Exception as e:
-        print(f"⚠️ Error updating purchase with key: {e}")
-        return {"success": False, "error": str(e)}
+        print(f"⚠️ Error releasing purchase claim: {e}")
+        return False
+    
+# ==================== PAGINATION ====================
+# Keyset ("seek") pagination for the admin listings: each page is one indexed
+# range scan of `limit + 1` rows past the cursor, whatever the table size.
+# Cursors are opaque url-safe strings holding the last row's sort value and
+# primary key, plus the sort they belong to so they can't be replayed
+# against a different ordering. NULL sort values sort last in both directions
+# (see _keyset_page).
+
+MAX_PAGE_SIZE = 500
+
+def _encode_cursor(sort, descending, value, key):
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    raw = json.dumps([sort, descending, value, key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor, sort, descending, sort_column):
+    """Returns (value, key); raises ValueError for malformed or foreign cursors"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        c_sort, c_desc, value, key = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if c_sort != sort or c_desc != descending:
+        raise ValueError("cursor does not match the requested sort")
+    if value is not None:
+        python_type = sort_column.type.python_type
+        if python_type is datetime:
+            value = datetime.fromisoformat(value)
+        elif python_type is date:
+            value = date.fromisoformat(value)
+    return value, key
+
+def _like_prefix(prefix):
+    """LIKE pattern matching values that start with `prefix` literally"""
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+def _keyset_page(db, stmt, sort, sort_column, key_column, descending, cursor, limit, build):
+    """
+    Run one keyset page of `stmt` ordered by (sort_column, key_column).
+    Returns {"items": [...], "next_cursor": str|None, "has_more": bool}.
+
+    Rows with a NULL sort value come after all others, in key order. They are
+    read by a second seek once the non-NULL rows run out, so both parts are
+    plain ASC/DESC range scans of the (sort, key) index in its own order.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    value = key = None
+    if cursor:
+        value, key = _decode_cursor(cursor, sort, descending, sort_column)
+    in_null_tail = bool(cursor) and value is None
+    direction = (lambda c: c.desc()) if descending else (lambda c: c.asc())
+    stmt = stmt.add_columns(sort_column.label("_page_sort"), key_column.label("_page_key"))
+
+    rows = []
+    if not in_null_tail:
+        where = [sort_column.is_not(None)] if sort_column.nullable else []
+        if cursor:
+            position = tuple_(sort_column, key_column)
+            where.append(position < tuple_(value, key) if descending else position > tuple_(value, key))
+        rows = db.execute(
+            stmt.where(*where).order_by(direction(sort_column), direction(key_column)).limit(limit + 1)
+        ).all()
+
+    if len(rows) <= limit and sort_column.nullable:
+        where = [sort_column.is_(None)]
+        if in_null_tail:
+            where.append(key_column < key if descending else key_column > key)
+        rows += db.execute(
+            stmt.where(*where).order_by(direction(key_column)).limit(limit + 1 - len(rows))
+        ).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_more:
+        last = rows[-1]._mapping
+        next_cursor = _encode_cursor(sort, descending, last["_page_sort"], last["_page_key"])
+    return {"items": [build(row) for row in rows], "next_cursor": next_cursor, "has_more": has_more}
+
+def page_licenses(cursor=None, limit=50, sort="username", descending=False, status=None, search=None):
+    """
+    One page of licenses with their last connection time.
+    sort: "username" or "expires"; status: "active", "expired" or "paused";
+    search: case-insensitive username prefix.
+    Raises ValueError for bad arguments, returns None on database errors.
+    """
+    sort_columns = {"username": _users.c.username, "expires": _users.c.expires_on}
+    if sort not in sort_columns:
+        raise ValueError(f"invalid sort: {sort}")
+
+    last_connected = LastConnected.__table__
+    stmt = select(*_LICENSE_COLUMNS, last_connected.c.last_connected).select_from(
+        _users.outerjoin(last_connected, last_connected.c.username == _users.c.username)
+    )
+    today = datetime.now().date()
+    if status == "active":
+        stmt = stmt.where(_users.c.expires_on > today)
+    elif status == "expired":
+        stmt = stmt.where(_users.c.expires_on <= today)
+    elif status == "paused":
+        stmt = stmt.where(_users.c.paused == True)
+    elif status:
+        raise ValueError(f"invalid status: {status}")
+    if search:
+        stmt = stmt.where(func.lower(_users.c.username).like(_like_prefix(search.lower()), escape="\\"))
+
+    try:
+        with get_db() as db:
+            return _keyset_page(
+                db, stmt, sort, sort_columns[sort], _users.c.username, descending, cursor, limit,
+                lambda row: dict(_license_from_row(row).to_dict(), last_connected=row[9])
+            )
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Error paging users: {e}")
+        return None
+
+def page_keys(cursor=None, limit=50, sort="created", descending=True, status=None, search=None):
+    """
+    One page of activation keys.
+    sort: "created" or "code"; status: "used" or "unused"; search: code prefix.
+    Raises ValueError for bad arguments, returns None on database errors.
+    """
+    sort_columns = {"created": _keys.c.created, "code": _keys.c.code}
+    if sort not in sort_columns:
+        raise ValueError(f"invalid sort: {sort}")
+
+    stmt = select(*_KEY_COLUMNS)
+    if status == "used":
+        stmt = stmt.where(_keys.c.used == True)
+    elif status == "unused":
+        stmt = stmt.where(_keys.c.used == False)
+    elif status:
+        raise ValueError(f"invalid status: {status}")
+    if search:
+        stmt = stmt.where(_keys.c.code.like(_like_prefix(search), escape="\\"))
 
-def get_pending_purchases():
-    """Get all pending purchases (not Completed)"""
     try:
         with get_db() as db:
-            from init_database import Purchase
-            purchases = db.query(Purchase).filter(Purchase.status != "Completed").order_by(Purchase.created_at.desc()).all()
-            return [
-                {
-                    'id': p.id,
-                    'username': p.username,
-                    'email': p.email,
-                    'platform': p.platform,
-                    'item': p.item,
-                    'currency': p.currency,
-                    'price': p.price,
-                    'status': p.status,
-                    'access_key': p.access_key,
-                    'created_at': p.created_at.strftime("%Y-%m-%d %H:%M:%S") if p.created_at else None,
-                    'updated_at': p.updated_at.strftime("%Y-%m-%d %H:%M:%S") if p.updated_at else None
-                }
-                for p in purchases
-            ]
+            return _keyset_page(
+                db, stmt, sort, sort_columns[sort], _keys.c.code, descending, cursor, limit,
+                lambda row: KeyRecord(*row[:6])
+            )
+    except ValueError:
+        raise
     except Exception as e:
-        print(f"⚠️ Error getting pending purchases: {e}")
+        print(f"⚠️ Error paging keys: {e}")
+        return None
+
+def page_testimonials(cursor=None, limit=50, descending=True, approved=None, search=None):
+    """
+    One page of testimonials ordered by date.
+    approved: True/False to filter by moderation state; search: username prefix.
+    Raises ValueError for bad arguments, returns None on database errors.
+    """
+    stmt = select(*_TESTIMONIAL_COLUMNS)
+    if approved is not None:
+        stmt = stmt.where(_testimonials.c.approved == approved)
+    if search:
+        stmt = stmt.where(func.lower(_testimonials.c.username).like(_like_prefix(search.lower()), escape="\\"))
+
+    try:
+        with get_db() as db:
+            return _keyset_page(
+                db, stmt, "date", _testimonials.c.date, _testimonials.c.id, descending, cursor, limit,
+                lambda row: TestimonialRecord(*row[:7])
+            )
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Error paging testimonials: {e}")
+        return None
+
+def page_purchases(cursor=None, limit=50, descending=True, platform=None, status=None, search=None):
+    """
+    One page of purchases ordered by creation time.
+    platform: a PurchasePlatform value; status: a PurchaseStatus value or
+    "pending" (the work queue); search: username prefix.
+    Raises ValueError for bad arguments, returns None on database errors.
+    """
+    purchases = _purchases()
+    stmt = select(purchases)
+    if platform:
+        stmt = stmt.where(purchases.c.platform == PurchasePlatform(platform))
+    if status == "pending":
+        stmt = stmt.where(purchases.c.status.in_(PENDING_PURCHASE_STATUSES))
+    elif status:
+        stmt = stmt.where(purchases.c.status == PurchaseStatus(status))
+    if search:
+        stmt = stmt.where(func.lower(purchases.c.username).like(_like_prefix(search.lower()), escape="\\"))
+
+    try:
+        with get_db() as db:
+            return _keyset_page(
+                db, stmt, "created_at", purchases.c.created_at, purchases.c.id, descending, cursor, limit,
+                _purchase_record
+            )
+    except ValueError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Error paging purchases: {e}")
+        return None
+
+# ==================== ADMIN USER LIST ====================
+# One LEFT JOIN of users, last_connected and stats, so the admin list is a
+# single query. Summary mode reads the same rows from the
+# admin_user_summary materialized view, refreshed CONCURRENTLY (readers are
+# never blocked) at most every ADMIN_SUMMARY_MAX_AGE seconds. Refreshes are
+# recorded in job_runs, so every worker knows when any process last did one.
+
+ADMIN_SUMMARY_MAX_AGE = int(os.getenv("ADMIN_SUMMARY_MAX_AGE", "60"))
+ADMIN_SUMMARY_JOB = "admin_summary_refresh"
+ADMIN_SUMMARY_LOCK_KEY = int(os.getenv("ADMIN_SUMMARY_LOCK_KEY", "7235676"))
+_admin_summary_fresh_until = 0.0  # monotonic time until which this process skips the check
+
+_admin_user_summary = table(
+    "admin_user_summary",
+    column("username"), column("player_id"), column("expires_on", Date), column("expires"),
+    column("paused"), column("paused_at"), column("remaining_days"), column("last_nickname"),
+    column("first_connection_date"), column("last_connected"), column("connection_count", Integer)
+)
+
+_ADMIN_USER_BASE_COLUMNS = (
+    "username", "player_id", "expires_on", "expires", "paused", "paused_at",
+    "remaining_days", "last_nickname", "first_connection_date",
+    "last_connected", "connection_count"
+)
+
+def _admin_users_live_source():
+    last_connected = LastConnected.__table__
+    stats = Stats.__table__
+    source = (
+        _users
+        .outerjoin(last_connected, last_connected.c.username == _users.c.username)
+        .outerjoin(stats, stats.c.username == _users.c.username)
+    )
+    columns = [_users.c[name] for name in _ADMIN_USER_BASE_COLUMNS[:9]] + [
+        last_connected.c.last_connected,
+        func.coalesce(stats.c.connection_count, 0).label("connection_count")
+    ]
+    return source, columns
+
+def _select_admin_summary_age():
+    """Seconds since the last recorded refresh by any process (NULL if none)"""
+    from init_database import JobRun
+    return select(
+        func.extract("epoch", func.timezone("utc", func.now()) - func.max(JobRun.started_at))
+    ).where(JobRun.job == ADMIN_SUMMARY_JOB, JobRun.status == "ok")
+
+def refresh_admin_user_summary(force=False):
+    """
+    Refresh the admin_user_summary view unless some process refreshed it
+    within ADMIN_SUMMARY_MAX_AGE seconds. The scheduler's admin_summary_refresh
+    job (force=True, recorded by the scheduler) normally keeps it fresh;
+    requests only refresh inline when that job hasn't run, and then only one
+    worker at a time (the others keep reading the current rows).
+    """
+    global _admin_summary_fresh_until
+    now = monotonic()
+    if not force and now < _admin_summary_fresh_until:
+        return True
+    try:
+        started_at = datetime.utcnow()
+        with engine.begin() as conn:
+            if not force:
+                age = conn.execute(_select_admin_summary_age()).scalar()
+                if age is not None and float(age) < ADMIN_SUMMARY_MAX_AGE:
+                    _admin_summary_fresh_until = now + ADMIN_SUMMARY_MAX_AGE - float(age)
+                    return True
+                locked = conn.execute(
+                    text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ADMIN_SUMMARY_LOCK_KEY}
+                ).scalar()
+                if not locked:
+                    return True
+            conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY admin_user_summary"))
+        if not force:
+            duration_ms = int((datetime.utcnow() - started_at).total_seconds() * 1000)
+            record_job_run(ADMIN_SUMMARY_JOB, started_at, duration_ms, "ok")
+        _admin_summary_fresh_until = now + ADMIN_SUMMARY_MAX_AGE
+        return True
+    except Exception as e:
+        print(f"⚠️ Error refreshing admin_user_summary: {e}")
+        return False
+
+def load_admin_users(computed=False, summary=False):
+    """
+    All licenses with last connection time and connection count, by username.
+    computed=True adds days_remaining and active, evaluated in SQL.
+    summary=True reads the (periodically refreshed) materialized view instead
+    of joining the live tables.
+    """
+    if summary:
+        refresh_admin_user_summary()
+        source = _admin_user_summary
+        columns = [source.c[name] for name in _ADMIN_USER_BASE_COLUMNS]
+    else:
+        source, columns = _admin_users_live_source()
+
+    expires_on = columns[2]
+    if computed:
+        columns = columns + [
+            (expires_on - func.current_date()).label("days_remaining"),
+            (expires_on > func.current_date()).label("active")
+        ]
+    stmt = select(*columns).select_from(source).order_by(columns[0])
+
+    try:
+        with get_db() as db:
+            users = []
+            for row in db.execute(stmt):
+                data = dict(row._mapping)
+                # Fall back to the legacy string for rows not backfilled yet
+                expires_on = data.pop("expires_on")
+                legacy = data.pop("expires")
+                data["expires"] = expires_on.isoformat() if expires_on else legacy
+                users.append(data)
+            return users
+    except Exception as e:
+        print(f"⚠️ Error loading admin users: {e}")
         return []
-    
+
+# ==================== STREAMING EXPORTS ====================
+# Generators over a server-side cursor: rows are fetched `batch_size` at a
+# time on a dedicated connection, so memory stays flat whatever the table
+# size. They open their own connection (not the request session) because
+# streamed responses are consumed after the request handler has returned.
+
+STREAM_BATCH_SIZE = 1000
+
+def _stream_rows(stmt, batch_size=STREAM_BATCH_SIZE):
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+        for row in result:
+            yield row
+
+def stream_licenses():
+    """Yield every license (as a dict) with its last connection time, by username"""
+    last_connected = LastConnected.__table__
+    stmt = (
+        select(*_LICENSE_COLUMNS, last_connected.c.last_connected)
+        .select_from(_users.outerjoin(last_connected, last_connected.c.username == _users.c.username))
+        .order_by(_users.c.username)
+    )
+    for row in _stream_rows(stmt):
+        yield dict(_license_from_row(row).to_dict(), last_connected=row[9])
+
+def stream_keys():
+    """Yield every activation key (as a dict), newest first"""
+    stmt = select(*_KEY_COLUMNS).order_by(_keys.c.created.desc(), _keys.c.code.desc())
+    for row in _stream_rows(stmt):
+        yield KeyRecord(*row).to_dict()
+
+def stream_logs(limit=None):
+    """Yield logs newest first, optionally only the latest `limit`"""
+    logs = Log.__table__
+    stmt = select(logs.c.timestamp, logs.c.message, logs.c.level).order_by(logs.c.id.desc())
+    if limit:
+        stmt = stmt.limit(limit)
+    for ts, msg, level in _stream_rows(stmt):
+        yield {"ts": ts, "msg": msg, "level": level}
+
+def get_log_summary(limit):
+    """Count and newest/oldest timestamps of the latest `limit` logs, without loading them"""
+    logs = Log.__table__
+    try:
+        with get_db() as db:
+            newest = db.execute(
+                select(logs.c.timestamp).order_by(logs.c.id.desc()).limit(1)
+            ).scalar()
+            if newest is None:
+                return {"total": 0, "newest": None, "oldest": None}
+            total = db.execute(
+                select(func.count()).select_from(select(logs.c.id).order_by(logs.c.id.desc()).limit(limit).subquery())
+            ).scalar()
+            oldest = db.execute(
+                select(logs.c.timestamp).order_by(logs.c.id.desc()).offset(total - 1).limit(1)
+            ).scalar()
+            return {"total": total, "newest": newest, "oldest": oldest}
+    except Exception as e:
+        print(f"⚠️ Error summarizing logs: {e}")
+        return {"total": 0, "newest": None, "oldest": None}
+
+def stream_recent_connections():
+    """Yield recent connection attempts, newest first"""
+    conns = RecentConnection.__table__
+    stmt = (
+        select(conns.c.timestamp, conns.c.username, conns.c.ip, conns.c.status)
+        .order_by(conns.c.id.desc())
+    )
+    for ts, username, ip, status in _stream_rows(stmt):
+        yield {"ts": ts, "username": username, "ip": ip, "status": status}
+
+def stream_purchases(platform=None):
+    """Yield purchases (as dicts), newest first, optionally for one platform"""
+    from init_database import Purchase
+    purchases = Purchase.__table__
+    stmt = select(purchases).order_by(purchases.c.created_at.desc(), purchases.c.id.desc())
+    if platform:
+        stmt = stmt.where(purchases.c.platform == platform)
+    for row in _stream_rows(stmt):
+        yield _purchase_record(row).to_dict()
+
 # ==================== EXPORTS ====================
 
 __all__ = [
     'load_users',
     'save_users',
     'find_user',
+    'find_license',
+    'delete_license',
+    'has_testimonial_from',
+    'add_user_xp',
+    'record_authorized_connection',
     'load_keys',
     'save_keys',
     'find_key',
+    'create_key',
+    'create_keys',
+    'redeem_key',
+    'delete_keys',
+    'revoke_keys',
+    'expire_unused_keys',
+    'KEY_REVOKED',
+    'KEY_EXPIRED',
+    'page_licenses',
+    'page_keys',
+    'page_testimonials',
+    'page_purchases',
+    'MAX_PAGE_SIZE',
+    'stream_licenses',
+    'stream_keys',
+    'stream_logs',
+    'stream_recent_connections',
+    'stream_purchases',
+    'get_log_summary',
+    'load_admin_users',
+    'refresh_admin_user_summary',
+    'LOG_RETENTION',
+    'ensure_log_partitions',
+    'prune_logs',
+    'run_log_maintenance',
+    'JOB_RUN_RETENTION_DAYS',
+    'record_job_run',
+    'get_job_runs',
+    'prune_job_runs',
+    'delete_expired_password_resets',
+    'EMAIL_CLAIM_TIMEOUT',
+    'enqueue_email',
+    'claim_outbound_emails',
+    'mark_emails_sent',
+    'mark_emails_failed',
+    'get_email_queue_stats',
+    'prune_outbound_emails',
+    'query_logs',
     'load_testimonials',
     'save_testimonials',
     'read_storage_impl',
@@ -1722,6 +3629,11 @@ __all__ = [
     'get_license',
     'pause_license',
     'resume_license',
+    'get_expiring_licenses',
+    'to_date',
+    'to_datetime',
+    'ensure_schema',
+    'call_after_commit',
     'get_user_xp',
     'load_stats',
     'save_stats',
@@ -1741,19 +3653,41 @@ __all__ = [
     'add_gem_account',
     'update_gem_account_nickname',
     'deduct_account_gems',
+    'reserve_gems',
+    'get_gem_accounts_stats',
     'recharge_account_gems',
+    'DEFAULT_ACCOUNT_GEMS',
+    'import_gem_accounts',
+    'recharge_gem_accounts',
+    'set_gem_accounts_active',
+    'delete_gem_accounts',
     'get_pool_stats',
+    'init_request_session',
     'get_latest_bot_version',
     'set_latest_bot_version',
     'update_user_bot_version',
     'save_all_shop_data',
     'get_shop_data',
+    'get_shop_snapshot',
     'get_shop_bundles_only',
     'create_gift_code',
+    'create_gift_codes',
     'get_gift_code',
     'redeem_gift_code',
-    'get_all_gift_codes',
+    'spend_gift_code',
+    'top_up_gift_code',
+    'update_gift_code_balance',
+    'get_gift_code_transactions',
+    'GIFT_CODE_STATUSES',
+    'page_gift_codes',
     'create_purchase',
+    'PurchaseStatus',
+    'PurchasePlatform',
+    'PENDING_PURCHASE_STATUSES',
+    'PURCHASE_CLAIM_TTL',
+    'claim_purchases',
+    'claim_purchase',
+    'release_purchase_claim',
     'get_user_purchases',
     'get_all_purchases',
     'get_shop_settings',
@@ -0,0 +1,239 @@
+"""
+Outbound email queue for Brevo transactional emails.
+
+send_email() stores the email in the outbound_emails table, in the same
+transaction as the request's other changes, and wakes this process's
+EmailSender thread once that commits, so request handlers never wait on (or
+fail because of) the Brevo API. The sender claims due emails in batches (see
+db_helper.claim_outbound_emails), sends them through one Brevo client per
+process (a single pooled HTTP connection set), and records the outcome:
+
+  - emails sharing subject and HTML are sent in one API call with Brevo
+    message versions (per-recipient `params` are substituted by Brevo)
+  - a failed send is retried with exponential backoff and jitter, up to
+    EMAIL_MAX_ATTEMPTS; client errors other than auth/rate limits fail
+    immediately
+  - a dedup key makes queueing the same email twice a no-op
+
+Configuration (environment):
+    BREVO_API_KEY, BREVO_SENDER_NAME, BREVO_SENDER_EMAIL
+    BREVO_API_HOST        https://api.brevo.com/v3 (point it at
+                          fake_brevo_server.py to test locally)
+    EMAIL_SENDER_ENABLED  true
+    EMAIL_BATCH_SIZE      50
+    EMAIL_MAX_ATTEMPTS    8
+    EMAIL_RETRY_BASE      30     seconds, doubled per attempt
+    EMAIL_RETRY_MAX       3600   seconds
+    EMAIL_POLL_INTERVAL   15     seconds between scans for due retries
+"""
+
+import os
+import random
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import sib_api_v3_sdk
+from sib_api_v3_sdk.rest import ApiException
+
+import db_helper
+
+BREVO_API_HOST = os.getenv("BREVO_API_HOST", "https://api.brevo.com/v3")
+EMAIL_SENDER_ENABLED = os.getenv("EMAIL_SENDER_ENABLED", "true").lower() == "true"
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "50"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "8"))
+EMAIL_RETRY_BASE = int(os.getenv("EMAIL_RETRY_BASE", "30"))
+EMAIL_RETRY_MAX = int(os.getenv("EMAIL_RETRY_MAX", "3600"))
+EMAIL_POLL_INTERVAL = int(os.getenv("EMAIL_POLL_INTERVAL", "15"))
+EMAIL_POOL_SIZE = 4
+
+# Brevo accepts at most this many message versions per call
+MAX_MESSAGE_VERSIONS = 1000
+
+# HTTP statuses worth retrying even though they are client errors
+_RETRYABLE_STATUSES = {401, 403, 408, 409, 425, 429}
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Brevo TransactionalEmailsApi shared by the process, or None without BREVO_API_KEY"""
+    global _client, _client_pid
+    with _client_lock:
+        # urllib3 pools must not be shared across a fork
+        if _client is None or _client_pid != os.getpid():
+            api_key = os.getenv("BREVO_API_KEY")
+            if not api_key:
+                return None
+            configuration = sib_api_v3_sdk.Configuration()
+            configuration.api_key['api-key'] = api_key
+            configuration.host = BREVO_API_HOST
+            configuration.connection_pool_maxsize = EMAIL_POOL_SIZE
+            _client = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
+            _client_pid = os.getpid()
+        return _client
+
+
+def _sender():
+    return {
+        "name": os.getenv("BREVO_SENDER_NAME", "RXZBot"),
+        "email": os.getenv("BREVO_SENDER_EMAIL", "noreply@rxzbot.com")
+    }
+
+
+def _recipient(email):
+    recipient = {"email": email["to_email"]}
+    if email["to_name"]:
+        recipient["name"] = email["to_name"]
+    return recipient
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the given number of failed attempts (+/- 20% jitter)"""
+    delay = min(EMAIL_RETRY_MAX, EMAIL_RETRY_BASE * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _is_permanent(error):
+    status = getattr(error, "status", None)
+    return isinstance(error, ApiException) and status is not None and 400 <= status < 500 \
+        and status not in _RETRYABLE_STATUSES
+
+
+def _describe(error):
+    if isinstance(error, ApiException):
+        return f"Brevo API {error.status}: {(error.body or error.reason or '')[:500]}"
+    return f"{type(error).__name__}: {error}"
+
+
+def _send_group(api, emails):
+    """
+    One API call for emails sharing subject and HTML.
+    Returns {email_id: message_id}.
+    """
+    first = emails[0]
+    if len(emails) == 1:
+        response = api.send_transac_email(sib_api_v3_sdk.SendSmtpEmail(
+            sender=_sender(),
+            to=[_recipient(first)],
+            subject=first["subject"],
+            html_content=first["html_content"],
+            params=first["params"] or None
+        ))
+        return {first["id"]: response.message_id}
+
+    response = api.send_transac_email(sib_api_v3_sdk.SendSmtpEmail(
+        sender=_sender(),
+        subject=first["subject"],
+        html_content=first["html_content"],
+        message_versions=[
+            sib_api_v3_sdk.SendSmtpEmailMessageVersions(to=[_recipient(email)], params=email["params"] or None)
+            for email in emails
+        ]
+    ))
+    message_ids = response.message_ids or []
+    return {
+        email["id"]: message_ids[i] if i < len(message_ids) else response.message_id
+        for i, email in enumerate(emails)
+    }
+
+
+def send_batch(emails):
+    """Send claimed emails and record the results; returns (sent, failed) counts"""
+    api = get_client()
+    groups = defaultdict(list)
+    for email in emails:
+        groups[(email["subject"], email["html_content"])].append(email)
+
+    sent, failures = {}, []
+    now = datetime.utcnow()
+    for group in groups.values():
+        for i in range(0, len(group), MAX_MESSAGE_VERSIONS):
+            chunk = group[i:i + MAX_MESSAGE_VERSIONS]
+            try:
+                if api is None:
+                    raise RuntimeError("BREVO_API_KEY not set")
+                sent.update(_send_group(api, chunk))
+            except Exception as e:
+                permanent = _is_permanent(e)
+                for email in chunk:
+                    give_up = permanent or email["attempts"] >= EMAIL_MAX_ATTEMPTS
+                    retry_at = None if give_up else now + timedelta(seconds=retry_delay(email["attempts"]))
+                    failures.append((email["id"], _describe(e), retry_at))
+                    if give_up:
+                        print(f"❌ Email {email['id']} to {email['to_email']} failed for good: {_describe(e)}")
+
+    db_helper.mark_emails_sent(sent)
+    db_helper.mark_emails_failed(failures)
+    if sent or failures:
+        print(f"📧 Emails: {len(sent)} sent, {len(failures)} failed")
+    return len(sent), len(failures)
+
+
+class EmailSender:
+    """Background thread draining the queue; woken on enqueue, polls for retries"""
+
+    def __init__(self, batch_size=EMAIL_BATCH_SIZE, poll_interval=EMAIL_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="email-sender", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_once(self):
+        """Send everything due now; returns (sent, failed) totals"""
+        sent = failed = 0
+        while not self._stop.is_set():
+            emails = db_helper.claim_outbound_emails(self.batch_size)
+            if not emails:
+                break
+            s, f = send_batch(emails)
+            sent, failed = sent + s, failed + f
+            if len(emails) < self.batch_size:
+                break
+        return sent, failed
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"⚠️ Email sender error: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+email_sender = EmailSender()
+
+
+def send_email(to_email, subject, html_content, dedup_key=None, to_name=None, params=None):
+    """
+    Queue an email for background sending. Inside a request it is only sent
+    if the request's database changes commit (see db_helper.enqueue_email).
+    True if it is queued (or was already, for a known dedup_key), False if
+    it couldn't be stored.
+    """
+    queued = db_helper.enqueue_email(
+        to_email, subject, html_content, dedup_key=dedup_key, to_name=to_name, params=params
+    )
+    if queued is None:
+        return False
+    if not queued["duplicate"]:
+        # The row is only visible to the sender once the request commits
+        db_helper.call_after_commit(email_sender.wake)
+    return True
@@ -0,0 +1,83 @@
+"""
+Precompiled transactional email templates.
+
+The HTML lives in templates/emails/ (Jinja, extending emails/base.html) and
+is compiled once at startup with the app's Jinja environment. Each template
+is then rendered a single time with a marker in place of every per-recipient
+field, and the output is split into its static pieces. From those:
+
+  - `brevo_html` puts Brevo `{{ params.field }}` placeholders in the slots.
+    It is what gets queued: every email of a kind has the same HTML, the
+    fields travel as Brevo params, and email_queue batches them into one
+    API call with message versions
+  - `render()` fills the slots with the escaped values locally (previews)
+
+Either way no template code runs per recipient.
+
+Because fields are substituted after rendering, a template may only output
+them directly ({{ field }}); using a field in a condition, loop or filter
+would act on the marker, not the real value.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+# name -> (template file, subject, per-recipient fields)
+EMAIL_TEMPLATES = {
+    "password_reset": ("emails/password_reset.html", "RXZBot password reset request", ("reset_code",)),
+    "purchase_key": ("emails/purchase_key.html", "Your RXZBot Access Key", ("username", "item", "access_key")),
+}
+
+_MARKER = "\x00{}\x00"
+_MARKER_RE = re.compile("\x00([a-z_]+)\x00")
+
+_templates = {}
+
+
+class EmailTemplate:
+    """A rendered email shell with slots for the per-recipient fields"""
+
+    def __init__(self, env, name, subject, fields):
+        self.name = name
+        self.subject = subject
+        self.fields = tuple(fields)
+
+        shell = env.get_template(name).render(**{f: Markup(_MARKER.format(f)) for f in self.fields})
+        pieces = _MARKER_RE.split(shell)
+        # split() alternates static text and captured field names
+        self._static = pieces[0::2]
+        self._slots = pieces[1::2]
+
+        missing = set(self.fields) - set(self._slots)
+        if missing:
+            raise ValueError(f"{name}: fields not output by the template: {', '.join(sorted(missing))}")
+
+        self.brevo_html = self._fill({f: f"{{{{ params.{f} }}}}" for f in self.fields})
+
+    def _fill(self, values):
+        parts = [self._static[0]]
+        for slot, static in zip(self._slots, self._static[1:]):
+            parts.append(values[slot])
+            parts.append(static)
+        return "".join(parts)
+
+    def params(self, **values):
+        """Brevo params for one recipient of brevo_html; values are HTML-escaped"""
+        return {f: str(escape(values[f])) for f in self.fields}
+
+    def render(self, **values):
+        """The email HTML for one recipient; values are HTML-escaped"""
+        return self._fill(self.params(**values))
+
+
+def load_email_templates(env):
+    """Compile and pre-render every email template (call once at startup)"""
+    for key, (name, subject, fields) in EMAIL_TEMPLATES.items():
+        _templates[key] = EmailTemplate(env, name, subject, fields)
+    return _templates
+
+
+def get_email_template(key):
+    """A template loaded by load_email_templates()"""
+    return _templates[key]
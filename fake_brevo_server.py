@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Minimal stand-in for Brevo's transactional email endpoint, to exercise
+email_queue.py locally without sending real mail.
+
+Accepts POST /v3/smtp/email, prints the recipients and subject, and answers
+like Brevo (201 with messageId, or messageIds for message versions).
+--fail-rate makes a share of the calls fail with a 503 to test retries.
+
+Usage:
+    python fake_brevo_server.py [--port 8025] [--fail-rate 0.2]
+    BREVO_API_HOST=http://localhost:8025/v3 BREVO_API_KEY=test python server.py
+"""
+
+import sys
+import json
+import random
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAIL_RATE = 0.0
+
+
+class FakeBrevoHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v3/smtp/email":
+            return self._reply(404, {"code": "not_found", "message": self.path})
+        if not self.headers.get("api-key"):
+            return self._reply(401, {"code": "unauthorized", "message": "Key not found"})
+        if random.random() < FAIL_RATE:
+            print("💥 Simulated failure")
+            return self._reply(503, {"code": "service_unavailable", "message": "simulated"})
+
+        length = int(self.headers.get("Content-Length", 0))
+        email = json.loads(self.rfile.read(length) or b"{}")
+        versions = email.get("messageVersions")
+        if versions:
+            ids = [f"<{uuid.uuid4()}@fake-brevo>" for _ in versions]
+            for version, message_id in zip(versions, ids):
+                to = ", ".join(r["email"] for r in version.get("to", []))
+                print(f"📧 {email.get('subject')!r} -> {to} {version.get('params') or ''} {message_id}")
+            return self._reply(201, {"messageIds": ids})
+
+        message_id = f"<{uuid.uuid4()}@fake-brevo>"
+        to = ", ".join(r["email"] for r in email.get("to", []))
+        print(f"📧 {email.get('subject')!r} -> {to} {message_id}")
+        return self._reply(201, {"messageId": message_id})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    port = 8025
+    if "--port" in sys.argv:
+        port = int(sys.argv[sys.argv.index("--port") + 1])
+    if "--fail-rate" in sys.argv:
+        FAIL_RATE = float(sys.argv[sys.argv.index("--fail-rate") + 1])
+
+    print(f"🧪 Fake Brevo listening on http://localhost:{port}/v3 (fail rate {FAIL_RATE:.0%})")
+    ThreadingHTTPServer(("", port), FakeBrevoHandler).serve_forever()
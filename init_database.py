@@ -1,6 +1,7 @@
 import os
+import enum
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, Integer, Boolean, DateTime, JSON, Text, Numeric
+from sqlalchemy import create_engine, Column, String, Integer, Boolean, Date, DateTime, JSON, Text, Numeric, LargeBinary, Enum
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -22,6 +23,12 @@ class User(Base):
     last_nickname = Column(String(255), nullable=True)
     first_connection_date = Column(String(30), nullable=True)
     last_bot_version = Column(String(20), nullable=True)
+    # Native typed copies of the string dates above (see migrate_native_dates.py).
+    # db_helper writes both; reads and range queries use these.
+    expires_on = Column(Date, nullable=True, index=True)
+    paused_on = Column(Date, nullable=True)
+    first_connected_at = Column(DateTime, nullable=True)
+
 class Key(Base):
     __tablename__ = 'keys'
     
@@ -77,6 +84,13 @@ class Log(Base):
     timestamp = Column(String(30), nullable=False)
     message = Column(Text, nullable=False)
     level = Column(String(10), default='info')
+    # Structured fields for /api/logs/query (all optional); the (field, created_at)
+    # and full-text indexes are created by db_helper.ensure_schema()
+    event = Column(String(50), nullable=True)
+    username = Column(String(255), nullable=True)
+    ip = Column(String(50), nullable=True)
+    # Native UTC time: partition key and retention cutoff (see migrate_log_partitions.py)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 class RecentConnection(Base):
     __tablename__ = 'recent_connections'
@@ -86,6 +100,7 @@ class RecentConnection(Base):
     username = Column(String(255), nullable=False)
     ip = Column(String(50), nullable=False)
     status = Column(String(20), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)  # indexed by db_helper.ensure_schema()
 
 class CustomMessage(Base):
     __tablename__ = 'custom_messages'
@@ -112,21 +127,193 @@ class PasswordReset(Base):
     used = Column(Boolean, default=False)
     used_at = Column(DateTime, nullable=True)
 
+class PurchaseStatus(str, enum.Enum):
+    AWAITING_CONTACT = "Awaiting user contact"
+    AWAITING_TRANSACTION = "Awaiting transaction"
+    COMPLETED = "Completed"
+
+class PurchasePlatform(str, enum.Enum):
+    INSTAGRAM = "Instagram"
+    DISCORD = "Discord"
+    PAYPAL = "PayPal"
+
+def _enum_values(enum_class):
+    return [member.value for member in enum_class]
+
 class Purchase(Base):
     __tablename__ = 'purchases'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(String(255), nullable=False)
     email = Column(String(255), nullable=False, index=True)
-    platform = Column(String(50), nullable=False)  # Instagram, Discord, or PayPal
+    # Stored as VARCHAR (native_enum=False) with the display values, so
+    # existing rows and raw SQL keep working
+    platform = Column(
+        Enum(PurchasePlatform, native_enum=False, length=50, values_callable=_enum_values, validate_strings=True),
+        nullable=False
+    )
     item = Column(String(255), nullable=False)  # e.g. "1 Month"
     currency = Column(String(50), nullable=False)  # roses, gems, or USD
     price = Column(String(255), nullable=False)  # e.g. "350 🌹" or "380 Gems" or "2.00"
     duration = Column(Integer, nullable=True)  # Duration in days (e.g., 30, 60, 90, 365000)
-    status = Column(String(50), default="Awaiting user contact")  # Status tracking
+    status = Column(
+        Enum(PurchaseStatus, native_enum=False, length=50, values_callable=_enum_values, validate_strings=True),
+        default=PurchaseStatus.AWAITING_CONTACT
+    )
     access_key = Column(String(255), nullable=True)  # Generated key after approval
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
+    claimed_by = Column(String(255), nullable=True)  # admin working on it (see db_helper.claim_purchases)
+    claimed_at = Column(DateTime, nullable=True)
+
+# Shop catalog mirrored from Wolvesville. Item tables carry a content_hash of
+# their synced fields so db_helper.save_all_shop_data() only writes changes.
+
+class ShopBundle(Base):
+    __tablename__ = 'shop_bundles'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    type = Column(String(50), nullable=False)
+    cost = Column(Integer, nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    name = Column(String(255), nullable=False)
+    image = Column(String(500), nullable=True)
+    is_new = Column(Boolean, default=False)
+    new_since = Column(String(30), nullable=True)
+    content_hash = Column(String(64), nullable=True)
+    updated_at = Column(String(30), nullable=True)
+
+class ShopSkinSet(Base):
+    __tablename__ = 'shop_skin_sets'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    type = Column(String(50), nullable=False)
+    cost = Column(Integer, nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    name = Column(String(255), nullable=False)
+    expire_date = Column(String(30), nullable=True)
+    item_sets = Column(JSON, default=list)
+    content_hash = Column(String(64), nullable=True)
+    updated_at = Column(String(30), nullable=True)
+
+class ShopDailySkin(Base):
+    __tablename__ = 'shop_daily_skins'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    type = Column(String(50), nullable=False)
+    cost = Column(Integer, nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    name = Column(String(255), nullable=False)
+    image_name = Column(String(255), nullable=True)
+    image_color = Column(String(50), nullable=True)
+    expire_date = Column(String(30), nullable=True)
+    avatar_item_ids = Column(JSON, default=list)
+    content_hash = Column(String(64), nullable=True)
+    updated_at = Column(String(30), nullable=True)
+
+class ShopCalendar(Base):
+    __tablename__ = 'shop_calendars'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    calendar_id = Column(String(100), nullable=False, index=True)
+    title = Column(String(255), nullable=False)
+    cost = Column(Integer, nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
+    description = Column(Text, nullable=True)
+    image_name = Column(String(255), nullable=True)
+    icon_name = Column(String(255), nullable=True)
+    duration_in_days = Column(Integer, nullable=True)
+    owned = Column(Boolean, default=False)
+    content_hash = Column(String(64), nullable=True)
+    updated_at = Column(String(30), nullable=True)
+
+class ShopMetadata(Base):
+    __tablename__ = 'shop_metadata'
+    
+    id = Column(Integer, primary_key=True, default=1)
+    last_updated = Column(String(30), nullable=True)
+    # Pre-serialized catalog served by /api/shop (rebuilt when a sync changes something)
+    snapshot_json = Column(LargeBinary, nullable=True)
+    snapshot_gzip = Column(LargeBinary, nullable=True)
+    snapshot_etag = Column(String(64), nullable=True)
+
+class ShopSettings(Base):
+    __tablename__ = 'shop_settings'
+    
+    id = Column(Integer, primary_key=True, default=1)
+    global_promo_enabled = Column(Boolean, default=False)
+    global_promo_percent = Column(Integer, default=0)
+    global_promo_label = Column(String(255), nullable=True)
+    updated_at = Column(String(30), nullable=True)
+
+class GemAccount(Base):
+    __tablename__ = 'gem_accounts'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    account_number = Column(Integer, nullable=False)
+    email = Column(String(255), unique=True, nullable=False)
+    password = Column(String(255), nullable=False)
+    current_nickname = Column(String(255), nullable=True)
+    gems_remaining = Column(Integer, nullable=False, default=5000)
+    is_active = Column(Boolean, default=True)
+    last_used = Column(String(30), nullable=True)
+
+class GiftCode(Base):
+    __tablename__ = 'gift_codes'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    code = Column(String(32), unique=True, nullable=False)
+    initial_amount = Column(Numeric(10, 2), nullable=True)
+    amount = Column(Numeric(10, 2), nullable=False)  # current balance
+    is_redeemed = Column(Boolean, default=False)
+    redeemed_by = Column(String(255), nullable=True)
+    redeemed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(Date, nullable=True)
+
+class GiftCodeTransaction(Base):
+    """Append-only ledger of every balance change of a gift code"""
+    __tablename__ = 'gift_code_transactions'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    code = Column(String(32), nullable=False)
+    kind = Column(String(20), nullable=False)  # mint, redeem, spend, topup, adjust
+    delta = Column(Numeric(10, 2), nullable=False)
+    balance_after = Column(Numeric(10, 2), nullable=False)
+    username = Column(String(255), nullable=True)
+    note = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class OutboundEmail(Base):
+    """Transactional email waiting to be (or already) sent by email_queue.py"""
+    __tablename__ = 'outbound_emails'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dedup_key = Column(String(255), unique=True, nullable=True)  # same key = same email, queued once
+    to_email = Column(String(255), nullable=False)
+    to_name = Column(String(255), nullable=True)
+    subject = Column(String(255), nullable=False)
+    html_content = Column(Text, nullable=False)
+    params = Column(JSON, nullable=True)  # Brevo {{ params.x }} values for this recipient
+    status = Column(String(20), nullable=False, default="pending")  # pending, sending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    message_id = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+class JobRun(Base):
+    __tablename__ = 'job_runs'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job = Column(String(50), nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    duration_ms = Column(Integer, nullable=False)
+    status = Column(String(20), nullable=False)  # ok, failed, timeout
+    error = Column(Text, nullable=True)
+    worker = Column(String(50), nullable=True)
 
 
 def init_database():
@@ -0,0 +1,132 @@
+"""
+Log policy: decides which log_event() calls are persisted to the database.
+
+Console and the in-memory buffer are cheap and see every line. The
+database sink goes through a LogPolicy with four rules, applied in order:
+
+  1. errors are always written
+  2. events listed in LOG_AGGREGATE_EVENTS are counted instead of written;
+     once per LOG_AGGREGATE_WINDOW seconds each (event, username) pair is
+     written as one summary line ("12x auth_success for X in the last 60s")
+  3. events listed in LOG_SAMPLE_RATES are written with that probability
+  4. at most LOG_USER_RATE_LIMIT lines per username per window; the excess
+     is counted and reported in a summary line
+
+State is per process (each gunicorn worker aggregates its own traffic).
+
+Configuration (environment):
+    LOG_SINKS              console,memory,db
+    LOG_AGGREGATE_EVENTS   auth_success,conn_authorized,xp_add,download
+    LOG_AGGREGATE_WINDOW   60
+    LOG_SAMPLE_RATES       download_attempt=0.05,bot_version=0.1
+    LOG_USER_RATE_LIMIT    20   (0 disables)
+"""
+
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+
+def _parse_list(value):
+    return {item.strip() for item in (value or "").split(",") if item.strip()}
+
+
+def _parse_rates(value):
+    """'event=0.1,other=0.5' -> {"event": 0.1, "other": 0.5} (invalid entries ignored)"""
+    rates = {}
+    for item in _parse_list(value):
+        event, _, rate = item.partition("=")
+        try:
+            rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            print(f"⚠️ Ignoring invalid log sample rate: {item!r}")
+    return rates
+
+
+class LogPolicy:
+    """Sampling, per-user rate limiting and aggregation for persisted logs"""
+
+    def __init__(self, aggregate_events=(), window=60, sample_rates=None, user_limit=0):
+        self.aggregate_events = set(aggregate_events)
+        self.window = window
+        self.sample_rates = dict(sample_rates or {})
+        self.user_limit = user_limit
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._aggregates = defaultdict(int)   # (event, username) -> count
+        self._user_counts = defaultdict(int)  # username -> lines written this window
+        self._suppressed = defaultdict(int)   # username -> lines dropped by the rate limit
+        self.stats = defaultdict(int)         # decision -> count, for monitoring
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            aggregate_events=_parse_list(os.getenv(
+                "LOG_AGGREGATE_EVENTS", "auth_success,conn_authorized,xp_add,download"
+            )),
+            window=int(os.getenv("LOG_AGGREGATE_WINDOW", "60")),
+            sample_rates=_parse_rates(os.getenv(
+                "LOG_SAMPLE_RATES", "download_attempt=0.05,bot_version=0.1"
+            )),
+            user_limit=int(os.getenv("LOG_USER_RATE_LIMIT", "20"))
+        )
+
+    def admit(self, level, event=None, username=None):
+        """True if this line should be written to the database now"""
+        with self._lock:
+            if level == "error":
+                return self._count("error")
+
+            if event in self.aggregate_events:
+                self._aggregates[(event, username)] += 1
+                self.stats["aggregated"] += 1
+                return False
+
+            rate = self.sample_rates.get(event)
+            if rate is not None and random.random() >= rate:
+                self.stats["sampled_out"] += 1
+                return False
+
+            if username and self.user_limit:
+                if self._user_counts[username] >= self.user_limit:
+                    self._suppressed[username] += 1
+                    self.stats["rate_limited"] += 1
+                    return False
+                self._user_counts[username] += 1
+
+            return self._count("written")
+
+    def _count(self, decision):
+        self.stats[decision] += 1
+        return True
+
+    def drain(self, force=False):
+        """
+        Summary lines for the window that just ended, as
+        (level, event, username, message) tuples; empty until the window is
+        over unless `force` (e.g. at shutdown).
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._window_start < self.window:
+                return []
+            elapsed = int(now - self._window_start)
+            summaries = []
+            for (event, username), count in sorted(self._aggregates.items(), key=lambda i: -i[1]):
+                who = f" for {username}" if username else ""
+                summaries.append(("info", event, username, f"{count}x {event}{who} in the last {elapsed}s"))
+            for username, count in self._suppressed.items():
+                summaries.append((
+                    "warn", "log_rate_limited", username,
+                    f"{count} log lines for {username} suppressed by the rate limit in the last {elapsed}s"
+                ))
+            self._aggregates.clear()
+            self._user_counts.clear()
+            self._suppressed.clear()
+            self._window_start = now
+            return summaries
+
+
+LOG_SINKS = _parse_list(os.getenv("LOG_SINKS", "console,memory,db"))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Backfill gift_codes.initial_amount for codes created before the column
+existed, from their current balance (the best value still known for them).
+
+The column is created by db_helper.ensure_schema(). Rows are updated in
+id-ordered chunks (one short transaction each), so the tool can run against
+a live database and be re-run safely.
+
+Usage: python migrate_gift_codes.py [--chunk-size N]
+"""
+
+import sys
+from sqlalchemy import select
+
+import db_helper
+from db_helper import engine
+from init_database import GiftCode
+
+gift_codes = GiftCode.__table__
+
+
+def backfill_initial_amounts(chunk_size=1000):
+    """Copy amount into initial_amount where it is missing; returns the row count"""
+    print("=" * 60)
+    print("🎁 BACKFILL GIFT CODE INITIAL AMOUNTS")
+    print("=" * 60)
+
+    print("\n📋 Ensuring columns and indexes exist...")
+    db_helper.ensure_schema()
+
+    updated = 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(
+                select(gift_codes.c.id)
+                .where(gift_codes.c.initial_amount.is_(None), gift_codes.c.id > last_id)
+                .order_by(gift_codes.c.id)
+                .limit(chunk_size)
+            ).scalars().all()
+            if not ids:
+                break
+            updated += conn.execute(
+                gift_codes.update()
+                .where(gift_codes.c.id.in_(ids), gift_codes.c.initial_amount.is_(None))
+                .values(initial_amount=gift_codes.c.amount)
+            ).rowcount
+            last_id = ids[-1]
+
+        print(f"   💾 {updated} rows updated (up to id {last_id})")
+
+    print(f"\n✅ Backfill complete: {updated} rows updated")
+    return updated
+
+
+if __name__ == "__main__":
+    chunk = 1000
+    if "--chunk-size" in sys.argv:
+        chunk = int(sys.argv[sys.argv.index("--chunk-size") + 1])
+    backfill_initial_amounts(chunk)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Convert `logs` and `recent_connections` into tables range-partitioned on
+created_at, so db_helper.prune_logs() can drop whole partitions instead of
+running DELETEs.
+
+For each table that isn't partitioned yet:
+  1. backfill created_at from the legacy "YYYY-MM-DD HH:MM:SSZ" string
+     (stored in CET, UTC+1) for rows written before the column existed
+  2. in one short transaction: rename the table to <table>_legacy, create the
+     partitioned table under the original name (reusing the id sequence) with
+     partitions from the retention cutoff up to a few periods ahead, plus a
+     default partition
+  3. copy the rows still inside the retention window in id-ordered chunks
+  4. drop <table>_legacy
+
+New writes go to the partitioned table as soon as step 2 commits; history
+reappears progressively while step 3 runs. Safe to re-run: partitioned
+tables are skipped.
+
+Usage: python migrate_log_partitions.py [--chunk-size N]
+"""
+
+import re
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+import db_helper
+from db_helper import engine, LOG_RETENTION
+
+# Column definitions of the partitioned tables; the primary key has to
+# include the partition key
+_TABLE_DDL = {
+    "logs": """
+        id INTEGER NOT NULL DEFAULT nextval('logs_id_seq'),
+        timestamp VARCHAR(30) NOT NULL,
+        message TEXT NOT NULL,
+        level VARCHAR(10) DEFAULT 'info',
+        event VARCHAR(50),
+        username VARCHAR(255),
+        ip VARCHAR(50),
+        created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        PRIMARY KEY (id, created_at)
+    """,
+    "recent_connections": """
+        id INTEGER NOT NULL DEFAULT nextval('recent_connections_id_seq'),
+        timestamp VARCHAR(30) NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        ip VARCHAR(50) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        PRIMARY KEY (id, created_at)
+    """,
+}
+
+_COLUMNS = {
+    "logs": "id, timestamp, message, level, event, username, ip, created_at",
+    "recent_connections": "id, timestamp, username, ip, status, created_at",
+}
+
+
+def _schema_indexes(table):
+    """Names of the indexes db_helper._SCHEMA_STATEMENTS creates on `table`"""
+    pattern = re.compile(rf"CREATE (?:UNIQUE )?INDEX IF NOT EXISTS (\w+) ON {table}\b")
+    return [m.group(1) for m in map(pattern.search, db_helper._SCHEMA_STATEMENTS) if m]
+
+
+# Indexes that have to move to the new table; derived from the schema
+# statements so an index added there can't be left behind on the legacy table
+_LEGACY_INDEXES = {table: _schema_indexes(table) for table in _TABLE_DDL}
+
+
+def backfill_created_at(table):
+    """Fill created_at from the CET timestamp string; unparseable rows get now()"""
+    with engine.begin() as conn:
+        parsed = conn.execute(text(
+            f"UPDATE {table} SET created_at = "
+            f"to_timestamp(substr(timestamp, 1, 19), 'YYYY-MM-DD HH24:MI:SS')::timestamp - interval '1 hour' "
+            f"WHERE created_at IS NULL AND timestamp ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}} \\d{{2}}:\\d{{2}}:\\d{{2}}'"
+        )).rowcount
+        fallback = conn.execute(text(
+            f"UPDATE {table} SET created_at = now() AT TIME ZONE 'utc' WHERE created_at IS NULL"
+        )).rowcount
+    print(f"   📅 created_at backfilled: {parsed} parsed, {fallback} set to now")
+
+
+def partition_table(table, chunk_size=5000):
+    interval, days = LOG_RETENTION[table]
+    legacy = f"{table}_legacy"
+
+    with engine.connect() as conn:
+        if db_helper.is_partitioned(conn, table):
+            print(f"✅ {table} is already partitioned, skipping")
+            return
+
+    print(f"\n📋 Partitioning {table} by {interval} (retention {days} days)...")
+    backfill_created_at(table)
+
+    today = datetime.utcnow().date()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    start = db_helper.period_start(cutoff.date(), interval)
+    last = db_helper.period_start(today, interval)
+    for _ in range(db_helper.LOG_PARTITIONS_AHEAD):
+        last = db_helper.next_period(last, interval)
+
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        conn.execute(text(f"CREATE TABLE {table} ({_TABLE_DDL[table]}) PARTITION BY RANGE (created_at)"))
+        # Keep the id sequence alive when the legacy table is dropped
+        conn.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+        conn.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+        # Index names moved with the legacy table; drop them there so
+        # ensure_schema() recreates them on the new parent
+        for index in _LEGACY_INDEXES.get(table, []):
+            conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+        count = 0
+        period = start
+        while period <= last:
+            db_helper.create_partition(conn, table, period, interval)
+            period = db_helper.next_period(period, interval)
+            count += 1
+    print(f"   🧱 Created {table} with {count} partitions")
+    db_helper.ensure_schema()
+
+    copied = 0
+    last_id = -1
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(text(
+                f"INSERT INTO {table} ({_COLUMNS[table]}) "
+                f"SELECT {_COLUMNS[table]} FROM {legacy} "
+                f"WHERE id > :last_id AND created_at >= :cutoff ORDER BY id LIMIT :chunk "
+                f"RETURNING id"
+            ), {"last_id": last_id, "cutoff": cutoff, "chunk": chunk_size}).scalars().all()
+        if not ids:
+            break
+        copied += len(ids)
+        last_id = max(ids)
+        print(f"   💾 {copied} rows copied (up to id {last_id})")
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE {legacy}"))
+    print(f"✅ {table}: {copied} rows kept, rows older than {cutoff:%Y-%m-%d} dropped with {legacy}")
+
+
+if __name__ == "__main__":
+    chunk = 5000
+    if "--chunk-size" in sys.argv:
+        chunk = int(sys.argv[sys.argv.index("--chunk-size") + 1])
+
+    print("=" * 60)
+    print("🗂️  PARTITION LOG TABLES")
+    print("=" * 60)
+    for name in LOG_RETENTION:
+        partition_table(name, chunk)
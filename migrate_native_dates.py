@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Backfill the native date columns on `users` from the legacy string columns:
+
+    expires               (YYYY-MM-DD)          -> expires_on          DATE
+    paused_at             (YYYY-MM-DD)          -> paused_on           DATE
+    first_connection_date (YYYY-MM-DD HH:MM:SS) -> first_connected_at  TIMESTAMP
+
+The columns and the expires_on index are created by db_helper.ensure_schema().
+Rows are converted in keyset-ordered chunks (one short transaction each), so the
+tool can run against a live database and be re-run safely; rows whose strings
+don't parse are reported and left NULL.
+
+Usage: python migrate_native_dates.py [--chunk-size N]
+"""
+
+import sys
+from sqlalchemy import select, update, bindparam
+
+import db_helper
+from db_helper import engine, to_date, to_datetime
+from init_database import User
+
+users = User.__table__
+
+_UPDATE_DATES = (
+    update(users)
+    .where(users.c.username == bindparam('b_username'))
+    .values(
+        expires_on=bindparam('b_expires_on'),
+        paused_on=bindparam('b_paused_on'),
+        first_connected_at=bindparam('b_first_connected_at')
+    )
+)
+
+
+def backfill_dates(chunk_size=1000):
+    """Convert all rows still missing expires_on; returns (converted, invalid)"""
+    print("=" * 60)
+    print("📅 BACKFILL NATIVE DATE COLUMNS")
+    print("=" * 60)
+
+    print("\n📋 Ensuring columns and indexes exist...")
+    db_helper.ensure_schema()
+
+    converted = 0
+    invalid = []
+    last_username = ""
+
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(users.c.username, users.c.expires, users.c.paused_at, users.c.first_connection_date)
+                .where(users.c.expires_on.is_(None), users.c.username > last_username)
+                .order_by(users.c.username)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+
+            params = []
+            for username, expires, paused_at, first_connection_date in rows:
+                expires_on = to_date(expires)
+                if expires_on is None:
+                    invalid.append((username, expires))
+                    continue
+                params.append({
+                    "b_username": username,
+                    "b_expires_on": expires_on,
+                    "b_paused_on": to_date(paused_at),
+                    "b_first_connected_at": to_datetime(first_connection_date)
+                })
+
+            if params:
+                conn.execute(_UPDATE_DATES, params)
+            converted += len(params)
+            last_username = rows[-1][0]
+
+        print(f"   💾 {converted} rows converted (up to '{last_username}')")
+
+    print(f"\n✅ Backfill complete: {converted} rows converted")
+    if invalid:
+        print(f"⚠️  {len(invalid)} rows have an unparseable expiry and were left NULL:")
+        for username, expires in invalid[:50]:
+            print(f"   - {username}: {expires!r}")
+    return converted, len(invalid)
+
+
+if __name__ == "__main__":
+    chunk = 1000
+    if "--chunk-size" in sys.argv:
+        chunk = int(sys.argv[sys.argv.index("--chunk-size") + 1])
+    backfill_dates(chunk)
@@ -0,0 +1,142 @@
+"""
+Compact, immutable row records returned by db_helper.
+
+Each record keeps its values in __slots__ (no per-instance dict), supports the
+read-only mapping access the routes already use (`rec["expires"]`,
+`rec.get("paused")`) and is serialized directly by RecordJSONProvider.
+Use `rec.replace(field=value)` to get a modified copy.
+
+`_fields` lists the names exposed through mapping access and JSON; it
+defaults to __slots__ but may include derived properties.
+"""
+
+from datetime import datetime
+from flask.json.provider import DefaultJSONProvider
+
+
+class Record:
+    """Base class for immutable __slots__ records"""
+    __slots__ = ()
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if '_fields' not in cls.__dict__:
+            cls._fields = cls.__slots__
+
+    def __init__(self, *args, **kwargs):
+        names = self.__slots__
+        if len(args) > len(names):
+            raise TypeError(f"{type(self).__name__} takes at most {len(names)} values")
+        for name, value in zip(names, args):
+            object.__setattr__(self, name, value)
+        for name in names[len(args):]:
+            object.__setattr__(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} got unexpected fields: {', '.join(kwargs)}")
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+    # --- read-only mapping access ---
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        if key not in self._fields:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self._fields
+
+    # --- helpers ---
+
+    def to_dict(self):
+        """Plain dict copy (used for JSON serialization)"""
+        return {name: getattr(self, name) for name in self._fields}
+
+    def replace(self, **changes):
+        """Return a copy with the given fields changed"""
+        values = [changes.pop(name, getattr(self, name)) for name in self.__slots__]
+        if changes:
+            raise TypeError(f"{type(self).__name__} got unexpected fields: {', '.join(changes)}")
+        return type(self)(*values)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class LicenseRecord(Record):
+    """One row of the users table.
+
+    The expiry is held as a native date (`expires_on`); `expires` is the
+    YYYY-MM-DD string the API has always returned.
+    """
+    __slots__ = (
+        "username", "player_id", "expires_on", "paused", "paused_at",
+        "remaining_days", "last_nickname", "first_connection_date"
+    )
+    _fields = (
+        "username", "player_id", "expires", "paused", "paused_at",
+        "remaining_days", "last_nickname", "first_connection_date"
+    )
+
+    @property
+    def expires(self):
+        return self.expires_on.isoformat() if self.expires_on else None
+
+    def is_active(self, today=None):
+        """True while the expiry date is still ahead (expires at 00:00 of that day)"""
+        if self.expires_on is None:
+            return False
+        return self.expires_on > (today or datetime.now().date())
+
+
+class KeyRecord(Record):
+    """One activation key"""
+    __slots__ = ("code", "duration", "created", "used", "used_by", "used_at")
+
+
+class TestimonialRecord(Record):
+    """One testimonial"""
+    __slots__ = ("id", "username", "rating", "comment", "anonymous", "date", "approved")
+
+
+class PurchaseRecord(Record):
+    """One purchase (Roses/Gems or PayPal), timestamps pre-formatted"""
+    __slots__ = (
+        "id", "username", "email", "platform", "item", "currency", "price",
+        "duration", "status", "access_key", "created_at", "updated_at",
+        "claimed_by", "claimed_at"
+    )
+
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes records straight from their slots"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Record):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
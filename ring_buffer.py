@@ -0,0 +1,244 @@
+"""
+Fixed-layout ring buffers shared by all gunicorn workers through an mmap'd
+file (in /dev/shm when available), used for the recent logs and connection
+attempts shown in the admin panel.
+
+Layout:
+
+    file header  64 bytes   magic, version, slot size, capacity, regions
+    region i     64 bytes   head (number of records ever written)
+                 capacity x slot
+    slot                    gen (Q) | ts_ns (q) | length (I) | JSON payload
+
+Each worker process claims a region of its own (a non-blocking fcntl lock
+on one byte of the region, held for the life of the process and released
+by the kernel when it dies), so appends are single-writer and take no
+cross-process lock. Readers never lock either: a slot is published by
+writing its generation last, and a reader keeps a slot only if the
+generation is the expected one before and after copying the payload
+(seqlock style), then merges all regions newest first.
+
+When every region is taken, the last one is shared and its writers
+serialize on a blocking lock. If the shared file can't be set up at all
+(no fcntl, read-only filesystem...), RingBuffer falls back to a
+process-local deque with the same interface.
+"""
+
+import os
+import json
+import mmap
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX: process-local fallback only
+    fcntl = None
+
+_MAGIC = b"RXRB"
+_VERSION = 1
+_FILE_HEADER = struct.Struct("<4sIIII")  # magic, version, slot_size, capacity, regions
+_HEADER_SIZE = 64
+_REGION_HEADER_SIZE = 64
+_HEAD = struct.Struct("<Q")
+_SLOT_HEADER = struct.Struct("<QqI")  # gen, ts_ns, length
+
+
+def _fit(record, limit):
+    """JSON-encode `record`, shortening its longest strings until it fits in `limit` bytes"""
+    payload = json.dumps(record, default=str, separators=(",", ":")).encode()
+    record = dict(record)
+    while len(payload) > limit:
+        strings = [k for k, v in record.items() if isinstance(v, str) and v]
+        if not strings:
+            return None
+        key = max(strings, key=lambda k: len(record[k]))
+        excess = len(payload) - limit
+        record[key] = record[key][:max(0, len(record[key]) - excess - 3)] + "…"
+        payload = json.dumps(record, default=str, separators=(",", ":")).encode()
+    return payload
+
+
+class _LocalRing:
+    """Process-local fallback with the same interface as RingBuffer"""
+
+    def __init__(self, capacity):
+        self._items = deque(maxlen=capacity)
+
+    def append(self, record):
+        self._items.appendleft(record)
+
+    def latest(self, limit=None):
+        items = list(self._items)
+        return items[:limit] if limit else items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RingBuffer:
+    """Newest-first ring of small JSON records shared across processes"""
+
+    def __init__(self, name, capacity=500, slot_size=512, regions=None, directory=None):
+        self.name = name
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.regions = regions or int(os.getenv("RING_BUFFER_REGIONS", "16"))
+        directory = directory or os.getenv("RING_BUFFER_DIR") or (
+            "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        )
+        # The layout (format version and sizes) is part of the name so a deploy
+        # or config change never resizes a file other processes still have mapped
+        self.path = os.path.join(
+            directory, f"rxzbot-ring-v{_VERSION}-{name}-{capacity}x{slot_size}x{self.regions}"
+        )
+        self._region_size = _REGION_HEADER_SIZE + capacity * slot_size
+        self._size = _HEADER_SIZE + self.regions * self._region_size
+        self._lock = threading.Lock()
+        self._owner_pid = None
+        self._region = None
+        self._shared_region = False
+        self._local = None
+        try:
+            if fcntl is None:
+                raise OSError("fcntl not available")
+            self._open()
+        except Exception as e:
+            print(f"⚠️ Shared ring '{name}' unavailable ({e}), using process-local buffer")
+            self._local = _LocalRing(capacity)
+
+    # --- setup ---
+
+    def _open(self):
+        expected = _FILE_HEADER.pack(_MAGIC, _VERSION, self.slot_size, self.capacity, self.regions)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            # One-time initialisation under a whole-file lock
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue  # replaced while we waited for the lock: open the new file
+                size = os.fstat(fd).st_size
+                if size == 0:
+                    # Brand new: nobody maps it before it is initialised
+                    os.ftruncate(fd, self._size)
+                    os.pwrite(fd, expected, 0)
+                elif os.pread(fd, _FILE_HEADER.size, 0) != expected or size != self._size:
+                    # Foreign or damaged file: it may still be mapped somewhere,
+                    # so put a fresh one in its place instead of resizing it
+                    self._replace(expected)
+                    continue
+                self._fd, fd = fd, None
+            finally:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            break
+        self._mm = mmap.mmap(self._fd, self._size)
+
+    def _replace(self, header):
+        """Atomically swap in a new, initialised file at self.path"""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self._size)
+            os.pwrite(fd, header, 0)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.path)
+
+    def _region_offset(self, region):
+        return _HEADER_SIZE + region * self._region_size
+
+    def _claim_region(self):
+        """Take a region for this process (redone after a fork)"""
+        pid = os.getpid()
+        if self._owner_pid == pid:
+            return
+        self._region, self._shared_region = None, False
+        for region in range(self.regions - 1):
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self._region_offset(region), os.SEEK_SET)
+            except OSError:
+                continue
+            self._region = region
+            break
+        if self._region is None:
+            # Every private region is in use: share the last one
+            self._region, self._shared_region = self.regions - 1, True
+        self._owner_pid = pid
+
+    # --- writing ---
+
+    def append(self, record):
+        """Add a record (a JSON-serializable dict); never raises"""
+        if self._local is not None:
+            self._local.append(record)
+            return
+        payload = _fit(record, self.slot_size - _SLOT_HEADER.size)
+        if payload is None:
+            return
+        try:
+            with self._lock:
+                self._claim_region()
+                offset = self._region_offset(self._region)
+                if self._shared_region:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset, os.SEEK_SET)
+                try:
+                    self._write(offset, payload)
+                finally:
+                    if self._shared_region:
+                        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset, os.SEEK_SET)
+        except Exception as e:
+            print(f"⚠️ Ring '{self.name}' append failed: {e}")
+
+    def _write(self, region_offset, payload):
+        mm = self._mm
+        (head,) = _HEAD.unpack_from(mm, region_offset)
+        slot = region_offset + _REGION_HEADER_SIZE + (head % self.capacity) * self.slot_size
+        _HEAD.pack_into(mm, slot, 0)  # unpublish while the slot is rewritten
+        body = slot + _SLOT_HEADER.size
+        mm[body:body + len(payload)] = payload
+        _SLOT_HEADER.pack_into(mm, slot, 0, time.time_ns(), len(payload))
+        _HEAD.pack_into(mm, slot, head + 1)  # publish: generation = record number + 1
+        _HEAD.pack_into(mm, region_offset, head + 1)
+
+    # --- reading ---
+
+    def _read_region(self, region):
+        mm = self._mm
+        region_offset = self._region_offset(region)
+        (head,) = _HEAD.unpack_from(mm, region_offset)
+        records = []
+        for number in range(max(0, head - self.capacity), head):
+            slot = region_offset + _REGION_HEADER_SIZE + (number % self.capacity) * self.slot_size
+            gen, ts, length = _SLOT_HEADER.unpack_from(mm, slot)
+            if gen != number + 1 or length > self.slot_size - _SLOT_HEADER.size:
+                continue  # being rewritten or already overwritten
+            body = slot + _SLOT_HEADER.size
+            payload = mm[body:body + length]
+            if _HEAD.unpack_from(mm, slot)[0] != gen:
+                continue  # changed while we copied it
+            try:
+                records.append((ts, json.loads(payload)))
+            except ValueError:
+                continue
+        return records
+
+    def latest(self, limit=None):
+        """Most recent records across all processes, newest first"""
+        if self._local is not None:
+            return self._local.latest(limit)
+        limit = limit or self.capacity
+        records = []
+        for region in range(self.regions):
+            records.extend(self._read_region(region))
+        records.sort(key=lambda item: item[0], reverse=True)
+        return [record for _, record in records[:limit]]
+
+    def __len__(self):
+        return len(self.latest())
@@ -0,0 +1,235 @@
+"""
+Background job scheduler shared by all gunicorn workers.
+
+Every worker runs an APScheduler BackgroundScheduler with the same jobs, but
+jobs marked leader_only execute on one worker only: the leader, i.e. the
+process holding a Postgres session-level advisory lock on a dedicated
+connection. The lock is released by Postgres when that connection (or the
+process) dies, so another worker picks the role up on its next run. Per-worker
+jobs (flushing in-process counters) run everywhere.
+
+Each job gets:
+  - an interval with random jitter, so workers and jobs don't fire in lockstep
+    (the first run is also delayed by a random fraction of the jitter)
+  - coalescing and max_instances=1 (missed runs collapse into one)
+  - a timeout: the run is reported as "timeout" and the job is skipped until
+    the stuck call returns (a Python thread can't be killed)
+  - run history: per-job counters and recent runs in memory, and leader runs
+    persisted to the job_runs table
+
+Configuration (environment):
+    SCHEDULER_ENABLED        true
+    SCHEDULER_LOCK_KEY       7235674  (advisory lock id, shared by all workers)
+"""
+
+import os
+import random
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from sqlalchemy import text
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_LOCK_KEY = int(os.getenv("SCHEDULER_LOCK_KEY", "7235674"))
+JOB_HISTORY_SIZE = 200
+
+
+class LeaderLock:
+    """Session-level pg_try_advisory_lock held on a connection of its own"""
+
+    def __init__(self, engine, key=SCHEDULER_LOCK_KEY):
+        self.engine = engine
+        self.key = key
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_leader(self):
+        return self._conn is not None
+
+    def check(self):
+        """True if this process is the leader (acquiring the lock if it is free)"""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.execute(text("SELECT 1"))
+                    return True
+                except Exception as e:
+                    # Connection lost: Postgres released the lock with it
+                    print(f"⚠️ Scheduler leader connection lost: {e}")
+                    self._close()
+            try:
+                conn = self.engine.connect()
+                # Autocommit so the idle connection doesn't hold a transaction open
+                conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar()
+            except Exception as e:
+                print(f"⚠️ Scheduler leader election failed: {e}")
+                return False
+            if acquired:
+                self._conn = conn
+                print(f"👑 Worker {os.getpid()} is the scheduler leader")
+                return True
+            conn.close()
+            return False
+
+    def release(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+                except Exception:
+                    pass
+                self._close()
+
+    def _close(self):
+        try:
+            self._conn.invalidate()
+        except Exception:
+            pass
+        self._conn = None
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter, timeout, leader_only):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.leader_only = leader_only
+        self.running = False
+        self.stats = {
+            "runs": 0, "ok": 0, "failed": 0, "timeouts": 0, "skipped": 0,
+            "last_status": None, "last_started": None, "last_duration_ms": None,
+            "last_error": None, "total_duration_ms": 0
+        }
+
+
+class JobScheduler:
+    """APScheduler wrapper adding leader election, timeouts and run history"""
+
+    def __init__(self, engine, record_run=None):
+        self.leader = LeaderLock(engine)
+        self.record_run = record_run  # callable(job, started_at, duration_ms, status, error)
+        self.jobs = {}
+        self.history = deque(maxlen=JOB_HISTORY_SIZE)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="job")
+        self._scheduler = BackgroundScheduler(
+            daemon=True,
+            job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 300}
+        )
+
+    def add_job(self, name, func, interval, jitter=0, timeout=60, leader_only=True):
+        """Run `func()` every `interval` seconds (+/- up to `jitter`)"""
+        job = Job(name, func, interval, jitter, timeout, leader_only)
+        self.jobs[name] = job
+        first_run = datetime.now() + timedelta(seconds=random.uniform(0, jitter or interval))
+        self._scheduler.add_job(
+            self._run, IntervalTrigger(seconds=interval, jitter=jitter or None),
+            args=[name], id=name, name=name, next_run_time=first_run
+        )
+
+    def start(self):
+        self._scheduler.start()
+        print(f"⏰ Scheduler started with {len(self.jobs)} jobs: {', '.join(self.jobs)}")
+
+    def shutdown(self):
+        try:
+            self._scheduler.shutdown(wait=False)
+        except Exception:
+            pass
+        self._executor.shutdown(wait=False)
+        self.leader.release()
+
+    def run_now(self, name):
+        """Run a job immediately in the calling thread (leader rule and timeout apply)"""
+        if name not in self.jobs:
+            raise KeyError(name)
+        return self._run(name)
+
+    def _run(self, name):
+        job = self.jobs[name]
+        with self._lock:
+            if job.leader_only and not self.leader.check():
+                job.stats["skipped"] += 1
+                return {"job": name, "status": "not_leader"}
+            if job.running:
+                # A previous run timed out and is still going
+                job.stats["skipped"] += 1
+                return {"job": name, "status": "still_running"}
+            job.running = True
+
+        started_at = datetime.utcnow()
+        start = time.monotonic()
+        future = self._executor.submit(job.func)
+        result = error = None
+        try:
+            result = future.result(timeout=job.timeout)
+            status = "ok"
+        except FutureTimeout:
+            status, error = "timeout", f"no result after {job.timeout}s"
+        except Exception as e:
+            status, error = "failed", f"{type(e).__name__}: {e}"
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+        if status == "timeout":
+            future.add_done_callback(lambda _: setattr(job, "running", False))
+        else:
+            job.running = False
+
+        duration_ms = int((time.monotonic() - start) * 1000)
+        self._record(job, started_at, duration_ms, status, error)
+        if status != "ok":
+            print(f"⚠️ Job {name} {status}: {error}")
+        return {"job": name, "status": status, "duration_ms": duration_ms, "result": result, "error": error}
+
+    def _record(self, job, started_at, duration_ms, status, error):
+        stats = job.stats
+        stats["runs"] += 1
+        stats["ok" if status == "ok" else "timeouts" if status == "timeout" else "failed"] += 1
+        stats["total_duration_ms"] += duration_ms
+        stats.update(
+            last_status=status, last_started=started_at.isoformat() + "Z",
+            last_duration_ms=duration_ms, last_error=error
+        )
+        self.history.appendleft({
+            "job": job.name, "started_at": started_at.isoformat() + "Z",
+            "duration_ms": duration_ms, "status": status, "error": error
+        })
+        if job.leader_only and self.record_run:
+            try:
+                self.record_run(job.name, started_at, duration_ms, status, error)
+            except Exception as e:
+                print(f"⚠️ Could not record run of {job.name}: {e}")
+
+    def status(self):
+        """Jobs, their schedule and counters, and this worker's recent runs"""
+        jobs = []
+        for name, job in self.jobs.items():
+            scheduled = self._scheduler.get_job(name)
+            next_run = scheduled.next_run_time if scheduled else None
+            jobs.append({
+                "name": name,
+                "interval": job.interval,
+                "jitter": job.jitter,
+                "timeout": job.timeout,
+                "leader_only": job.leader_only,
+                "running": job.running,
+                "next_run": next_run.isoformat() if next_run else None,
+                **job.stats
+            })
+        return {
+            "worker": os.getpid(),
+            "leader": self.leader.is_leader,
+            "running": self._scheduler.running,
+            "jobs": jobs,
+            "recent": list(self.history)[:50]
+        }
@@ -7,12 +7,14 @@ import time
 import threading
 import secrets
 import string
-from datetime import datetime, timedelta
-from collections import deque
+import csv
+import io
+from datetime import datetime, date, timedelta
 from functools import wraps
 from flask import (
     Flask, request, jsonify, render_template,
-    redirect, url_for, session, send_from_directory, make_response, abort, send_file
+    redirect, url_for, session, send_from_directory, make_response, abort, send_file,
+    Response, stream_with_context, stream_template
 )
 from flask_cors import CORS
 import paypalrestsdk
@@ -25,8 +27,6 @@ import html
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import sib_api_v3_sdk
-from sib_api_v3_sdk.rest import ApiException
 from wolvesville_api import wolvesville_api
 from token_manager import token_manager
 import db_helper
@@ -47,8 +47,15 @@ from db_helper import (
     get_custom_message, set_custom_message,
     get_latest_bot_version, set_latest_bot_version, update_user_bot_version,
     create_purchase, get_purchase, get_all_purchases_for_admin, update_purchase_status, update_purchase_with_key, get_pending_purchases,
-    create_paypal_purchase, get_all_paypal_purchases
+    create_paypal_purchase, get_all_paypal_purchases,
+    PurchaseStatus, PurchasePlatform
 )
+from records import RecordJSONProvider
+from ring_buffer import RingBuffer
+from log_policy import LogPolicy, LOG_SINKS
+from scheduler import JobScheduler, SCHEDULER_ENABLED
+from email_queue import send_email, email_sender, EMAIL_SENDER_ENABLED
+from email_templates import load_email_templates, get_email_template
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 load_dotenv()  # load .env file if it exists (for local development)
@@ -64,6 +71,7 @@ else:
 # Configuration
 # -----------------------
 app = Flask(__name__, static_folder="static", template_folder="templates")
+app.json = RecordJSONProvider(app)  # serialize db_helper records without dict copies
 CORS(app, 
      resources={
          r"/*": {
@@ -75,6 +83,9 @@ CORS(app,
          }
      })
 
+# One DB session + one commit per request instead of one per db_helper call
+db_helper.init_request_session(app)
+
 app.wsgi_app = ProxyFix(
     app.wsgi_app,
     x_for=1,
@@ -213,8 +224,12 @@ CET_OFFSET = timedelta(hours=1)  # CET = UTC+1 in winter
 # Storage helper functions — use DB-backed `db_helper` instead.
 
 def generate_key():
-    """Generate a random 6-character key with uppercase, lowercase, and numbers."""
-    characters = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    """Generate a random 6-character key of uppercase letters and digits.
+
+    Redemption is case-insensitive, so codes are minted in a single case to
+    keep every code distinct under lower(code).
+    """
+    characters = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(characters) for _ in range(6))
 
 def find_key(keys, key_code):
@@ -247,9 +262,6 @@ def get_wolvesville_player_profile(player_id):
     """Get player profile using managed tokens"""
     return wolvesville_api.get_player_profile(player_id)
 
-
-def parse_date(s):
-    return datetime.strptime(s, "%Y-%m-%d")
         
 # -----------------------
 # Key redemption routes
@@ -265,65 +277,35 @@ def redeem():
         if not key_code or not username:
             return render_template("redeem.html", error="Key and username are required")
         
-        # Load keys
-        keys = load_keys()
-        # Case-insensitive key lookup
-        key = None
-        for k in keys:
-            if k["code"].lower() == key_code.lower():
-                key = k
-                break
-        
-        if not key:
-            log_event(f"redeem fail: key '{key_code}' not found", level="warn")
+        # Claim the key and extend the license in one transaction
+        result = db_helper.redeem_key(
+            key_code,
+            username,
+            (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
+        )
+        status = result["status"]
+
+        if status == "invalid":
+            log_event(f"redeem fail: key '{key_code}' not found", level="warn", event="redeem_fail", username=username)
             return render_template("redeem.html", error="Invalid key")
         
-        if key.get("used"):
-            log_event(f"redeem fail: key '{key_code}' already used", level="warn")
+        if status == "used":
+            log_event(f"redeem fail: key '{key_code}' already used", level="warn", event="redeem_fail", username=username)
             return render_template("redeem.html", error="This key has already been used")
-        
-        # Activate the key
-        days = key["duration"]
-        users = load_users()
-        existing = find_user(users, username)
-
-        today = datetime.now()
 
-        if existing:
-            # User exists - check if license is still valid or expired
-            try:
-                current_expires = datetime.strptime(existing["expires"], "%Y-%m-%d")
-                
-                # If license is still valid, extend from expiry date
-                if current_expires > today:
-                    new_expires = current_expires + timedelta(days=days)
-                    log_event(f"Key redemption - Extended valid license: {username} from {existing['expires']} to {new_expires.strftime('%Y-%m-%d')}")
-                else:
-                    # License expired, start fresh from today
-                    new_expires = today + timedelta(days=days)
-                    log_event(f"Key redemption - Renewed expired license: {username} from today to {new_expires.strftime('%Y-%m-%d')}")
-                
-                existing["expires"] = new_expires.strftime("%Y-%m-%d")
-            except Exception as e:
-                log_event(f"Key redemption - Error parsing date for {username}, starting fresh: {e}", level="warn")
-                new_expires = today + timedelta(days=days)
-                existing["expires"] = new_expires.strftime("%Y-%m-%d")
-        else:
-            # New user - create from today
-            expires = (today + timedelta(days=days)).strftime("%Y-%m-%d")
-            users.append({"username": username, "expires": expires})
-            log_event(f"Key redemption - New user created: {username} expires {expires}")
+        if status != "ok":
+            log_event(f"redeem fail: key '{key_code}' for {username}: {result.get('error')}", level="error", event="redeem_fail", username=username)
+            return render_template("redeem.html", error="Could not redeem the key, please try again")
         
-        # Mark key as used
-        key["used"] = True
-        key["used_by"] = username
-        key["used_at"] = (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
-        
-        # Save everything
-        save_users(users)
-        save_keys(keys)
+        days = result["duration"]
+        if result["new_user"]:
+            log_event(f"Key redemption - New user created: {username} expires {result['expires']}")
+        elif result["extended"]:
+            log_event(f"Key redemption - Extended valid license: {username} from {result['previous_expires']} to {result['expires']}")
+        else:
+            log_event(f"Key redemption - Renewed expired license: {username} from today to {result['expires']}")
         
-        log_event(f"key redeemed: {key_code} by {username} for {days} days")
+        log_event(f"key redeemed: {key_code} by {username} for {days} days", event="key_redeemed", username=username)
         
         # Generate download token
         token = generate_download_token(username, f"{days}days")
@@ -338,6 +320,96 @@ def testimonial_success():
     return render_template("testimonial_success.html")
 
 
+# -----------------------
+# Paginated listings
+# -----------------------
+
+def _page_args(default_desc):
+    """Common keyset pagination query args: cursor, limit, order, q"""
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        raise ValueError("invalid limit")
+    order = request.args.get("order", "desc" if default_desc else "asc")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+    return {
+        "cursor": request.args.get("cursor") or None,
+        "limit": limit,
+        "descending": order == "desc",
+        "search": (request.args.get("q") or "").strip() or None
+    }
+
+def _page_response(page_fn, default_desc, **filters):
+    """Run a db_helper page_* function with the request's paging args"""
+    try:
+        page = page_fn(**_page_args(default_desc), **filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if page is None:
+        return jsonify({"error": "Failed to load page"}), 500
+    return jsonify(page)
+
+
+# -----------------------
+# Streaming exports
+# -----------------------
+
+# kind -> (row generator, CSV columns)
+EXPORTS = {
+    "users": (db_helper.stream_licenses, [
+        "username", "player_id", "expires", "paused", "paused_at", "remaining_days",
+        "last_nickname", "first_connection_date", "last_connected"
+    ]),
+    "keys": (db_helper.stream_keys, ["code", "duration", "created", "used", "used_by", "used_at"]),
+    "logs": (db_helper.stream_logs, ["ts", "level", "msg"]),
+    "recent": (db_helper.stream_recent_connections, ["ts", "username", "ip", "status"]),
+    "purchases": (db_helper.stream_purchases, [
+        "id", "username", "email", "platform", "item", "currency", "price",
+        "duration", "status", "access_key", "created_at", "updated_at"
+    ]),
+}
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, default=str) + "\n"
+
+def _csv_lines(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route("/api/export/<kind>", methods=["GET"])
+@admin_required
+def api_export(kind):
+    """Stream a whole table as NDJSON (default) or CSV (?format=csv)"""
+    if kind not in EXPORTS:
+        return jsonify({"error": f"unknown export, expected one of: {', '.join(EXPORTS)}"}), 404
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+
+    stream, columns = EXPORTS[kind]
+    rows = stream()
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    if fmt == "csv":
+        body, mimetype = _csv_lines(rows, columns), "text/csv"
+    else:
+        body, mimetype = _ndjson_lines(rows), "application/x-ndjson"
+
+    log_event(f"export started: {kind} ({fmt})")
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={kind}-{stamp}.{fmt}"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 # -----------------------
 # Admin API for keys
 # -----------------------
@@ -349,54 +421,127 @@ def api_get_keys():
     keys = load_keys()
     return jsonify(keys)
 
+# Upper bound for one bulk generation request
+MAX_KEYS_PER_BATCH = 5000
+
+@app.route("/api/keys/page", methods=["GET"])
+@admin_required
+def api_get_keys_page():
+    """One page of keys (?cursor=&limit=&sort=created|code&order=&status=used|unused&q=prefix)"""
+    return _page_response(
+        db_helper.page_keys, True,
+        sort=request.args.get("sort", "created"),
+        status=request.args.get("status") or None
+    )
+
 @app.route("/api/keys/generate", methods=["POST"])
 @admin_required
 def api_generate_key():
-    """Generate a new activation key"""
+    """Generate one or more activation keys (`count`), optionally as CSV (`format: "csv"`)"""
     body = request.get_json() or {}
     duration = body.get("duration")
+    count = body.get("count", 1)
     
-    if not duration or not isinstance(duration, int) or duration <= 0:
+    if isinstance(duration, bool) or not isinstance(duration, int) or duration <= 0:
         return jsonify({"error": "Invalid duration"}), 400
-    
-    # Generate unique key
-    key_code = generate_key()
-    
-    # Ensure uniqueness by checking database
-    keys = load_keys()
-    while find_key(keys, key_code):
-        key_code = generate_key()
+
+    if isinstance(count, bool) or not isinstance(count, int) or count <= 0 or count > MAX_KEYS_PER_BATCH:
+        return jsonify({"error": f"count must be between 1 and {MAX_KEYS_PER_BATCH}"}), 400
     
     # Create timestamp
     created = (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
     
-    # Create key in database
-    new_key = create_key(key_code, duration, created)
-    
-    if not new_key:
-        return jsonify({"error": "Failed to create key"}), 500
-    
-    log_event(f"key generated: {key_code} for {duration} days")
+    # Codes are allocated in bulk; collisions are retried by the database insert
+    new_keys = db_helper.create_keys(generate_key, count, duration, created)
     
-    return jsonify({"message": "Key generated", "key": new_key}), 200
+    if not new_keys:
+        return jsonify({"error": "Failed to create keys"}), 500
+
+    if count == 1:
+        log_event(f"key generated: {new_keys[0].code} for {duration} days")
+    else:
+        log_event(f"keys generated: {count} keys for {duration} days")
+
+    if body.get("format") == "csv" or request.args.get("format") == "csv":
+        lines = ["code,duration,created"]
+        lines.extend(f"{k.code},{k.duration},{k.created}" for k in new_keys)
+        response = make_response("\n".join(lines) + "\n")
+        response.headers["Content-Type"] = "text/csv; charset=utf-8"
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename=keys-{duration}d-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.csv"
+        )
+        return response
+
+    if count == 1:
+        return jsonify({"message": "Key generated", "key": new_keys[0]}), 200
+    return jsonify({"message": f"{count} keys generated", "keys": new_keys}), 200
+
+def _key_codes_from_body(body):
+    """Key codes from a JSON body: either "code" or a "codes" list"""
+    codes = body.get("codes")
+    if codes is None:
+        codes = [body.get("code", "")]
+    if not isinstance(codes, list):
+        return []
+    return [c.strip() for c in codes if isinstance(c, str) and c.strip()]
 
 @app.route("/api/keys/delete", methods=["POST"])
 @admin_required
 def api_delete_key():
-    """Delete an activation key"""
+    """Delete one ("code") or several ("codes") activation keys"""
     body = request.get_json() or {}
-    key_code = body.get("code", "").strip()
+    codes = _key_codes_from_body(body)
     
-    if not key_code:
+    if not codes:
         return jsonify({"error": "Key code required"}), 400
     
-    keys = load_keys()
-    keys = [k for k in keys if k["code"] != key_code]
-    save_keys(keys)
+    deleted = db_helper.delete_keys(codes)
+    if deleted is None:
+        return jsonify({"error": "Failed to delete keys"}), 500
     
-    log_event(f"key deleted: {key_code}")
+    if len(codes) == 1:
+        log_event(f"key deleted: {codes[0]}")
+    else:
+        log_event(f"keys deleted: {deleted} of {len(codes)} requested")
     
-    return jsonify({"message": "Key deleted"}), 200
+    return jsonify({"message": "Key deleted" if len(codes) == 1 else "Keys deleted", "deleted": deleted}), 200
+
+@app.route("/api/keys/revoke", methods=["POST"])
+@admin_required
+def api_revoke_keys():
+    """Revoke a batch of unused keys so they can no longer be redeemed"""
+    body = request.get_json() or {}
+    codes = _key_codes_from_body(body)
+
+    if not codes:
+        return jsonify({"error": "Key codes required"}), 400
+
+    now = (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
+    revoked = db_helper.revoke_keys(codes, now)
+    if revoked is None:
+        return jsonify({"error": "Failed to revoke keys"}), 500
+
+    log_event(f"keys revoked: {revoked} of {len(codes)} requested")
+    return jsonify({"message": "Keys revoked", "revoked": revoked}), 200
+
+@app.route("/api/keys/expire", methods=["POST"])
+@admin_required
+def api_expire_keys():
+    """Expire every unused key older than `days` days"""
+    body = request.get_json() or {}
+    days = body.get("days")
+
+    if isinstance(days, bool) or not isinstance(days, int) or days <= 0:
+        return jsonify({"error": "Invalid days"}), 400
+
+    now = datetime.utcnow() + CET_OFFSET
+    cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%SZ")
+    expired = db_helper.expire_unused_keys(cutoff, now.strftime("%Y-%m-%d %H:%M:%SZ"))
+    if expired is None:
+        return jsonify({"error": "Failed to expire keys"}), 500
+
+    log_event(f"keys expired: {expired} unused keys created before {cutoff}")
+    return jsonify({"message": "Keys expired", "expired": expired, "created_before": cutoff}), 200
 
 # -----------------------
 # Payment routes
@@ -580,7 +725,7 @@ def download():
     token = request.args.get("token")
     
     # ✅ LOG THE RAW TOKEN
-    log_event(f"Download attempt - Token: {token[:50] if token else 'MISSING'}... (len={len(token) if token else 0})", level="info")
+    log_event(f"Download attempt - Token: {token[:50] if token else 'MISSING'}... (len={len(token) if token else 0})", level="info", event="download_attempt")
     
     if not token:
         log_event("Download failed: No token in request", level="error")
@@ -603,13 +748,13 @@ def download():
         decoded_token = urllib.parse.unquote(token)
         
         if decoded_token != token:
-            log_event(f"Trying URL-decoded token: {decoded_token[:50]}...", level="info")
+            log_event(f"Trying URL-decoded token: {decoded_token[:50]}...", level="info", event="download_attempt")
             payload = verify_download_token(decoded_token)
         
         if not payload:
             abort(403)
 
-    log_event(f"Download successful for user: {payload.get('u')}", level="info")
+    log_event(f"Download successful for user: {payload.get('u')}", level="info", event="download", username=payload.get('u'))
 
     file_path = "files/rxzbot.zip"
     
@@ -646,47 +791,41 @@ def activate_license(username, item):
     
     days = days_map.get(item, 30)
     
-    users = load_users()
-    existing = find_user(users, username)
+    existing = db_helper.find_license(username)
     
     # Special handling for permanent items
     if item in ["rawcode", "custombot"]:
         expires = "2099-12-31"  # Permanent license
         if existing:
-            existing["expires"] = expires
+            updated_user = existing.replace(expires_on=date(2099, 12, 31))
         else:
-            users.append({"username": username, "expires": expires})
+            updated_user = {"username": username, "expires": expires}
     else:
         # Normal subscription logic with PROPER RENEWAL
-        today = datetime.now()
+        today = date.today()
         
         if existing:
             # User exists - check if license is still valid or expired
-            try:
-                current_expires = datetime.strptime(existing["expires"], "%Y-%m-%d")
-                
+            if existing.expires_on is None:
+                # If the stored date is invalid, start fresh
+                log_event(f"Invalid expiry date for {username}, starting fresh", level="warn")
+                new_expires = today + timedelta(days=days)
+            elif existing.is_active(today):
                 # If license is still valid, extend from expiry date
-                if current_expires > today:
-                    new_expires = current_expires + timedelta(days=days)
-                    log_event(f"Extended valid license: {username} from {existing['expires']} to {new_expires.strftime('%Y-%m-%d')}")
-                else:
-                    # License expired, start fresh from today
-                    new_expires = today + timedelta(days=days)
-                    log_event(f"Renewed expired license: {username} from today to {new_expires.strftime('%Y-%m-%d')}")
-                
-                existing["expires"] = new_expires.strftime("%Y-%m-%d")
-            except Exception as e:
-                # If date parsing fails, start fresh
-                log_event(f"Error parsing date for {username}, starting fresh: {e}", level="warn")
+                new_expires = existing.expires_on + timedelta(days=days)
+                log_event(f"Extended valid license: {username} from {existing['expires']} to {new_expires.isoformat()}")
+            else:
+                # License expired, start fresh from today
                 new_expires = today + timedelta(days=days)
-                existing["expires"] = new_expires.strftime("%Y-%m-%d")
+                log_event(f"Renewed expired license: {username} from today to {new_expires.isoformat()}")
+            updated_user = existing.replace(expires_on=new_expires)
         else:
             # New user - create from today
-            expires = (today + timedelta(days=days)).strftime("%Y-%m-%d")
-            users.append({"username": username, "expires": expires})
+            expires = (today + timedelta(days=days)).isoformat()
+            updated_user = {"username": username, "expires": expires}
             log_event(f"New user created: {username} expires {expires}")
     
-    save_users(users)
+    save_users([updated_user])
     log_event(f"License activated: {username} for {item} ({days} days)")
 
 
@@ -722,15 +861,14 @@ def debug():
     # Get latest bot version from recent connections
     latest_version = "Unknown"
     try:
-        recent_logs = db_helper.get_recent_logs(limit=100)
-        for log in recent_logs:
-            if "bot version" in log.get("msg", ""):
-                # Extract version from log message
-                import re
-                match = re.search(r'v\d+\.\d+\.\d+', log["msg"])
-                if match:
-                    latest_version = match.group(0)
-                    break
+        page = db_helper.query_logs(event="bot_version", limit=20)
+        for log in (page or {}).get("items", []):
+            # Extract version from log message
+            import re
+            match = re.search(r'v\d+\.\d+\.\d+', log["msg"])
+            if match:
+                latest_version = match.group(0)
+                break
     except:
         pass
     
@@ -760,27 +898,24 @@ def auth():
     # client IP (support proxied headers)
     ip = request.headers.get("X-Forwarded-For", request.remote_addr)
 
-    users = load_users()
-    user = find_user(users, username)
+    user = db_helper.find_license(username)
     
     if not user:
-        log_event(f"auth fail: username '{username}' not found", level="warn")
+        log_event(f"auth fail: username '{username}' not found", level="warn", event="auth_fail", username=username)
         record_connection(username, ip, "unauthorized")
         return jsonify({"message": "unauthorized"}), 403
 
-    try:
-        expiry = parse_date(user["expires"])
-    except Exception:
-        log_event(f"auth fail: invalid expiry date for '{username}'", level="error")
+    if user.expires_on is None:
+        log_event(f"auth fail: invalid expiry date for '{username}'", level="error", event="auth_fail", username=username)
         record_connection(username, ip, "unauthorized")
         return jsonify({"message": "unauthorized"}), 403
 
-    if expiry >= datetime.now():
-        log_event(f"auth success: '{username}' valid until {user['expires']}", level="info")
+    if user.is_active():
+        log_event(f"auth success: '{username}' valid until {user['expires']}", level="info", event="auth_success", username=username)
         record_connection(username, ip, "authorized")
         return jsonify({"message": "authorized", "expires": user["expires"]}), 200
     else:
-        log_event(f"auth expired: '{username}' expired on {user['expires']}", level="warn")
+        log_event(f"auth expired: '{username}' expired on {user['expires']}", level="warn", event="auth_expired", username=username)
         record_connection(username, ip, "expired")
         return jsonify({"message": "expired", "expires": user["expires"]}), 403
 
@@ -833,32 +968,57 @@ def admin_add():
     if not expires:
         expires = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
 
-    users = load_users()
-    existing = find_user(users, username)
+    existing = db_helper.find_license(username)
     if existing:
-        existing["expires"] = expires
+        updated_user = dict(existing.to_dict(), expires=expires)
     else:
-        users.append({"username": username, "expires": expires})
-    save_res = save_users(users)
+        updated_user = {"username": username, "expires": expires}
+    save_res = save_users([updated_user])
     log_event(f"web add: {username} expires {expires}")
     return redirect(url_for("login"))
 
 @app.route("/admin/delete/<username>", methods=["GET"])
 @admin_required
 def admin_delete(username):
-    users = load_users()
-    users = [u for u in users if u["username"].lower() != username.lower()]
-    save_res = save_users(users)
+    db_helper.delete_license(username)
     log_event(f"web delete: {username}")
     return redirect(url_for("login"))
 
 @app.route("/api/users", methods=["GET"])
 @admin_required
 def api_get_users():
-    users = load_users()
-    last_conn = load_last_connected()
-    for u in users:
-        u["last_connected"] = last_conn.get(u["username"])
+    """All users with last connection and connection count (?computed=1 adds days_remaining/active, ?summary=1 reads the cached summary)"""
+    flag = lambda name: request.args.get(name, "").lower() in ("1", "true", "yes")
+    return jsonify(db_helper.load_admin_users(computed=flag("computed"), summary=flag("summary")))
+
+@app.route("/api/users/summary/refresh", methods=["POST"])
+@admin_required
+def api_refresh_users_summary():
+    """Force a refresh of the materialized admin user summary"""
+    if not db_helper.refresh_admin_user_summary(force=True):
+        return jsonify({"error": "Failed to refresh summary"}), 500
+    return jsonify({"message": "Summary refreshed"}), 200
+
+@app.route("/api/users/page", methods=["GET"])
+@admin_required
+def api_get_users_page():
+    """One page of users (?cursor=&limit=&sort=username|expires&order=&status=active|expired|paused&q=prefix)"""
+    return _page_response(
+        db_helper.page_licenses, False,
+        sort=request.args.get("sort", "username"),
+        status=request.args.get("status") or None
+    )
+
+@app.route("/api/users/expiring", methods=["GET"])
+@admin_required
+def api_get_expiring_users():
+    """Users whose license expires within the next `days` days (default 7)"""
+    try:
+        days = max(0, min(int(request.args.get("days", 7)), 3650))
+    except ValueError:
+        return jsonify({"error": "invalid days value"}), 400
+    today = date.today()
+    users = db_helper.get_expiring_licenses(today, today + timedelta(days=days + 1))
     return jsonify(users)
 
 @app.route("/api/add", methods=["POST"])
@@ -880,13 +1040,12 @@ def api_add():
     if not expires:
         expires = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
 
-    users = load_users()
-    existing = find_user(users, username)
+    existing = db_helper.find_license(username)
     if existing:
-        existing["expires"] = expires
+        updated_user = dict(existing.to_dict(), expires=expires)
     else:
-        users.append({"username": username, "expires": expires})
-    save_res = save_users(users)
+        updated_user = {"username": username, "expires": expires}
+    save_res = save_users([updated_user])
     log_event(f"api_add: {username} expires {expires}")
     return jsonify({"message": "ok", "username": username, "expires": expires, "save_result": save_res}), 200
 
@@ -898,22 +1057,15 @@ def api_delete():
     if not username:
         return jsonify({"error": "username missing"}), 400
     
-    try:
-        with db_helper.get_db() as db:
-            from init_database import User
-            from sqlalchemy import func
-            # Case-insensitive search
-            user = db.query(User).filter(func.lower(User.username) == username.lower()).first()
-            if user:
-                db.delete(user)
-                db.commit()
-                log_event(f"api_delete: {username}")
-                return jsonify({"message": "deleted", "username": username}), 200
-            else:
-                return jsonify({"error": "user not found"}), 404
-    except Exception as e:
-        log_event(f"api_delete error: {username} - {e}", level="error")
-        return jsonify({"error": str(e)}), 500
+    # Case-insensitive delete through the lower(username) index
+    deleted = db_helper.delete_license(username)
+    if deleted is None:
+        log_event(f"api_delete error: {username}", level="error")
+        return jsonify({"error": "failed to delete user"}), 500
+    if not deleted:
+        return jsonify({"error": "user not found"}), 404
+    log_event(f"api_delete: {username}")
+    return jsonify({"message": "deleted", "username": username}), 200
 
 @app.route("/api/extend", methods=["POST"])
 @admin_required
@@ -931,34 +1083,30 @@ def api_extend():
         return jsonify({"error": "invalid days value"}), 400
     
     # Load users
-    users = load_users()
-    user = find_user(users, username)
+    user = db_helper.find_license(username)
     
     # Check if user exists
     if not user:
         return jsonify({"error": f"User '{username}' not found"}), 404
     
     try:
-        # Parse current expiry date
-        current_expiry = parse_date(user["expires"])
+        if user.expires_on is None:
+            raise ValueError(f"invalid expiry date for '{username}'")
         
         # If date has already passed, start from today
-        if current_expiry < datetime.now():
-            base_date = datetime.now()
+        if not user.is_active():
+            base_date = date.today()
             print(f"⏰ User '{username}' was expired, extending from today")
         else:
-            base_date = current_expiry
+            base_date = user.expires_on
             print(f"📅 User '{username}' is active, extending from {user['expires']}")
         
         # Add the days
         new_expiry = base_date + timedelta(days=days)
-        new_expiry_str = new_expiry.strftime("%Y-%m-%d")
-        
-        # Update the user
-        user["expires"] = new_expiry_str
+        new_expiry_str = new_expiry.isoformat()
         
-        # Persist changes to storage
-        save_res = save_users(users)
+        # Persist the updated user
+        save_res = save_users([user.replace(expires_on=new_expiry)])
         
         print(f"✅ Extended '{username}' by {days} days. New expiry: {new_expiry_str}")
         log_event(f"extended: {username} +{days} days -> {new_expiry_str}")
@@ -982,30 +1130,51 @@ def api_extend():
 def static_files(path):
     return send_from_directory("static", path)
 
-# In-memory logs
-LOGS = deque(maxlen=500)
-RECENT_CONN = deque(maxlen=300)
+# In-memory logs, shared by all workers (see ring_buffer.py)
+LOGS = RingBuffer("logs", capacity=500, slot_size=512)
+RECENT_CONN = RingBuffer("recent", capacity=300, slot_size=256)
 
-def log_event(msg, level="info"):
-    """Store a structured log and print to console."""
+# Which lines reach the database
+LOG_POLICY = LogPolicy.from_env()
+
+def log_event(msg, level="info", event=None, username=None, ip=None):
+    """Store a structured log and print to console.
+
+    `event` (e.g. "auth_fail"), `username` and `ip` are stored in their own
+    indexed columns so /api/logs/query can filter on them.
+    Console and memory get every line; the database only gets what
+    LOG_POLICY admits (sampling, rate limits, aggregation, see log_policy.py).
+    """
     ts = (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
-    entry = {"ts": ts, "msg": str(msg), "level": level}
-    LOGS.appendleft(entry)
-    print(f"[{ts}] [{level.upper()}] {msg}")
-    
-    # Save to database
+    if "memory" in LOG_SINKS:
+        LOGS.append({"ts": ts, "msg": str(msg), "level": level})
+    if "console" in LOG_SINKS:
+        print(f"[{ts}] [{level.upper()}] {msg}")
+
+    if "db" in LOG_SINKS:
+        if LOG_POLICY.admit(level, event, username):
+            save_log_to_db(ts, str(msg), level, event, username, ip)
+        flush_log_summaries(ts)
+
+def save_log_to_db(ts, msg, level, event=None, username=None, ip=None):
     try:
-        db_helper.save_log(ts, str(msg), level)
+        db_helper.save_log(ts, msg, level, event=event, username=username, ip=ip)
     except Exception as e:
         print(f"Failed to save log to database: {e}")
 
+def flush_log_summaries(ts=None, force=False):
+    """Persist the aggregation/rate-limit summaries of the last policy window"""
+    ts = ts or (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
+    for level, event, username, summary in LOG_POLICY.drain(force=force):
+        save_log_to_db(ts, summary, level, event, username)
+
 def record_connection(username, ip, status):
     """Record a recent connection attempt."""
     ts = (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
     entry = {"ts": ts, "username": username, "ip": ip, "status": status}
-    RECENT_CONN.appendleft(entry)
+    RECENT_CONN.append(entry)
     lvl = "info" if status == "authorized" else "warn"
-    log_event(f"conn {status}: {username} @{ip}", level=lvl)
+    log_event(f"conn {status}: {username} @{ip}", level=lvl, event=f"conn_{status}", username=username, ip=ip)
     
     # Save to database
     try:
@@ -1014,41 +1183,70 @@ def record_connection(username, ip, status):
         print(f"Failed to save connection to database: {e}")
     
     if status == "authorized":
-        stats = load_stats()
-        stats[username] = stats.get(username, 0) + 1
-        save_stats(stats)
-        
-        last_conn = load_last_connected()
-        last_conn[username] = ts
-        save_last_connected(last_conn)
+        db_helper.record_authorized_connection(username, ts)
 
 @app.route("/api/logs", methods=["GET"])
 @admin_required
 def api_logs():
-    """Get recent logs from database"""
+    """Recent logs from the shared in-memory buffer (database after a host restart)"""
     try:
-        logs = db_helper.get_recent_logs(limit=500)
+        logs = LOGS.latest(500) or db_helper.get_recent_logs(limit=500)
         return jsonify(logs)
     except Exception as e:
         print(f"Error fetching logs: {e}")
         return jsonify([])
 
+@app.route("/api/logs/query", methods=["GET"])
+@admin_required
+def api_logs_query():
+    """
+    Filtered log search, newest first:
+    ?level=warn,error&event=&username=&ip=&q=<full-text>&since=&until=<ISO UTC>&cursor=&limit=
+    """
+    args = request.args
+    try:
+        limit = int(args.get("limit", 100))
+        since = datetime.fromisoformat(args["since"]) if args.get("since") else None
+        until = datetime.fromisoformat(args["until"]) if args.get("until") else None
+        levels = [l.strip() for l in args.get("level", "").split(",") if l.strip()]
+        page = db_helper.query_logs(
+            cursor=args.get("cursor") or None,
+            limit=limit,
+            levels=levels or None,
+            event=args.get("event") or None,
+            username=args.get("username") or None,
+            ip=args.get("ip") or None,
+            search=(args.get("q") or "").strip() or None,
+            since=since,
+            until=until
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if page is None:
+        return jsonify({"error": "Failed to query logs"}), 500
+    return jsonify(page)
+
 @app.route("/debug/logs", methods=["GET"])
 @admin_required
 def debug_logs():
     """Admin-only debug logs view"""
     try:
-        logs = db_helper.get_recent_logs(limit=10000)  # Large limit to get most logs
-        return render_template("debug_logs.html", logs=logs)
+        limit = 10000  # Large limit to get most logs
+        # Rows are streamed into the page as they come off the cursor
+        return stream_template(
+            "debug_logs.html",
+            logs=db_helper.stream_logs(limit=limit),
+            summary=db_helper.get_log_summary(limit)
+        )
     except Exception as e:
         return f"Error fetching logs: {e}", 500
 
 @app.route("/api/recent", methods=["GET"])
 @admin_required
 def api_recent():
-    """Recent connection attempts from database"""
+    """Recent connection attempts from the shared in-memory buffer (database after a host restart)"""
     try:
-        connections = db_helper.get_recent_connections(limit=300)
+        connections = RECENT_CONN.latest(300) or db_helper.get_recent_connections(limit=300)
         return jsonify(connections)
     except Exception as e:
         print(f"Error fetching recent connections: {e}")
@@ -1078,6 +1276,14 @@ def api_get_testimonials():
     approved.sort(key=lambda x: x.get('date', ''), reverse=True)
     return jsonify(approved)
 
+@app.route("/api/testimonials/page", methods=["GET"])
+def api_get_testimonials_page():
+    """One page of testimonials by date; the public only sees approved ones (?approved=true|false for admins)"""
+    approved = True
+    if session.get("logged_in"):
+        approved = {"true": True, "false": False}.get(request.args.get("approved", "").lower())
+    return _page_response(db_helper.page_testimonials, True, approved=approved)
+
 @app.route("/api/testimonials/submit", methods=["POST"])
 def api_submit_testimonial():
     """Public endpoint for users to submit testimonials (pending approval) + 3 days bonus"""
@@ -1100,16 +1306,12 @@ def api_submit_testimonial():
         return jsonify({"error": "Invalid rating"}), 400
     
     # Check if user exists
-    users = load_users()
-    user = find_user(users, username)
+    user = db_helper.find_license(username)
     if not user:
         return jsonify({"error": "User not found. Please use your registered username."}), 404
     
-    testimonials = load_testimonials()
-    
     # Check if user already submitted a review (ONE REVIEW PER USER MAX)
-    existing = next((t for t in testimonials if t.get('username', '').lower() == username.lower()), None)
-    if existing:
+    if db_helper.has_testimonial_from(username):
         return jsonify({"error": "You have already submitted a review. Thank you!"}), 400
     
     # Generate unique ID
@@ -1126,25 +1328,21 @@ def api_submit_testimonial():
         "approved": False  # PENDING - admin must approve
     }
     
-    testimonials.append(new_testimonial)
-    save_testimonials(testimonials)
+    save_testimonials([new_testimonial])
     
     # 🎁 BONUS: Add 3 days to user's license as a thank you!
     try:
-        today = datetime.now()
-        current_expires = datetime.strptime(user["expires"], "%Y-%m-%d")
-        
         # If license is still valid, extend from expiry date
-        if current_expires > today:
-            new_expires = current_expires + timedelta(days=3)
+        if user.is_active():
+            new_expires = user.expires_on + timedelta(days=3)
         else:
-            # If expired, add 3 days from today
-            new_expires = today + timedelta(days=3)
+            # If expired (or no valid date), add 3 days from today
+            new_expires = date.today() + timedelta(days=3)
         
-        user["expires"] = new_expires.strftime("%Y-%m-%d")
-        save_users(users)
+        new_expires_str = new_expires.isoformat()
+        save_users([user.replace(expires_on=new_expires)])
         
-        log_event(f"testimonial bonus: {username} got +3 days (new expiry: {user['expires']})")
+        log_event(f"testimonial bonus: {username} got +3 days (new expiry: {new_expires_str})")
     except Exception as e:
         log_event(f"Error adding bonus to {username}: {e}", level="error")
     
@@ -1176,8 +1374,6 @@ def api_add_testimonial():
     if not isinstance(rating, int) or rating < 1 or rating > 5:
         return jsonify({"error": "invalid rating (must be 1-5)"}), 400
     
-    testimonials = load_testimonials()
-    
     # Generate unique ID
     import uuid
     testimonial_id = str(uuid.uuid4())[:8]
@@ -1194,8 +1390,7 @@ def api_add_testimonial():
         "approved": True
     }
     
-    testimonials.append(new_testimonial)
-    save_testimonials(testimonials)
+    save_testimonials([new_testimonial])
     
     log_event(f"testimonial added: {username} ({rating}★)")
     
@@ -1235,8 +1430,7 @@ def api_approve_testimonial():
     if not testimonial:
         return jsonify({"error": "Testimonial not found"}), 404
     
-    testimonial["approved"] = True
-    save_testimonials(testimonials)
+    save_testimonials([testimonial.replace(approved=True)])
     
     log_event(f"testimonial approved: {testimonial_id}")
     
@@ -1262,7 +1456,7 @@ def api_create_purchase():
         if not all([username, email, platform, item, currency, price]):
             return jsonify({"success": False, "error": "Missing required fields"}), 400
         
-        if platform not in ["Instagram", "Discord"]:
+        if platform not in (PurchasePlatform.INSTAGRAM, PurchasePlatform.DISCORD):
             return jsonify({"success": False, "error": "Invalid platform"}), 400
         
         if currency not in ["roses", "gems"]:
@@ -1291,6 +1485,33 @@ def api_create_purchase():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# -----------------------
+# Shop catalog
+# -----------------------
+
+@app.route("/api/shop", methods=["GET"])
+@app.route("/api/shop/data", methods=["GET"])
+def api_shop_data():
+    """Shop catalog snapshot, served pre-serialized with ETag / If-None-Match support"""
+    snapshot = db_helper.get_shop_snapshot()
+    if not snapshot:
+        return jsonify({"error": "Shop data unavailable"}), 503
+
+    # Each encoding gets its own validator; either one matches the current catalog
+    use_gzip = "gzip" in request.accept_encodings
+    etag = snapshot.etag + ("-gz" if use_gzip else "")
+    if request.if_none_match.contains(snapshot.etag) or request.if_none_match.contains(snapshot.etag + "-gz"):
+        response = make_response("", 304)
+    else:
+        response = make_response(snapshot.gzip if use_gzip else snapshot.json)
+        response.headers["Content-Type"] = "application/json"
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
 @app.route("/api/admin/purchases", methods=["GET"])
 @admin_required
 def api_get_purchases():
@@ -1313,6 +1534,79 @@ def api_get_paypal_purchases():
         print(f"❌ Error fetching PayPal purchases: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/api/admin/purchases/page", methods=["GET"])
+@admin_required
+def api_get_purchases_page():
+    """One page of purchases (?cursor=&limit=&order=&platform=&status=&q=prefix)"""
+    return _page_response(
+        db_helper.page_purchases, True,
+        platform=request.args.get("platform") or None,
+        status=request.args.get("status") or None
+    )
+
+@app.route("/api/admin/paypal-purchases/page", methods=["GET"])
+@admin_required
+def api_get_paypal_purchases_page():
+    """One page of PayPal purchases (?cursor=&limit=&order=&status=&q=prefix)"""
+    return _page_response(
+        db_helper.page_purchases, True,
+        platform="PayPal",
+        status=request.args.get("status") or None
+    )
+
+# -----------------------
+# Purchase work queue
+# -----------------------
+PURCHASE_STATUS_VALUES = [status.value for status in PurchaseStatus]
+
+def _admin_claimant():
+    """Name recorded on claimed purchases: X-Admin-Name, else a per-session id"""
+    name = (request.headers.get("X-Admin-Name") or "").strip()[:100]
+    if name:
+        return name
+    if "admin_claim_id" not in session:
+        session["admin_claim_id"] = f"admin-{secrets.token_hex(3)}"
+    return session["admin_claim_id"]
+
+@app.route("/api/admin/purchases/queue", methods=["GET"])
+@admin_required
+def api_purchase_queue():
+    """Pending purchases, oldest first (?cursor=&limit=&platform=&q=prefix)"""
+    return _page_response(
+        db_helper.page_purchases, False,
+        platform=request.args.get("platform") or None,
+        status="pending"
+    )
+
+@app.route("/api/admin/purchases/claim", methods=["POST"])
+@admin_required
+def api_claim_purchases():
+    """
+    Claim the oldest pending purchases ({"limit", "status", "platform"}).
+    Purchases another admin is working on are skipped.
+    """
+    body = request.get_json() or {}
+    limit = body.get("limit", 1)
+    if isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0:
+        return jsonify({"success": False, "error": "Invalid limit"}), 400
+    try:
+        claimed = db_helper.claim_purchases(
+            _admin_claimant(), limit, status=body.get("status") or None, platform=body.get("platform") or None
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if claimed is None:
+        return jsonify({"success": False, "error": "Failed to claim purchases"}), 500
+    return jsonify({"success": True, "purchases": claimed, "claim_ttl": db_helper.PURCHASE_CLAIM_TTL}), 200
+
+@app.route("/api/admin/purchase/<int:purchase_id>/release", methods=["POST"])
+@admin_required
+def api_release_purchase(purchase_id):
+    """Give a claimed purchase back to the queue"""
+    if not db_helper.release_purchase_claim(purchase_id, _admin_claimant()):
+        return jsonify({"success": False, "error": "Purchase not claimed by you"}), 409
+    return jsonify({"success": True}), 200
+
 @app.route("/api/admin/purchase/<int:purchase_id>/status", methods=["PUT"])
 @admin_required
 def api_update_purchase_status(purchase_id):
@@ -1321,22 +1615,29 @@ def api_update_purchase_status(purchase_id):
         body = request.get_json() or {}
         new_status = (body.get("status") or "").strip()
         
-        if new_status not in ["Awaiting user contact", "Awaiting transaction", "Completed"]:
+        if new_status not in PURCHASE_STATUS_VALUES:
             return jsonify({"success": False, "error": "Invalid status"}), 400
         
-        result = update_purchase_status(purchase_id, new_status)
+        result = update_purchase_status(purchase_id, new_status, claimant=_admin_claimant())
         
         if result["success"]:
             log_event(f"Purchase {purchase_id} status updated to: {new_status}", level="info")
             return jsonify(result), 200
         else:
-            return jsonify(result), 404
+            return jsonify(result), 409 if result.get("conflict") else 404
             
     except Exception as e:
         print(f"❌ Error updating purchase: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+class PurchaseApprovalError(Exception):
+    """Aborts an approval; rolls back its database changes (see api_approve_purchase)"""
+    def __init__(self, result, status):
+        super().__init__(result.get("error"))
+        self.result = result
+        self.status = status
+
 @app.route("/api/admin/purchase/<int:purchase_id>/approve", methods=["POST"])
 @admin_required
 def api_approve_purchase(purchase_id):
@@ -1352,35 +1653,287 @@ def api_approve_purchase(purchase_id):
         if not purchase:
             return jsonify({"success": False, "error": "Purchase not found"}), 404
         
-        # Send email with key
-        email_sent = send_purchase_key_email(
-            email=purchase["email"],
-            username=purchase["username"],
-            item=purchase["item"],
-            access_key=access_key
-        )
+        if purchase["status"] == PurchaseStatus.COMPLETED:
+            return jsonify({"success": False, "error": "Purchase already completed"}), 409
         
-        if not email_sent:
-            return jsonify({"success": False, "error": "Failed to send email"}), 500
+        # Take the purchase so other admins leave it alone (refused once completed)
+        claimant = _admin_claimant()
+        claim = db_helper.claim_purchase(purchase_id, claimant)
+        if not claim["success"]:
+            return jsonify(claim), 409 if claim.get("conflict") else 404
         
-        # Create the key in the Key table so it can be redeemed
+        # Completing the purchase, creating its key and queueing the email
+        # share one savepoint. Completion only matches a purchase that isn't
+        # completed yet, so of two concurrent approvals (even from tabs of the
+        # same session) one gets a 409; any failing step undoes the others.
         # Use purchase duration if available, otherwise default to 30 days
         key_duration = purchase.get("duration") or 30
-        create_key(access_key, key_duration, (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ"))
-        
-        # Update purchase with key and mark as completed
-        result = update_purchase_with_key(purchase_id, access_key)
+        try:
+            with db_helper.get_db():
+                result = update_purchase_with_key(purchase_id, access_key, claimant=claimant)
+                if not result["success"]:
+                    raise PurchaseApprovalError(result, 409 if result.get("conflict") else 500)
+                
+                created = (datetime.utcnow() + CET_OFFSET).strftime("%Y-%m-%d %H:%M:%SZ")
+                if not create_key(access_key, key_duration, created):
+                    raise PurchaseApprovalError({"success": False, "error": "Failed to create key"}, 500)
+                
+                email_sent = send_purchase_key_email(
+                    email=purchase["email"],
+                    username=purchase["username"],
+                    item=purchase["item"],
+                    access_key=access_key,
+                    dedup_key=f"purchase-key:{purchase_id}"
+                )
+                if not email_sent:
+                    raise PurchaseApprovalError({"success": False, "error": "Failed to queue email"}, 500)
+        except PurchaseApprovalError as e:
+            return jsonify(e.result), e.status
         
-        if result["success"]:
-            log_event(f"Purchase {purchase_id} approved - Key: {access_key} sent to {purchase['email']}", level="info")
-            return jsonify({"success": True, "message": "Purchase approved and key sent via email"}), 200
-        else:
-            return jsonify(result), 500
+        log_event(f"Purchase {purchase_id} approved - Key: {access_key} sent to {purchase['email']}", level="info")
+        return jsonify({"success": True, "message": "Purchase approved, key email queued"}), 200
             
     except Exception as e:
         print(f"❌ Error approving purchase: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+# -----------------------
+# Gem accounts
+# -----------------------
+# Upper bound for one CSV import
+MAX_GEM_ACCOUNT_IMPORT = 2000
+
+def _gem_account_selection_from_body(body):
+    """
+    (ids, active, below) from a JSON body: "account_id", an "account_ids"
+    list, and/or a "filter" object {"active": bool, "below": gems}
+    """
+    ids = body.get("account_ids")
+    if ids is None and body.get("account_id") is not None:
+        ids = [body.get("account_id")]
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            raise ValueError("account_ids must be a list of integers")
+    selection = body.get("filter") or {}
+    if not isinstance(selection, dict):
+        raise ValueError("filter must be an object")
+    active, below = selection.get("active"), selection.get("below")
+    if active is not None and not isinstance(active, bool):
+        raise ValueError("filter.active must be true or false")
+    if below is not None and (not isinstance(below, int) or below < 0):
+        raise ValueError("filter.below must be a non-negative integer")
+    return ids, active, below
+
+@app.route("/api/gem-accounts", methods=["GET"])
+@admin_required
+def api_gem_accounts():
+    """All gem accounts, without passwords"""
+    return jsonify(db_helper.get_all_gem_accounts()), 200
+
+@app.route("/api/gem-accounts/stats", methods=["GET"])
+@admin_required
+def api_gem_accounts_stats():
+    return jsonify(db_helper.get_gem_accounts_stats()), 200
+
+@app.route("/api/gem-accounts/add", methods=["POST"])
+@admin_required
+def api_add_gem_account():
+    body = request.get_json() or {}
+    report = db_helper.import_gem_accounts([body])
+    if report is None:
+        return jsonify({"error": "Failed to add account"}), 500
+    entry = report[0]
+    if entry["status"] == "invalid":
+        return jsonify({"error": entry["error"]}), 400
+    if entry["status"] == "exists":
+        return jsonify({"error": "Account already exists"}), 409
+    log_event(f"gem account added: {entry['email']}")
+    return jsonify({"success": True, "id": entry["id"]}), 200
+
+@app.route("/api/gem-accounts/import", methods=["POST"])
+@admin_required
+def api_import_gem_accounts():
+    """
+    Import accounts from a CSV (uploaded as "file" or sent as the raw body)
+    with columns account_number,email,password[,current_nickname,gems_remaining].
+    ?update=1 overwrites number/password/nickname of existing emails.
+    Returns a per-row report.
+    """
+    upload = request.files.get("file")
+    content = upload.read().decode("utf-8-sig") if upload else request.get_data(as_text=True)
+    rows = list(csv.DictReader(io.StringIO(content)))
+
+    if not rows:
+        return jsonify({"error": "CSV with a header row and at least one account required"}), 400
+    if len(rows) > MAX_GEM_ACCOUNT_IMPORT:
+        return jsonify({"error": f"At most {MAX_GEM_ACCOUNT_IMPORT} accounts per import"}), 400
+
+    report = db_helper.import_gem_accounts(rows, update_existing=request.args.get("update") == "1")
+    if report is None:
+        return jsonify({"error": "Import failed"}), 500
+
+    counts = {}
+    for entry in report:
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    log_event(f"gem accounts imported: {counts}")
+    return jsonify({"counts": counts, "results": report}), 200
+
+@app.route("/api/gem-accounts/recharge", methods=["POST"])
+@admin_required
+def api_recharge_gem_accounts():
+    """Set gems on one account, a list of accounts or a filter (e.g. {"below": 1000})"""
+    body = request.get_json() or {}
+    amount = body.get("gems_amount", db_helper.DEFAULT_ACCOUNT_GEMS)
+    if not isinstance(amount, int) or amount < 0:
+        return jsonify({"error": "Invalid gems_amount"}), 400
+    try:
+        result = db_helper.recharge_gem_accounts(amount, *_gem_account_selection_from_body(body))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if result is None:
+        return jsonify({"error": "Failed to recharge accounts"}), 500
+
+    log_event(f"gem accounts recharged to {amount}: {result['updated']}")
+    return jsonify({"success": True, **result}), 200
+
+@app.route("/api/gem-accounts/toggle", methods=["POST"])
+@admin_required
+def api_toggle_gem_accounts():
+    """Enable or disable one account, a list of accounts or a filter"""
+    body = request.get_json() or {}
+    is_active = body.get("is_active")
+    if not isinstance(is_active, bool):
+        return jsonify({"error": "is_active must be true or false"}), 400
+    try:
+        result = db_helper.set_gem_accounts_active(is_active, *_gem_account_selection_from_body(body))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if result is None:
+        return jsonify({"error": "Failed to update accounts"}), 500
+
+    log_event(f"gem accounts {'enabled' if is_active else 'disabled'}: {result['updated']}")
+    return jsonify({"success": True, **result}), 200
+
+@app.route("/api/gem-accounts/delete", methods=["POST"])
+@admin_required
+def api_delete_gem_accounts():
+    """Delete one ("account_id") or several ("account_ids") accounts"""
+    body = request.get_json() or {}
+    try:
+        ids, _, _ = _gem_account_selection_from_body({k: body.get(k) for k in ("account_id", "account_ids")})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not ids:
+        return jsonify({"error": "Account id required"}), 400
+
+    deleted = db_helper.delete_gem_accounts(ids)
+    if deleted is None:
+        return jsonify({"error": "Failed to delete accounts"}), 500
+
+    log_event(f"gem accounts deleted: {deleted} of {len(ids)} requested")
+    return jsonify({"success": True, "deleted": deleted}), 200
+
+# -----------------------
+# Gift codes
+# -----------------------
+def _gift_amount(value):
+    """Positive amount with at most 2 decimals, or None"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        return None
+    return round(float(value), 2)
+
+@app.route("/api/gift-codes/create", methods=["POST"])
+@admin_required
+def api_create_gift_code():
+    body = request.get_json() or {}
+    amount = _gift_amount(body.get("amount"))
+    if amount is None:
+        return jsonify({"error": "Invalid amount"}), 400
+
+    code = db_helper.create_gift_code(amount, body.get("expires_at") or None)
+    if not code:
+        return jsonify({"error": "Failed to create gift code"}), 500
+
+    log_event(f"gift code created: {code} ({amount:.2f}€)")
+    return jsonify({"code": code, "amount": amount}), 200
+
+# Upper bound for one minting request
+MAX_GIFT_CODES_PER_BATCH = 50000
+
+@app.route("/api/gift-codes/generate", methods=["POST"])
+@admin_required
+def api_generate_gift_codes():
+    """
+    Mint `count` gift codes of `amount` (optional `expires_at`, `note`).
+    Returned as a streamed CSV with `format: "csv"`, JSON otherwise.
+    """
+    body = request.get_json() or {}
+    amount = _gift_amount(body.get("amount"))
+    count = body.get("count", 1)
+    if amount is None:
+        return jsonify({"error": "Invalid amount"}), 400
+    if isinstance(count, bool) or not isinstance(count, int) or count <= 0 or count > MAX_GIFT_CODES_PER_BATCH:
+        return jsonify({"error": f"count must be between 1 and {MAX_GIFT_CODES_PER_BATCH}"}), 400
+
+    note = (body.get("note") or "").strip()[:255] or None
+    minted = db_helper.create_gift_codes(count, amount, body.get("expires_at") or None, note=note)
+    if not minted:
+        return jsonify({"error": "Failed to create gift codes"}), 500
+
+    log_event(f"gift codes minted: {count} x {amount:.2f}€" + (f" ({note})" if note else ""))
+
+    if body.get("format") == "csv" or request.args.get("format") == "csv":
+        filename = f"gift-codes-{count}x{amount:g}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.csv"
+        return Response(
+            _csv_lines(minted, ["code", "amount", "created_at", "expires_at"]),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+    return jsonify({"message": f"{count} gift codes created", "codes": minted}), 200
+
+@app.route("/api/admin/gift-codes", methods=["GET"])
+@admin_required
+def api_gift_codes():
+    """One page of gift codes (?cursor=&limit=&order=&status=available|redeemed|expired&q=prefix)"""
+    try:
+        page = db_helper.page_gift_codes(**_page_args(True), status=request.args.get("status") or None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if page is None:
+        return jsonify({"error": "Failed to load gift codes"}), 500
+    return jsonify({"codes": page["items"], "next_cursor": page["next_cursor"], "has_more": page["has_more"]})
+
+@app.route("/api/admin/gift-codes/<code>", methods=["GET"])
+@admin_required
+def api_gift_code_detail(code):
+    """A gift code with its ledger"""
+    gift_code = db_helper.get_gift_code(code)
+    if not gift_code:
+        return jsonify({"error": "Code not found"}), 404
+    return jsonify({**gift_code, "transactions": db_helper.get_gift_code_transactions(code)})
+
+@app.route("/api/admin/gift-codes/<code>/balance", methods=["POST"])
+@admin_required
+def api_gift_code_balance(code):
+    """Top up ({"top_up": amount}) or set ({"balance": amount}) a gift code's balance"""
+    body = request.get_json() or {}
+    note = (body.get("note") or "").strip()[:255] or None
+    if "top_up" in body:
+        amount = _gift_amount(body.get("top_up"))
+        if amount is None:
+            return jsonify({"error": "Invalid amount"}), 400
+        ok, result = db_helper.top_up_gift_code(code, amount, username="admin", note=note)
+    else:
+        balance = body.get("balance")
+        if isinstance(balance, bool) or (balance != 0 and _gift_amount(balance) is None):
+            return jsonify({"error": "Invalid balance"}), 400
+        ok, result = db_helper.update_gift_code_balance(code, round(float(balance), 2), username="admin", note=note)
+
+    if not ok:
+        return jsonify({"error": result}), 404 if result == "Code not found" else 409
+    log_event(f"gift code {code.upper()} balance changed: {body}")
+    return jsonify({"success": True, **db_helper.get_gift_code(code)}), 200
+
 # Start background ping if configured
 # Start background ping if configured
 
@@ -1537,16 +2090,11 @@ def add_account():
                              step='username',
                              error='This username does not have an active license. Please activate a license key first.')
     
-    # Check if license is expired
-    from datetime import datetime
-    try:
-        expires_date = datetime.strptime(license_data['expires'], '%Y-%m-%d')
-        if expires_date < datetime.now() and not license_data.get('paused', False):
-            return render_template('add_account.html',
-                                 step='username',
-                                 error='This license has expired. Please renew your license first.')
-    except Exception:
-        pass
+    # Check if license is expired (licenses without a valid date are let through)
+    if license_data.expires_on is not None and not license_data.is_active() and not license_data.get('paused', False):
+        return render_template('add_account.html',
+                             step='username',
+                             error='This license has expired. Please renew your license first.')
     
     # Check if account is already linked to this user
     existing_accounts = db_helper.get_user_accounts(user_email)
@@ -1636,54 +2184,36 @@ def add_xp():
         license_data = db_helper.get_license(username)
         
         if not license_data:
-            log_event(f"XP add rejected: username '{username}' not found in database", level="warn")
+            log_event(f"XP add rejected: username '{username}' not found in database", level="warn", event="xp_rejected", username=username)
             return jsonify({'success': False, 'error': 'User not registered'}), 403
         
         # Check if license is expired or paused
-        try:
-            from datetime import datetime
-            expires_date = datetime.strptime(license_data['expires'], '%Y-%m-%d')
-            
-            if license_data.get('paused', False):
-                log_event(f"XP add rejected: username '{username}' license is paused", level="warn")
-                return jsonify({'success': False, 'error': 'License is paused'}), 403
-            
-            if expires_date < datetime.now():
-                log_event(f"XP add rejected: username '{username}' license expired on {license_data['expires']}", level="warn")
-                return jsonify({'success': False, 'error': 'License expired'}), 403
-                
-        except Exception as e:
-            log_event(f"XP add error: failed to parse license date for '{username}': {e}", level="error")
+        if license_data.expires_on is None:
+            log_event(f"XP add error: invalid license date for '{username}'", level="error")
             return jsonify({'success': False, 'error': 'Invalid license data'}), 500
         
+        if license_data.get('paused', False):
+            log_event(f"XP add rejected: username '{username}' license is paused", level="warn", event="xp_rejected", username=username)
+            return jsonify({'success': False, 'error': 'License is paused'}), 403
+        
+        if not license_data.is_active():
+            log_event(f"XP add rejected: username '{username}' license expired on {license_data['expires']}", level="warn", event="xp_rejected", username=username)
+            return jsonify({'success': False, 'error': 'License expired'}), 403
+        
         # ✅ OPTIONAL: Verify player_id matches the registered one (if you use authv2)
         if license_data.get('player_id') and license_data['player_id'] != player_id:
-            log_event(f"XP add rejected: player_id mismatch for '{username}'", level="warn")
+            log_event(f"XP add rejected: player_id mismatch for '{username}'", level="warn", event="xp_rejected", username=username)
             return jsonify({'success': False, 'error': 'Player ID mismatch'}), 403
         
-        # Load XP data from DB
-        xp_data, sha = db_helper.read_storage('user-XP.json')
-        
-        if username not in xp_data:
-            xp_data[username] = {"daily": {}, "weekly": {}, "monthly": {}}
-        
         # Get current date info
-        today = datetime.now().strftime('%Y-%m-%d')
-        week = datetime.now().strftime('%Y-W%U')
-        month = datetime.now().strftime('%Y-%m')
-        
-        # Update daily
-        xp_data[username]['daily'][today] = xp_data[username]['daily'].get(today, 0) + xp_amount
-        
-        # Update weekly
-        xp_data[username]['weekly'][week] = xp_data[username]['weekly'].get(week, 0) + xp_amount
-        
-        # Update monthly
-        xp_data[username]['monthly'][month] = xp_data[username]['monthly'].get(month, 0) + xp_amount
-        
-        # Save to storage (DB)
-        if db_helper.write_storage('user-XP.json', xp_data, sha):
-            log_event(f"XP added: {username} +{xp_amount} XP", level="info")
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        week = now.strftime('%Y-W%U')
+        month = now.strftime('%Y-%m')
+        
+        # Update this user's daily/weekly/monthly XP row in the DB
+        if db_helper.add_user_xp(username, xp_amount, today, week, month):
+            log_event(f"XP added: {username} +{xp_amount} XP", level="info", event="xp_add", username=username)
             return jsonify({'success': True})
         
         return jsonify({'success': False, 'error': 'Failed to save XP data'}), 500
@@ -1799,7 +2329,7 @@ def authv2():
     is_up_to_date = bot_version.lstrip('v') == latest_version.lstrip('v')
     
     # Log bot version
-    log_event(f"authv2: '{username}' connecting with bot version {bot_version} (latest: {latest_version}, upToDate: {is_up_to_date})", level="info")
+    log_event(f"authv2: '{username}' connecting with bot version {bot_version} (latest: {latest_version}, upToDate: {is_up_to_date})", level="info", event="bot_version", username=username)
 
     # STEP 1: Try to find by player_id first
     user_by_id = db_helper.get_user_by_player_id(player_id)
@@ -1807,14 +2337,13 @@ def authv2():
     # STEP 2: If no ID match, try nickname
     user_by_nickname = None
     if not user_by_id:
-        users = load_users()
-        user_by_nickname = find_user(users, username)
+        user_by_nickname = db_helper.find_license(username)
     
     # SCENARIO 1: Player ID matches an existing account
     if user_by_id:
         # CHECK IF LICENSE IS PAUSED
         if user_by_id.get("paused", False):
-            log_event(f"authv2 paused: '{username}' license is paused", level="warn")
+            log_event(f"authv2 paused: '{username}' license is paused", level="warn", event="auth_paused", username=username)
             record_connection(username, ip, "paused")
             return jsonify({
                 "message": "paused",
@@ -1822,10 +2351,8 @@ def authv2():
                 "upToDate": is_up_to_date
             }), 403
 
-        try:
-            expiry = parse_date(user_by_id["expires"])
-        except Exception:
-            log_event(f"authv2 fail: invalid expiry date for ID (nickname: '{username}')", level="error")
+        if user_by_id.expires_on is None:
+            log_event(f"authv2 fail: invalid expiry date for ID (nickname: '{username}')", level="error", event="auth_fail", username=username)
             record_connection(username, ip, "unauthorized")
             return jsonify({
                 "message": "unauthorized",
@@ -1833,7 +2360,7 @@ def authv2():
                 "upToDate": is_up_to_date
             }), 403
 
-        if expiry >= datetime.now():
+        if user_by_id.is_active():
             # ✅ Update user's last bot version
             db_helper.update_user_bot_version(user_by_id["username"], bot_version)
             
@@ -1842,7 +2369,7 @@ def authv2():
             custom_msg = ""
             
             if old_nickname != username:
-                log_event(f"authv2: nickname changed: '{old_nickname}' → '{username}'")
+                log_event(f"authv2: nickname changed: '{old_nickname}' → '{username}'", event="nickname_changed", username=username)
                 db_helper.update_user_nickname(player_id, username, old_nickname)
                 custom_msg = f"🔄 Your nickname has been updated from '{old_nickname}' to '{username}'"
             
@@ -1851,7 +2378,7 @@ def authv2():
             if global_msg:
                 custom_msg = global_msg + ("\n\n" + custom_msg if custom_msg else "")
             
-            log_event(f"authv2 success: '{username}' valid until {user_by_id['expires']}", level="info")
+            log_event(f"authv2 success: '{username}' valid until {user_by_id['expires']}", level="info", event="auth_success", username=username)
             record_connection(username, ip, "authorized")
             
             return jsonify({
@@ -1863,7 +2390,7 @@ def authv2():
                 "upToDate": is_up_to_date
             }), 200
         else:
-            log_event(f"authv2 expired: '{username}' expired on {user_by_id['expires']}", level="warn")
+            log_event(f"authv2 expired: '{username}' expired on {user_by_id['expires']}", level="warn", event="auth_expired", username=username)
             record_connection(username, ip, "expired")
             return jsonify({
                 "message": "expired",
@@ -1876,7 +2403,7 @@ def authv2():
     elif user_by_nickname:
         if user_by_nickname.get("player_id") is None:
             if user_by_nickname.get("paused", False):
-                log_event(f"authv2 paused: '{username}' license is paused", level="warn")
+                log_event(f"authv2 paused: '{username}' license is paused", level="warn", event="auth_paused", username=username)
                 record_connection(username, ip, "paused")
                 return jsonify({
                     "message": "paused",
@@ -1884,10 +2411,8 @@ def authv2():
                     "upToDate": is_up_to_date
                 }), 403
 
-            try:
-                expiry = parse_date(user_by_nickname["expires"])
-            except Exception:
-                log_event(f"authv2 fail: invalid expiry date for '{username}'", level="error")
+            if user_by_nickname.expires_on is None:
+                log_event(f"authv2 fail: invalid expiry date for '{username}'", level="error", event="auth_fail", username=username)
                 record_connection(username, ip, "unauthorized")
                 return jsonify({
                     "message": "unauthorized",
@@ -1895,7 +2420,7 @@ def authv2():
                     "upToDate": is_up_to_date
                 }), 403
 
-            if expiry >= datetime.now():
+            if user_by_nickname.is_active():
                 # First connection - bind player_id to this account
                 db_helper.update_user_player_id(username, player_id)
                 
@@ -1909,7 +2434,7 @@ def authv2():
                 if global_msg:
                     custom_msg = global_msg + "\n\n" + custom_msg
                 
-                log_event(f"authv2 first connection: '{username}' linked to ID")
+                log_event(f"authv2 first connection: '{username}' linked to ID", event="first_connection", username=username)
                 record_connection(username, ip, "authorized")
                 
                 return jsonify({
@@ -1921,7 +2446,7 @@ def authv2():
                     "upToDate": is_up_to_date
                 }), 200
             else:
-                log_event(f"authv2 expired: '{username}' expired on {user_by_nickname['expires']}", level="warn")
+                log_event(f"authv2 expired: '{username}' expired on {user_by_nickname['expires']}", level="warn", event="auth_expired", username=username)
                 record_connection(username, ip, "expired")
                 return jsonify({
                     "message": "expired",
@@ -1930,7 +2455,7 @@ def authv2():
                     "upToDate": is_up_to_date
                 }), 403
         else:
-            log_event(f"authv2 fail: nickname '{username}' already linked to different ID", level="warn")
+            log_event(f"authv2 fail: nickname '{username}' already linked to different ID", level="warn", event="auth_fail", username=username)
             record_connection(username, ip, "unauthorized")
             return jsonify({
                 "message": "unauthorized",
@@ -1940,7 +2465,7 @@ def authv2():
     
     # SCENARIO 3: Neither ID nor nickname found
     else:
-        log_event(f"authv2 fail: no account found for nickname '{username}'", level="warn")
+        log_event(f"authv2 fail: no account found for nickname '{username}'", level="warn", event="auth_fail", username=username)
         record_connection(username, ip, "unauthorized")
         return jsonify({
             "message": "unauthorized",
@@ -2042,6 +2567,140 @@ def api_users_bot_versions():
         log_event(f"Error getting bot version stats: {e}", level="error")
         return jsonify({"error": str(e)}), 500
 
+# -----------------------
+# Log retention
+# -----------------------
+@app.route("/api/admin/logs/policy", methods=["GET"])
+@admin_required
+def api_log_policy():
+    """Log policy configuration and this worker's decision counters"""
+    return jsonify({
+        "sinks": sorted(LOG_SINKS),
+        "aggregate_events": sorted(LOG_POLICY.aggregate_events),
+        "window": LOG_POLICY.window,
+        "sample_rates": LOG_POLICY.sample_rates,
+        "user_limit": LOG_POLICY.user_limit,
+        "stats": dict(LOG_POLICY.stats)
+    })
+
+@app.route("/api/admin/logs/maintenance", methods=["POST"])
+@admin_required
+def api_log_maintenance():
+    """Run log partition creation and retention now"""
+    result = db_helper.run_log_maintenance()
+    log_event(f"log maintenance run: {result['pruned']}")
+    return jsonify(result), 200
+
+# -----------------------
+# Scheduled jobs
+# -----------------------
+SHOP_SYNC_URL = os.getenv("SHOP_SYNC_URL")  # JSON feed: {bundles, skinSets, dailySkins, calendars}
+SHOP_SYNC_INTERVAL = int(os.getenv("SHOP_SYNC_INTERVAL", "900"))  # seconds
+LOG_MAINTENANCE_INTERVAL = int(os.getenv("LOG_MAINTENANCE_INTERVAL", "3600"))  # seconds
+RESET_CLEANUP_INTERVAL = int(os.getenv("RESET_CLEANUP_INTERVAL", "3600"))  # seconds
+
+job_scheduler = JobScheduler(db_helper.engine, record_run=db_helper.record_job_run)
+
+def job_shop_sync():
+    """Pull the shop catalog feed and store what changed"""
+    response = requests.get(SHOP_SYNC_URL, timeout=30)
+    response.raise_for_status()
+    data = response.json()
+    changes = db_helper.save_all_shop_data(
+        data.get("bundles", []), data.get("skinSets", []),
+        data.get("dailySkins", []), data.get("calendars", [])
+    )
+    if changes is None:
+        raise RuntimeError("shop sync failed, see logs")
+    if changes.get("changed"):
+        new_bundles = changes["bundles"]["inserted"]
+        log_event(
+            f"shop synced: {len(new_bundles)} new bundles" + (f" ({', '.join(new_bundles[:5])})" if new_bundles else ""),
+            event="shop_sync"
+        )
+    return {"changed": changes.get("changed", False), "etag": changes.get("etag")}
+
+def job_log_maintenance():
+    """Partitions and retention for logs, plus old job runs and sent emails"""
+    result = db_helper.run_log_maintenance()
+    result["job_runs_pruned"] = db_helper.prune_job_runs()
+    result["emails_pruned"] = db_helper.prune_outbound_emails()
+    return result
+
+def job_reset_cleanup():
+    """Delete expired and used password reset codes"""
+    deleted = db_helper.delete_expired_password_resets()
+    if deleted:
+        print(f"🧹 Deleted {deleted} expired password resets")
+    return {"deleted": deleted}
+
+def job_refresh_admin_summary():
+    """
+    Keep the admin user summary warm. The run is recorded in job_runs, which
+    is what tells every worker's /api/users the view is fresh enough, so a
+    failed refresh has to fail the run.
+    """
+    if not db_helper.refresh_admin_user_summary(force=True):
+        raise RuntimeError("admin_user_summary refresh failed")
+    return {"refreshed": True}
+
+def job_flush_counters():
+    """Write this worker's log aggregation summaries even when no new logs arrive"""
+    flush_log_summaries()
+
+def start_scheduler():
+    if not SCHEDULER_ENABLED:
+        print("⏸️ Scheduler disabled (SCHEDULER_ENABLED=false)")
+        return
+    if SHOP_SYNC_URL:
+        job_scheduler.add_job("shop_sync", job_shop_sync, SHOP_SYNC_INTERVAL, jitter=60, timeout=120)
+    job_scheduler.add_job("log_maintenance", job_log_maintenance, LOG_MAINTENANCE_INTERVAL, jitter=300, timeout=600)
+    job_scheduler.add_job("reset_cleanup", job_reset_cleanup, RESET_CLEANUP_INTERVAL, jitter=300, timeout=60)
+    job_scheduler.add_job(
+        db_helper.ADMIN_SUMMARY_JOB, job_refresh_admin_summary,
+        max(db_helper.ADMIN_SUMMARY_MAX_AGE, 30), jitter=10, timeout=120
+    )
+    # Counters live in each worker's memory, so every worker flushes its own
+    job_scheduler.add_job(
+        "flush_counters", job_flush_counters, LOG_POLICY.window,
+        jitter=5, timeout=30, leader_only=False
+    )
+    job_scheduler.start()
+
+@app.route("/api/admin/jobs", methods=["GET"])
+@admin_required
+def api_jobs():
+    """Scheduler state of this worker plus the persisted run history"""
+    return jsonify({
+        **job_scheduler.status(),
+        "history": db_helper.get_job_runs(request.args.get("job"), request.args.get("limit", 50, type=int))
+    })
+
+@app.route("/api/admin/jobs/<name>/run", methods=["POST"])
+@admin_required
+def api_run_job(name):
+    """Run a scheduled job now (leader-only jobs run only if this worker is the leader)"""
+    if name not in job_scheduler.jobs:
+        return jsonify({"error": "unknown job"}), 404
+    result = job_scheduler.run_now(name)
+    return jsonify(result), 200 if result["status"] in ("ok", "not_leader") else 500
+
+@app.route("/api/admin/emails", methods=["GET"])
+@admin_required
+def api_email_queue():
+    """Outbound email queue counts by status"""
+    stats = db_helper.get_email_queue_stats()
+    if stats is None:
+        return jsonify({"error": "Failed to load email queue"}), 500
+    return jsonify({**stats, "sender_running": EMAIL_SENDER_ENABLED}), 200
+
+@app.route("/api/admin/emails/flush", methods=["POST"])
+@admin_required
+def api_flush_email_queue():
+    """Send every due email now, in this request"""
+    sent, failed = email_sender.run_once()
+    return jsonify({"sent": sent, "failed": failed}), 200
+
 # -----------------------
 # Shutdown Handler
 # -----------------------
@@ -2053,6 +2712,9 @@ def cleanup_on_exit():
     try:
         print("\n🛑 Server shutting down...")
         token_manager.stop_auto_refresh()
+        job_scheduler.shutdown()
+        email_sender.stop()
+        flush_log_summaries(force=True)
         print("✅ Cleanup complete")
     except Exception as e:
         print(f"⚠️ Error during cleanup: {e}")
@@ -2092,6 +2754,14 @@ except Exception as e:
     print("=" * 60)
     print("   - Server will start but registering won't be available.")
 
+# compiled once; send_*_email only fill in the per-recipient fields
+load_email_templates(app.jinja_env)
+
+start_scheduler()
+
+if EMAIL_SENDER_ENABLED:
+    email_sender.start()
+
 # Replace the old functions:
 def search_wolvesville_player(username):
     """Search for player using managed tokens"""
@@ -2104,18 +2774,6 @@ def get_wolvesville_player_profile(player_id):
 
 # ========== FORGOT PASSWORD ROUTES ==========
 
-def init_brevo_client():
-    """Initialize Brevo (Sendinblue) API client"""
-    api_key = os.getenv("BREVO_API_KEY")
-    if not api_key:
-        print("❌ BREVO_API_KEY not set in environment!")
-        return None
-    
-    configuration = sib_api_v3_sdk.Configuration()
-    configuration.api_key['api-key'] = api_key
-    api_client = sib_api_v3_sdk.ApiClient(configuration)
-    return sib_api_v3_sdk.TransactionalEmailsApi(api_client)
-
 def generate_reset_code():
     """Generate a random 6-digit code"""
     return ''.join([str(secrets.randbelow(10)) for _ in range(6)])
@@ -2125,405 +2783,49 @@ def generate_reset_token():
     return secrets.token_urlsafe(32)
 
 def send_password_reset_email(email, reset_code):
-    """Send password reset email with 6-digit code using Brevo"""
+    """Queue the password reset email with the 6-digit code (sent by email_queue)"""
     try:
-        api_instance = init_brevo_client()
-        if not api_instance:
-            log_event(f"Failed to initialize Brevo client for {email}", level="error")
-            return False
-        
-        sender_name = os.getenv("BREVO_SENDER_NAME", "RXZBot")
-        sender_email = os.getenv("BREVO_SENDER_EMAIL", "noreply@rxzbot.com")
-        
-        email_obj = sib_api_v3_sdk.SendSmtpEmail(
-            sender={"name": sender_name, "email": sender_email},
-            to=[{"email": email}],
-            subject="RXZBot password reset request",
-            html_content=f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <style>
-                    body {{
-                        font-family: 'Segoe UI', Arial, sans-serif;
-                        margin: 0;
-                        padding: 0;
-                        background-color: #0a0e1a;
-                    }}
-                    .container {{
-                        background: linear-gradient(135deg, #0a0e1a, #0d1526, #1a1f35);
-                        min-height: 100vh;
-                        display: flex;
-                        align-items: center;
-                        justify-content: center;
-                        padding: 20px;
-                    }}
-                    .card {{
-                        background: linear-gradient(135deg, #0f1724 0%, #0d1520 100%);
-                        border: 1px solid rgba(0, 212, 255, 0.12);
-                        border-radius: 16px;
-                        padding: 40px;
-                        max-width: 520px;
-                        width: 100%;
-                                               color: #eaf1ff;
-                        box-shadow: 0 0 40px rgba(0,  212, 255, 0.06);
-                    }}
-                    h1 {{
-                        color: #00d4ff;
-                        margin: 0 0 8px 0;
-                        font-size: 26px;
-                    }}
-                    .subtitle {{
-                        color: #9aa4b2;
-                        font-size: 14px;
-                        margin-bottom: 28px;
-                    }}
-                    .info {{
-                        color: #d0d8e8;
-                        font-size: 14px;
-                        line-height: 1.6;
-                        margin: 18px 0;
-                    }}
-                    .code-box {{
-                        background: linear-gradient(
-                            135deg,
-                            rgba(0,212,255,0.12),
-                            rgba(0,212,255,0.05)
-                        );
-                        border: 2px solid rgba(0,212,255,0.35);
-                        border-radius: 12px;
-                        padding: 28px;
-                        text-align: center;
-                        margin: 28px 0;
-                    }}
-                    .code {{
-                        font-size: 34px;
-                        font-weight: 700;
-                        color: #00d4ff;
-                        letter-spacing: 8px;
-                        margin: 0;
-                    }}
-                    .timer {{
-                        color: #ffa502;
-                        font-weight: 600;
-                        margin-top: 14px;
-                        font-size: 13px;
-                    }}
-                    .security {{
-                        margin: 28px 0;
-                    }}
-                    .security-item {{
-                        display: flex;
-                        align-items: center;
-                        margin-bottom: 10px;
-                        color: #b5bcc8;
-                        font-size: 13px;
-                    }}
-                    .security-icon {{
-                        color: #00d4ff;
-                        margin-right: 10px;
-                        font-weight: bold;
-                    }}
-                    .warning {{
-                        background: rgba(255,71,87,0.08);
-                        border-left: 4px solid #ff4757;
-                        padding: 14px;
-                        border-radius: 6px;
-                        margin: 22px 0;
-                        color: #ffb3b3;
-                        font-size: 12px;
-                    }}
-                    .footer {{
-                        text-align: center;
-                        color: #7a8294;
-                        font-size: 12px;
-                        margin-top: 32px;
-                        border-top: 1px solid rgba(255,255,255,0.06);
-                        padding-top: 18px;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="card">
-                        <h1>Password Reset Request</h1>
-                        <p class="subtitle">Secure account recovery for RXZBot</p>
-
-                        <p class="info">Hello,</p>
-
-                        <p class="info">
-                            We received a request to reset the password associated with your RXZBot account.
-                            Please use the verification code below to continue.
-                        </p>
-
-                        <div class="code-box">
-                            <p class="code">{reset_code}</p>
-                            <div class="timer">This code expires in 5 minutes</div>
-                        </div>
-
-                        <div class="security">
-                            <div class="security-item">
-                                <span class="security-icon">✓</span>
-                                <span>This code can only be used once</span>
-                            </div>
-                            <div class="security-item">
-                                <span class="security-icon">✓</span>
-                                <span>Automatically expires after 5 minutes</span>
-                            </div>
-                            <div class="security-item">
-                                <span class="security-icon">✓</span>
-                                <span>No changes are made without this code</span>
-                            </div>
-                        </div>
-
-                        <div class="warning">
-                            <strong>Didn’t request this?</strong><br>
-                            If you did not initiate a password reset, you can safely ignore this email.
-                            Your account will remain unchanged.
-                        </div>
-
-                        <p class="info">
-                            Enter this code on the RXZBot password reset page to choose a new password.
-                        </p>
-
-                        <div class="footer">
-                            <p>© 2026 RXZBot. All rights reserved.</p>
-                            <p>This is an automated security message. Please do not reply.</p>
-                        </div>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
+        template = get_email_template("password_reset")
+        queued = send_email(
+            email,
+            template.subject,
+            template.brevo_html,
+            dedup_key=f"password-reset:{email.lower()}:{reset_code}",
+            params=template.params(reset_code=reset_code)
         )
         
-        response = api_instance.send_transac_email(email_obj)
-        log_event(f"Password reset email sent to {email}", level="info")
-        return True
+        if queued:
+            log_event(f"Password reset email queued for {email}", level="info")
+        else:
+            log_event(f"Failed to queue reset email for {email}", level="error")
+        return queued
         
-    except ApiException as e:
-        log_event(f"Brevo API error sending reset email to {email}: {e}", level="error")
-        return False
     except Exception as e:
-        log_event(f"Error sending reset email to {email}: {str(e)}", level="error")
+        log_event(f"Error queueing reset email to {email}: {str(e)}", level="error")
         return False
 
 
-def send_purchase_key_email(email, username, item, access_key):
-    """Send access key email after purchase approval"""
+def send_purchase_key_email(email, username, item, access_key, dedup_key=None):
+    """Queue the access key email after purchase approval (sent by email_queue)"""
     try:
-        api_instance = init_brevo_client()
-        if not api_instance:
-            log_event(f"Failed to initialize Brevo client for {email}", level="error")
-            return False
-        
-        sender_name = os.getenv("BREVO_SENDER_NAME", "RXZBot")
-        sender_email = os.getenv("BREVO_SENDER_EMAIL", "noreply@rxzbot.com")
-        
-        email_obj = sib_api_v3_sdk.SendSmtpEmail(
-            sender={"name": sender_name, "email": sender_email},
-            to=[{"email": email}],
-            subject="Your RXZBot Access Key",
-            html_content=f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <style>
-                    body {{
-                        font-family: 'Segoe UI', Arial, sans-serif;
-                        margin: 0;
-                        padding: 0;
-                        background-color: #0a0e1a;
-                    }}
-                    .container {{
-                        background: linear-gradient(135deg, #0a0e1a, #0d1526, #1a1f35);
-                        min-height: 100vh;
-                        display: flex;
-                        align-items: center;
-                        justify-content: center;
-                        padding: 20px;
-                    }}
-                    .card {{
-                        background: linear-gradient(135deg, #0f1724 0%, #0d1520 100%);
-                        border: 1px solid rgba(0, 212, 255, 0.12);
-                        border-radius: 16px;
-                        padding: 40px;
-                        max-width: 520px;
-                        width: 100%;
-                        color: #eaf1ff;
-                        box-shadow: 0 0 40px rgba(0, 212, 255, 0.06);
-                    }}
-                    h1 {{
-                        color: #00d4ff;
-                        margin: 0 0 8px 0;
-                        font-size: 28px;
-                    }}
-                    .subtitle {{
-                        color: #9aa4b2;
-                        font-size: 14px;
-                        margin-bottom: 28px;
-                    }}
-                    .info {{
-                        color: #d0d8e8;
-                        font-size: 14px;
-                        line-height: 1.8;
-                        margin: 18px 0;
-                    }}
-                    .key-box {{
-                        background: linear-gradient(
-                            135deg,
-                            rgba(0,212,255,0.12),
-                            rgba(0,212,255,0.05)
-                        );
-                        border: 2px solid rgba(0,212,255,0.35);
-                        border-radius: 12px;
-                        padding: 28px;
-                        text-align: center;
-                        margin: 28px 0;
-                    }}
-                    .access-key {{
-                        font-family: 'Courier New', monospace;
-                        font-size: 32px;
-                        font-weight: 700;
-                        color: #00d4ff;
-                        letter-spacing: 4px;
-                        margin: 0;
-                        word-break: break-all;
-                    }}
-                    .key-label {{
-                        color: #9aa4b2;
-                        font-weight: 600;
-                        margin-top: 14px;
-                        font-size: 12px;
-                        text-transform: uppercase;
-                        letter-spacing: 1px;
-                    }}
-                    .item-info {{
-                        background: rgba(0,212,255,0.08);
-                        border-left: 4px solid #00d4ff;
-                        padding: 16px;
-                        border-radius: 6px;
-                        margin: 22px 0;
-                        color: #d0d8e8;
-                        font-size: 13px;
-                    }}
-                    .item-info strong {{
-                        color: #00d4ff;
-                        display: block;
-                        margin-bottom: 6px;
-                    }}
-                    .steps {{
-                        margin: 28px 0;
-                    }}
-                    .step {{
-                        display: flex;
-                        margin-bottom: 14px;
-                        color: #d0d8e8;
-                        font-size: 13px;
-                    }}
-                    .step-number {{
-                        display: flex;
-                        align-items: center;
-                        justify-content: center;
-                        width: 28px;
-                        height: 28px;
-                        background: #00d4ff;
-                        color: #0a0e1a;
-                        border-radius: 50%;
-                        font-weight: 700;
-                        margin-right: 12px;
-                        flex-shrink: 0;
-                    }}
-                    .support {{
-                        background: rgba(46,213,115,0.08);
-                        border-left: 4px solid #2ed573;
-                        padding: 14px;
-                        border-radius: 6px;
-                        margin: 22px 0;
-                        color: #b5bcc8;
-                        font-size: 12px;
-                    }}
-                    .support strong {{
-                        color: #2ed573;
-                    }}
-                    .footer {{
-                        text-align: center;
-                        color: #7a8294;
-                        font-size: 12px;
-                        margin-top: 32px;
-                        border-top: 1px solid rgba(255,255,255,0.06);
-                        padding-top: 18px;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="card">
-                        <h1>🎉 Your Access Key</h1>
-                        <p class="subtitle">Welcome to RXZBot, {username}!</p>
-
-                        <p class="info">Thank you for your purchase! Your payment has been approved and your access key is ready to use.</p>
-
-                        <div class="key-box">
-                            <p class="access-key">{access_key}</p>
-                            <p class="key-label">Your Activation Key</p>
-                        </div>
-
-                        <div class="item-info">
-                            <strong>📦 Purchased Item:</strong>
-                            {item}
-                        </div>
-
-                        <div class="steps">
-                            <div class="step">
-                                <span class="step-number">1</span>
-                                <span>Copy your access key from above</span>
-                            </div>
-                            <div class="step">
-                                <span class="step-number">2</span>
-                                <span>Visit <strong>rxzbot.com/redeem</strong> to activate</span>
-                            </div>
-                            <div class="step">
-                                <span class="step-number">3</span>
-                                <span>Paste your key and click Redeem</span>
-                            </div>
-                            <div class="step">
-                                <span class="step-number">4</span>
-                                <span>Your account will be activated instantly</span>
-                            </div>
-                        </div>
-
-                        <div class="support">
-                            <strong>💬 Need Help?</strong><br>
-                            Contact us on Instagram (@rxzbotcom) or Discord (.gg/rxzbot) if you have any issues.
-                        </div>
-
-                        <p class="info" style="color: #9aa4b2; font-size: 12px;">
-                            <strong>Important:</strong> Keep your access key safe and don't share it with anyone.
-                        </p>
-
-                        <div class="footer">
-                            <p>© 2026 RXZBot. All rights reserved.</p>
-                            <p>This is an automated message. Please do not reply to this email.</p>
-                        </div>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
+        template = get_email_template("purchase_key")
+        queued = send_email(
+            email,
+            template.subject,
+            template.brevo_html,
+            dedup_key=dedup_key,
+            to_name=username,
+            params=template.params(username=username, item=item, access_key=access_key)
         )
         
-        response = api_instance.send_transac_email(email_obj)
-        log_event(f"Purchase key email sent to {email} for {item}", level="info")
-        return True
+        if queued:
+            log_event(f"Purchase key email queued for {email} ({item})", level="info")
+        else:
+            log_event(f"Failed to queue purchase key email for {email}", level="error")
+        return queued
         
-    except ApiException as e:
-        log_event(f"Brevo API error sending purchase key email to {email}: {e}", level="error")
-        return False
     except Exception as e:
-        log_event(f"Error sending purchase key email to {email}: {str(e)}", level="error")
+        log_event(f"Error queueing purchase key email to {email}: {str(e)}", level="error")
         return False
 
 @app.route('/forgot-password', methods=['GET'])
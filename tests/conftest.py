@@ -0,0 +1,50 @@
+"""
+Shared fixtures.
+
+Database tests run against the Postgres database at TEST_DATABASE_URL and
+are skipped when it isn't set. Use a throwaway database: db_helper creates
+the tables on import and the tests empty the ones they use.
+
+    TEST_DATABASE_URL=postgresql://localhost/rxzbot_test python -m pytest -q
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    # db_helper connects on import
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+
+
+@pytest.fixture(scope="session")
+def db_helper():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL not set")
+    import db_helper
+    return db_helper
+
+
+@pytest.fixture
+def empty_tables(db_helper):
+    """Call with table names to truncate them (ids restart at 1)"""
+    from sqlalchemy import text
+
+    def empty(*tables):
+        with db_helper.engine.begin() as conn:
+            conn.execute(text(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE"))
+    return empty
+
+
+@pytest.fixture
+def app(db_helper):
+    """Minimal Flask app with the per-request unit of work of server.py"""
+    from flask import Flask
+    app = Flask(__name__)
+    db_helper.init_request_session(app)
+    return app
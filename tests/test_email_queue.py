@@ -0,0 +1,134 @@
+"""Outbound email queue: dedup, transactional outbox, batching and retries against fake_brevo_server.py"""
+
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import func, select
+
+pytest.importorskip("sib_api_v3_sdk")
+
+HTML = "<p>Your code: {{ params.code }}</p>"
+
+
+@pytest.fixture
+def brevo(db_helper, empty_tables, monkeypatch):
+    """A fake Brevo on a free port; yields the list of received API calls"""
+    import email_queue
+    import fake_brevo_server
+
+    empty_tables("outbound_emails")
+    calls = []
+    original = fake_brevo_server.FakeBrevoHandler.do_POST
+
+    def do_post(handler):
+        calls.append(handler.path)
+        return original(handler)
+
+    monkeypatch.setattr(fake_brevo_server.FakeBrevoHandler, "do_POST", do_post)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fake_brevo_server.FakeBrevoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setenv("BREVO_API_KEY", "test")
+    monkeypatch.setattr(email_queue, "BREVO_API_HOST", f"http://127.0.0.1:{server.server_port}/v3")
+    monkeypatch.setattr(email_queue, "_client", None)
+    yield calls
+    server.shutdown()
+    email_queue._client = None
+
+
+def _emails(db_helper):
+    emails = db_helper._outbound_emails()
+    with db_helper.engine.connect() as conn:
+        return [dict(row._mapping) for row in conn.execute(select(emails).order_by(emails.c.id))]
+
+
+def _queue(email_queue, count, **kwargs):
+    for i in range(count):
+        assert email_queue.send_email(f"user{i}@example.com", "Code", HTML, params={"code": f"{i:06d}"}, **kwargs)
+
+
+def test_dedup_key_queues_once(db_helper, brevo):
+    import email_queue
+    for _ in range(2):
+        assert email_queue.send_email("a@example.com", "Code", HTML, dedup_key="reset:a:1", params={"code": "1"})
+    assert len(_emails(db_helper)) == 1
+
+
+def test_email_commits_with_the_request(db_helper, brevo, app, monkeypatch):
+    import email_queue
+    visible_at_wake = []
+    count = select(func.count()).select_from(db_helper._outbound_emails())
+
+    def wake():
+        with db_helper.engine.connect() as conn:
+            visible_at_wake.append(conn.execute(count).scalar())
+    monkeypatch.setattr(email_queue.email_sender, "wake", wake)
+
+    @app.route("/fail")
+    def fail():
+        try:
+            with db_helper.get_db():
+                email_queue.send_email("a@example.com", "Key", HTML, dedup_key="purchase-key:1")
+                raise RuntimeError("key creation failed")
+        except RuntimeError:
+            return "failed", 500
+
+    @app.route("/ok")
+    def ok():
+        email_queue.send_email("a@example.com", "Key", HTML, dedup_key="purchase-key:1")
+        return "ok"
+
+    client = app.test_client()
+    client.get("/fail")
+    assert _emails(db_helper) == []
+    assert visible_at_wake == []  # rolled back: nobody woken
+
+    client.get("/ok")
+    assert len(_emails(db_helper)) == 1
+    assert visible_at_wake == [1]  # woken after the commit
+
+
+def test_same_html_is_sent_as_one_batch(db_helper, brevo):
+    import email_queue
+    _queue(email_queue, 3)
+    assert email_queue.EmailSender(batch_size=10).run_once() == (3, 0)
+
+    assert len(brevo) == 1
+    emails = _emails(db_helper)
+    assert {e["status"] for e in emails} == {"sent"}
+    assert len({e["message_id"] for e in emails}) == 3
+
+
+def test_failed_send_is_retried_with_backoff(db_helper, brevo, monkeypatch):
+    import email_queue
+    import fake_brevo_server
+    _queue(email_queue, 1)
+
+    monkeypatch.setattr(fake_brevo_server, "FAIL_RATE", 1.0)
+    assert email_queue.EmailSender().run_once() == (0, 1)
+    (email,) = _emails(db_helper)
+    assert email["status"] == "pending" and email["attempts"] == 1
+    assert email["next_attempt_at"] > datetime.utcnow()
+    assert "503" in email["last_error"]
+
+    # Not due yet
+    assert email_queue.EmailSender().run_once() == (0, 0)
+
+    monkeypatch.setattr(fake_brevo_server, "FAIL_RATE", 0.0)
+    emails = db_helper._outbound_emails()
+    with db_helper.engine.begin() as conn:
+        conn.execute(emails.update().values(next_attempt_at=datetime.utcnow()))
+    assert email_queue.EmailSender().run_once() == (1, 0)
+    (email,) = _emails(db_helper)
+    assert email["status"] == "sent" and email["attempts"] == 2 and email["message_id"]
+
+
+def test_client_errors_fail_for_good(db_helper, brevo, monkeypatch):
+    import email_queue
+    _queue(email_queue, 1)
+    monkeypatch.setattr(email_queue, "BREVO_API_HOST", email_queue.BREVO_API_HOST + "/missing")
+    assert email_queue.EmailSender().run_once() == (0, 1)
+    (email,) = _emails(db_helper)
+    assert email["status"] == "failed" and "404" in email["last_error"]
@@ -0,0 +1,56 @@
+"""Precompiled email templates: escaping, Brevo placeholders and field checks"""
+
+import os
+
+import pytest
+
+jinja2 = pytest.importorskip("jinja2")
+
+from conftest import ROOT
+import email_templates
+from email_templates import EmailTemplate
+
+
+@pytest.fixture(scope="module")
+def env():
+    # Same autoescaping as Flask's app.jinja_env for .html templates
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.join(ROOT, "templates")),
+        autoescape=jinja2.select_autoescape(["html"])
+    )
+
+
+@pytest.fixture(scope="module")
+def templates(env):
+    return email_templates.load_email_templates(env)
+
+
+def test_fields_are_escaped(templates):
+    html = templates["purchase_key"].render(username="<b>bob</b>", item="Gems & \"Roses\"", access_key="AB12CD")
+    assert "&lt;b&gt;bob&lt;/b&gt;" in html and "<b>bob" not in html
+    assert "Gems &amp; &#34;Roses&#34;" in html
+    assert "AB12CD" in html
+    assert "\x00" not in html
+
+
+def test_render_matches_a_direct_jinja_render(env, templates):
+    values = {"username": "<i>x</i>", "item": "a & b", "access_key": "K"}
+    direct = env.get_template("emails/purchase_key.html").render(**values)
+    assert templates["purchase_key"].render(**values) == direct
+
+
+def test_brevo_html_is_shared_and_params_are_escaped(templates):
+    template = templates["password_reset"]
+    assert "{{ params.reset_code }}" in template.brevo_html
+    assert "\x00" not in template.brevo_html
+    assert template.params(reset_code="<123>") == {"reset_code": "&lt;123&gt;"}
+    filled = template.brevo_html.replace("{{ params.reset_code }}", template.params(reset_code="123456")["reset_code"])
+    assert filled == template.render(reset_code="123456")
+
+
+def test_field_that_is_not_output_directly_is_rejected():
+    env = jinja2.Environment(
+        loader=jinja2.DictLoader({"upper.html": "<p>{{ name|upper }}</p>"}), autoescape=True
+    )
+    with pytest.raises(ValueError, match="name"):
+        EmailTemplate(env, "upper.html", "Subject", ["name"])
@@ -0,0 +1,119 @@
+"""Gift code balances under concurrent redemption and spending"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import func, select, text
+
+
+@pytest.fixture
+def gift_code(db_helper, empty_tables):
+    empty_tables("gift_codes", "gift_code_transactions")
+
+    def mint(amount):
+        return db_helper.create_gift_code(amount)
+    return mint
+
+
+def _concurrently(func_, args_list):
+    with ThreadPoolExecutor(max_workers=len(args_list)) as pool:
+        return list(pool.map(lambda args: func_(*args), args_list))
+
+
+def _ledger(db_helper, code):
+    ledger = db_helper._gift_code_transactions()
+    with db_helper.engine.connect() as conn:
+        return conn.execute(
+            select(ledger.c.kind, ledger.c.delta, ledger.c.balance_after)
+            .where(ledger.c.code == code).order_by(ledger.c.id)
+        ).all()
+
+
+def test_code_is_redeemed_once(db_helper, gift_code):
+    code = gift_code(25)
+    results = _concurrently(db_helper.redeem_gift_code, [(code, f"user{i}") for i in range(8)])
+
+    assert sorted(ok for ok, _ in results) == [False] * 7 + [True]
+    assert [value for ok, value in results if ok] == [25.0]
+    assert {value for ok, value in results if not ok} == {"Code already redeemed"}
+    assert db_helper.get_gift_code(code)["amount"] == 0
+    assert [kind for kind, _, _ in _ledger(db_helper, code)] == ["mint", "redeem"]
+
+
+def test_concurrent_spends_never_overdraw(db_helper, gift_code):
+    code = gift_code(100)
+    results = _concurrently(db_helper.spend_gift_code, [(code, 15, f"user{i}") for i in range(10)])
+
+    assert sum(ok for ok, _ in results) == 6
+    assert {value for ok, value in results if not ok} == {"Insufficient balance"}
+    assert db_helper.get_gift_code(code)["amount"] == 10
+
+    ledger = _ledger(db_helper, code)
+    assert sum(delta for _, delta, _ in ledger) == Decimal("10")
+    assert sorted(balance for _, _, balance in ledger[1:]) == [Decimal(b) for b in (10, 25, 40, 55, 70, 85)]
+
+
+def test_spending_the_whole_balance_redeems_the_code(db_helper, gift_code):
+    code = gift_code(30)
+    assert db_helper.spend_gift_code(code, 30, "alice") == (True, 0.0)
+    assert db_helper.get_gift_code(code)["is_redeemed"] is True
+    assert db_helper.spend_gift_code(code, 1, "bob") == (False, "Code already redeemed")
+
+
+def test_ledger_is_append_only(db_helper, gift_code):
+    code = gift_code(5)
+    for statement in ("UPDATE gift_code_transactions SET delta = 0", "DELETE FROM gift_code_transactions"):
+        with pytest.raises(Exception, match="append-only"):
+            with db_helper.engine.begin() as conn:
+                conn.execute(text(statement))
+    with db_helper.engine.connect() as conn:
+        count = conn.execute(select(func.count()).select_from(db_helper._gift_code_transactions())).scalar()
+    assert count == 1
+
+
+def _wait_for_lock_waiter(db_helper, timeout=10):
+    """Block until some other backend is waiting on a row lock"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with db_helper.engine.connect() as conn:
+            if conn.execute(text("SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'")).scalar():
+                return
+        time.sleep(0.01)
+    raise AssertionError("no backend blocked on the gift code row")
+
+
+@pytest.mark.parametrize("delta", [-15, 15])
+def test_redeem_waiting_on_a_balance_change_pays_the_new_balance(db_helper, gift_code, delta):
+    """A redeem blocked behind a spend or top-up must see the committed balance"""
+    code = gift_code(100)
+    codes, ledger = db_helper._gift_codes(), db_helper._gift_code_transactions()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with db_helper.engine.begin() as conn:
+            conn.execute(codes.update().where(codes.c.code == code).values(amount=codes.c.amount + delta))
+            conn.execute(ledger.insert().values(
+                code=code, kind="spend" if delta < 0 else "topup", delta=delta, balance_after=100 + delta
+            ))
+            redeem = pool.submit(db_helper.redeem_gift_code, code, "alice")
+            _wait_for_lock_waiter(db_helper)
+        assert redeem.result() == (True, float(100 + delta))
+
+    assert sum(delta for _, delta, _ in _ledger(db_helper, code)) == 0
+    assert db_helper.get_gift_code(code)["amount"] == 0
+
+
+def test_adjustment_waiting_on_a_spend_records_the_real_delta(db_helper, gift_code):
+    code = gift_code(100)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        with db_helper.engine.begin() as conn:
+            codes, ledger = db_helper._gift_codes(), db_helper._gift_code_transactions()
+            conn.execute(codes.update().where(codes.c.code == code).values(amount=85))
+            conn.execute(ledger.insert().values(code=code, kind="spend", delta=-15, balance_after=85))
+            adjust = pool.submit(db_helper.update_gift_code_balance, code, 50, "admin")
+            _wait_for_lock_waiter(db_helper)
+        assert adjust.result() == (True, "Balance updated")
+
+    ledger = _ledger(db_helper, code)
+    assert ledger[-1] == ("adjust", Decimal("-35"), Decimal("50"))
+    assert sum(delta for _, delta, _ in ledger) == Decimal("50")
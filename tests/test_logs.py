@@ -0,0 +1,31 @@
+"""Log rows are kept when the request that wrote them rolls back"""
+
+from sqlalchemy import select
+
+
+def _timestamps(db_helper, table):
+    with db_helper.engine.connect() as conn:
+        return conn.execute(select(table.c.timestamp).order_by(table.c.id)).scalars().all()
+
+
+def test_logs_survive_a_rolled_back_request(db_helper, empty_tables, app):
+    empty_tables("logs", "recent_connections", "keys")
+    logs = db_helper.Log.__table__
+    connections = db_helper.RecentConnection.__table__
+
+    @app.route("/fail")
+    def fail():
+        try:
+            with db_helper.get_db():
+                db_helper.create_key("KEY001", 30, "2026-01-01 00:00:00Z")
+                db_helper.save_log("2026-01-01 00:00:01Z", "key creation failed", "error")
+                db_helper.save_recent_connection("2026-01-01 00:00:02Z", "alice", "127.0.0.1", "denied")
+                raise RuntimeError("key creation failed")
+        except RuntimeError:
+            return "failed", 500
+
+    assert app.test_client().get("/fail").status_code == 500
+    with db_helper.engine.connect() as conn:
+        assert conn.execute(select(db_helper._keys.c.code)).all() == []
+    assert _timestamps(db_helper, logs) == ["2026-01-01 00:00:01Z"]
+    assert _timestamps(db_helper, connections) == ["2026-01-01 00:00:02Z"]
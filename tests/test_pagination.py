@@ -0,0 +1,68 @@
+"""Keyset pagination: cursors across ties and NULL sort values"""
+
+from datetime import date, datetime, timedelta
+
+import pytest
+
+
+def _walk(page, limit, **kwargs):
+    """Every item of a listing, following next_cursor page by page"""
+    items, cursor = [], None
+    while True:
+        result = page(cursor=cursor, limit=limit, **kwargs)
+        items.extend(result["items"])
+        assert result["has_more"] == (result["next_cursor"] is not None)
+        if not result["has_more"]:
+            return items
+        cursor = result["next_cursor"]
+
+
+@pytest.fixture
+def gift_codes(db_helper, empty_tables):
+    """Codes with tied and NULL created_at values; returns (code, created_at, id) in insert order"""
+    empty_tables("gift_codes", "gift_code_transactions")
+    base = datetime(2026, 1, 1, 12, 0, 0)
+    created = [base, base, base + timedelta(hours=1), None, base, None, base + timedelta(hours=2), None]
+    rows = [
+        {"code": f"CODE{i:02d}", "amount": 10, "initial_amount": 10, "is_redeemed": False, "created_at": at}
+        for i, at in enumerate(created)
+    ]
+    with db_helper.engine.begin() as conn:
+        conn.execute(db_helper._gift_codes().insert(), rows)
+    return [(row["code"], row["created_at"], i + 1) for i, row in enumerate(rows)]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 50])
+@pytest.mark.parametrize("descending", [True, False])
+def test_gift_code_pages_cover_ties_and_nulls(db_helper, gift_codes, descending, limit):
+    dated = sorted((row for row in gift_codes if row[1]), key=lambda r: (r[1], r[2]), reverse=descending)
+    undated = sorted((row for row in gift_codes if not row[1]), key=lambda r: r[2], reverse=descending)
+    expected = [row[0] for row in dated + undated]  # NULLs last in both directions
+
+    items = _walk(db_helper.page_gift_codes, limit, descending=descending)
+    assert [item["code"] for item in items] == expected
+
+
+def test_cursor_is_bound_to_its_ordering(db_helper, gift_codes):
+    first = db_helper.page_gift_codes(limit=2, descending=True)
+    with pytest.raises(ValueError):
+        db_helper.page_gift_codes(cursor=first["next_cursor"], limit=2, descending=False)
+    with pytest.raises(ValueError):
+        db_helper.page_gift_codes(cursor="not-a-cursor", limit=2)
+
+
+def test_license_pages_by_expiry(db_helper, empty_tables):
+    empty_tables("users", "last_connected")
+    users = db_helper._users
+    expiry = [date(2026, 3, 1), None, date(2026, 3, 1), date(2026, 2, 1), None, date(2026, 3, 1)]
+    with db_helper.engine.begin() as conn:
+        conn.execute(users.insert(), [
+            {"username": f"user{i}", "expires": "2026-01-01", "expires_on": on, "paused": False}
+            for i, on in enumerate(expiry)
+        ])
+
+    items = _walk(db_helper.page_licenses, 2, sort="expires", descending=False)
+    assert [item["username"] for item in items] == ["user3", "user0", "user2", "user5", "user1", "user4"]
+
+    items = _walk(db_helper.page_licenses, 2, sort="expires", descending=True)
+    assert [item["username"] for item in items] == ["user5", "user2", "user0", "user3", "user4", "user1"]
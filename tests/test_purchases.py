@@ -0,0 +1,106 @@
+"""Purchase work queue: claims, completion conflicts and queue order"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+
+@pytest.fixture
+def purchases(db_helper, empty_tables):
+    """Creates purchases and returns their ids, oldest first"""
+    empty_tables("purchases", "keys", "outbound_emails")
+
+    def create(count=1):
+        ids = []
+        for i in range(count):
+            result = db_helper.create_purchase(f"user{i}", f"user{i}@example.com", "Instagram", "30 days", "EUR", 5)
+            ids.append(result["purchase_id"])
+        # Distinct creation times, in id order
+        start = datetime(2026, 1, 1)
+        with db_helper.engine.begin() as conn:
+            for n, purchase_id in enumerate(ids):
+                conn.execute(
+                    db_helper._purchases().update()
+                    .where(db_helper._purchases().c.id == purchase_id)
+                    .values(created_at=start + timedelta(minutes=n))
+                )
+        return ids
+    return create
+
+
+def test_claim_conflicts_between_admins(db_helper, purchases):
+    (purchase_id,) = purchases()
+    assert db_helper.claim_purchase(purchase_id, "alice")["success"]
+
+    taken = db_helper.claim_purchase(purchase_id, "bob")
+    assert taken["conflict"] and "alice" in taken["error"]
+    assert db_helper.update_purchase_with_key(purchase_id, "KEY001", claimant="bob")["conflict"]
+
+    assert db_helper.release_purchase_claim(purchase_id, "alice")
+    assert db_helper.claim_purchase(purchase_id, "bob")["success"]
+
+
+def test_completed_purchase_cannot_be_claimed_or_completed_again(db_helper, purchases):
+    (purchase_id,) = purchases()
+    assert db_helper.claim_purchase(purchase_id, "alice")["success"]
+    done = db_helper.update_purchase_with_key(purchase_id, "KEY001", claimant="alice")
+    assert done["success"] and done["purchase"]["claimed_by"] is None
+
+    # Completion released the claim; the status check is what keeps others out
+    for result in (
+        db_helper.claim_purchase(purchase_id, "bob"),
+        db_helper.update_purchase_with_key(purchase_id, "KEY002", claimant="alice"),
+    ):
+        assert result == {"success": False, "error": "Purchase already completed", "conflict": True}
+    assert db_helper.get_purchase(purchase_id)["access_key"] == "KEY001"
+
+
+def test_concurrent_approvals_from_one_session(db_helper, purchases):
+    """Tabs of one admin session share a claimant; only one approval may win"""
+    (purchase_id,) = purchases()
+    db_helper.claim_purchase(purchase_id, "admin-1")
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(
+            lambda n: db_helper.update_purchase_with_key(purchase_id, f"KEY{n:03d}", claimant="admin-1"),
+            range(6)
+        ))
+    assert sum(result["success"] for result in results) == 1
+    assert all(result["conflict"] for result in results if not result["success"])
+
+
+def test_claim_purchases_hands_out_disjoint_batches(db_helper, purchases):
+    ids = purchases(6)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        batches = list(pool.map(lambda name: db_helper.claim_purchases(name, limit=3), ["alice", "bob"]))
+    claimed = [p["id"] for batch in batches for p in batch]
+    assert sorted(claimed) == ids
+    assert db_helper.claim_purchases("carol", limit=3) == []
+
+
+def test_pending_list_is_newest_first_and_queue_oldest_first(db_helper, purchases):
+    ids = purchases(3)
+    assert [p["id"] for p in db_helper.get_pending_purchases()] == ids[::-1]
+    queue = db_helper.page_purchases(status="pending", descending=False)
+    assert [p["id"] for p in queue["items"]] == ids
+
+
+def test_failed_approval_rolls_back_in_the_request(db_helper, purchases, app):
+    """A step failing inside the approval savepoint undoes completion and the key"""
+    (purchase_id,) = purchases()
+
+    @app.route("/approve")
+    def approve():
+        try:
+            with db_helper.get_db():
+                assert db_helper.update_purchase_with_key(purchase_id, "KEY001")["success"]
+                assert db_helper.create_key("KEY001", 30, "2026-01-01 00:00:00Z")
+                raise RuntimeError("email could not be queued")
+        except RuntimeError:
+            return "failed", 500
+
+    assert app.test_client().get("/approve").status_code == 500
+    assert db_helper.get_purchase(purchase_id)["status"] == "Awaiting user contact"
+    with db_helper.engine.connect() as conn:
+        assert conn.execute(select(db_helper._keys.c.code)).all() == []